@@ -1,76 +1,204 @@
 from itertools import islice
-from collections import defaultdict, Counter
-import operator
-import string
-import re
+from collections import defaultdict, Counter, namedtuple
+from datetime import datetime, timezone
 import db
-import os
-from nltk.util import ngrams
-
-up_dir = os.path.dirname(os.path.dirname(__file__))
-stop_words_file = up_dir + '/stopwords.txt'
-stop_words = set(line.strip() for line in open(stop_words_file))
-stop_words.add('')
-
-punc = string.punctuation
-# Not sure what codec these two characters are from
-# but they are different than the quotes found in
-# string.punctuation and are not being removed
-punc += '”'
-punc += '“'
-
-# Messages we don't want used in the common_phrases method
-# because they're posted by slack
-omit_phrases = ['joined the channel', 'left the channel',
-                'pinned a message', 'uploaded a file']
-
-CHANNEL_EXPR = re.compile('(?<=<#)(.*?)(?=>)')
-USER_EXPR = re.compile('(?<=<@)(.*?)(?=>)')
-
+import nlp
+import metrics
+from cache import results
+from functools import wraps
 
 
 # DB Queries
-ALL_MESSAGE_TEXTS = 'SELECT Text FROM Messages'
-MESSAGES_WITH_REACT = '''
-    SELECT Text FROM Messages
-    INNER JOIN Reacts ON Messages.MessageID=Reacts.MessageID
-    WHERE Reacts.ReactName = %s
+
+# Each analytics command is one SQL statement, kept in parts so that
+# compile_query can turn the command's filters into WHERE clauses and the
+# requested count into the LIMIT. filters maps a filter name to its column,
+# or to a condition with a %s when it isn't an equality test. Every query is
+# scoped to one team, and the indexes it reads lead with TeamID. The SQL has
+# to run on every db backend.
+#
+# The rollups count all of history. A command asked for a window (since)
+# reads the raw tables instead, with a range scan on (TeamID, CreatedAt).
+Query = namedtuple('Query', ['select', 'where', 'filters', 'tail'])
+
+# Unfiltered top-N reads come from the rollup tables maintained by db
+TOP_REACTS = Query('''
+    SELECT ReactName, Count FROM ReactCounts''',
+    ['Count > 0'], {'team': 'TeamID'},
+    'ORDER BY Count DESC')
+
+REACTS_BY_USER = Query('''
+    SELECT ReactName, COUNT(*) FROM Reacts''',
+    [], {'team': 'Reacts.TeamID', 'user': 'Reacts.UserID', 'since': 'Reacts.CreatedAt >= %s'},
+    'GROUP BY ReactName ORDER BY COUNT(*) DESC')
+
+REACTS_IN_CHANNEL = Query('''
+    SELECT Reacts.ReactName, COUNT(*) FROM Reacts
+    INNER JOIN Messages ON Messages.MessageID=Reacts.MessageID''',
+    [], {'team': 'Messages.TeamID', 'user': 'Reacts.UserID', 'channel': 'Messages.ChannelID',
+         'since': 'Reacts.CreatedAt >= %s'},
+    'GROUP BY Reacts.ReactName ORDER BY COUNT(*) DESC')
+
+MOST_REACTED_TO = Query('''
+    SELECT Messages.Text, MessageReactCounts.Total FROM MessageReactCounts
+    INNER JOIN Messages ON Messages.MessageID=MessageReactCounts.MessageID''',
+    ['MessageReactCounts.Total > 0'],
+    {'team': 'MessageReactCounts.TeamID', 'user': 'Messages.UserID', 'channel': 'Messages.ChannelID',
+     'since': 'Messages.CreatedAt >= %s'},
+    'ORDER BY MessageReactCounts.Total DESC')
+
+# The react names on the top messages are read by REACT_NAMES_ON, as there is
+# no array type in SQLite
+MOST_UNIQUE_REACTS = Query('''
+    SELECT Messages.MessageID, Messages.Text FROM MessageReactCounts
+    INNER JOIN Messages ON Messages.MessageID=MessageReactCounts.MessageID''',
+    ['MessageReactCounts.DistinctReacts > 0', "Messages.Text <> ''"],
+    {'team': 'MessageReactCounts.TeamID', 'user': 'Messages.UserID', 'channel': 'Messages.ChannelID',
+     'since': 'Messages.CreatedAt >= %s'},
+    'ORDER BY MessageReactCounts.DistinctReacts DESC')
+
+REACT_NAMES_ON = 'SELECT DISTINCT MessageID, ReactName FROM Reacts WHERE MessageID IN ({})'
+MESSAGE_TEXTS_ON = 'SELECT MessageID, Text FROM Messages WHERE MessageID IN ({})'
+
+REACT_TOTALS = Query('''
+    SELECT UserID, Count FROM UserReactCounts''',
+    ['Count > 0'], {'team': 'TeamID'},
+    'ORDER BY Count DESC')
+
+REACTS_BY_REACTOR = Query('''
+    SELECT UserID, COUNT(*) FROM Reacts''',
+    ['UserID IS NOT NULL'], {'team': 'TeamID', 'since': 'CreatedAt >= %s'},
+    'GROUP BY UserID ORDER BY COUNT(*) DESC')
+
+# A message is counted once per react on it, as the MESSAGES_WITH_REACT join did
+REACT_WORDS = Query('''
+    SELECT MessageWords.Word, COUNT(*) FROM Reacts
+    INNER JOIN MessageWords ON MessageWords.MessageID=Reacts.MessageID''',
+    [], {'team': 'Reacts.TeamID', 'react': 'Reacts.ReactName', 'since': 'Reacts.CreatedAt >= %s'},
+    'GROUP BY MessageWords.Word ORDER BY COUNT(*) DESC')
+
+# Every requested react's top words in one statement, for the buzzwords
+# command on backends whose GROUP BY hashes. ROW_NUMBER keeps each react's
+# top rows. The names are an IN list as SQLite has no arrays for = ANY.
+REACT_WORDS_BY_REACT = '''
+    SELECT ReactName, Word, Total FROM
+    (SELECT Reacts.ReactName, MessageWords.Word, COUNT(*) AS Total,
+     ROW_NUMBER() OVER (PARTITION BY Reacts.ReactName ORDER BY COUNT(*) DESC) AS WordRank
+     FROM Reacts INNER JOIN MessageWords ON MessageWords.MessageID=Reacts.MessageID
+     WHERE Reacts.TeamID = %s AND Reacts.ReactName IN ({names}){since}
+     GROUP BY Reacts.ReactName, MessageWords.Word) AS ranked{limit}'''
+# Where GROUP BY sorts, REACT_WORDS for each react in one statement instead
+REACT_WORDS_PART = 'SELECT %s, t.* FROM ({}) AS t'
+
+PHRASE_TOTALS = Query('''
+    SELECT Phrase, Count FROM PhraseCounts''',
+    ['Count > 0'], {'team': 'TeamID'},
+    'ORDER BY Count DESC')
+
+MESSAGE_TEXTS = Query('''
+    SELECT Text FROM Messages''',
+    [], {'team': 'TeamID', 'since': 'CreatedAt >= %s'},
+    '')
+
+ACTIVITY_TOTALS = Query('''
+    SELECT UserID, Count FROM UserActivity''',
+    ['Count > 0'], {'team': 'TeamID'},
+    'ORDER BY Count DESC')
+
+MESSAGES_BY_USER = Query('''
+    SELECT UserID, COUNT(*) FROM Messages''',
+    ['UserID IS NOT NULL'], {'team': 'TeamID', 'since': 'CreatedAt >= %s'},
+    'GROUP BY UserID ORDER BY COUNT(*) DESC')
+
+
+def compile_query(query, count, **filters):
     '''
-REACTS_BY_USER = '''
-    SELECT * FROM Reacts WHERE Reacts.UserID = %s
+    Builds the SQL for query, adding a WHERE clause for every filter that is
+    not None. A count of None means no limit.
+
+    Returns:
+        tuple: (sql, args) ready for db.execute
     '''
-ALL_REACTS = '''
-    SELECT Messages.MessageID, Text, ReactName FROM Messages
-    INNER JOIN Reacts ON Messages.MessageID=Reacts.MessageID
+    conditions = list(query.where)
+    args = []
+    for name, value in filters.items():
+        if value is None:
+            continue
+        if name not in query.filters:
+            raise ValueError('Query does not support filtering by ' + name)
+        column = query.filters[name]
+        conditions.append(db.backend.range_condition(column) if '%s' in column else column + ' = %s')
+        args.append(value)
+
+    sql = query.select
+    if conditions:
+        sql += '\n    WHERE ' + ' AND '.join(conditions)
+    sql += '\n    ' + query.tail + ' LIMIT %s'
+    args.append(db.backend.no_limit if count is None else count)
+    return sql, tuple(args)
+
+
+def run_query(query, count, **filters):
+    sql, args = compile_query(query, count, **filters)
+    return db.execute(sql, args)
+
+
+def window_start(window):
     '''
-MOST_REACTED_TO = '''
-    SELECT Messages.Text, Count(Reacts.ReactName) FROM Messages
-    INNER JOIN Reacts ON Messages.MessageID=Reacts.MessageID
-    GROUP BY Messages.MessageID
-    ORDER BY Count(Reacts.ReactName) DESC
+    Start of a window (timedelta) ending now, or None for all of history,
+    which a window reaching back before year 1 is too
     '''
+    if window is None:
+        return None
+    try:
+        return datetime.now(timezone.utc) - window
+    except OverflowError:
+        return None
 
-REACT_TOTALS = '''SELECT UserID, COUNT(UserID) FROM Reacts 
-    GROUP BY UserID
-    ORDER BY COUNT(UserID)
-    '''
 
-ACTIVITY_TOTALS = '''
-    Select UserID, Count(UserID) FROM
-    (SELECT UserID FROM Messages UNION ALL
-    SELECT UserID FROM Reacts) 
-    As t
-    GROUP BY UserID
-    ORDER BY Count(UserID) DESC
-'''
+# Might be going a little overboard with the decorators here
 
+# Outermost, so cache hits and engine answers are timed as the bot sees them
+ANALYTICS_SECONDS = metrics.histogram('analytics_seconds', 'Latency of the analytics commands',
+                                      ('function',))
 
-# Might be going a little overboard with the decorators here
+# engine.Engine answering the counting commands in memory, set by the bot
+# when ANALYTICS_ENGINE is enabled
+engine = None
+
+def served_by_engine(f):
+    '''
+    Answers from the in-process engine once it has loaded and has every write
+    to the team, else runs f
+    '''
+    @wraps(f)
+    def wrapper(team_id, *args, **kwargs):
+        if engine is not None and engine.serves(team_id):
+            return getattr(engine, f.__name__)(team_id, *args, **kwargs)
+        return f(team_id, *args, **kwargs)
+    return wrapper
+
+# sketch.Sketches answering common_phrases, buzzwords and most_unique
+# approximately, set by the bot when ANALYTICS_SKETCHES is on
+sketches = None
+
+def approximate(method, team_id, *args, window=None, **filters):
+    '''
+    Calls method of the sketches once they have loaded. They count all of
+    history with no filters, so for a window or any filter this returns
+    None and the command is answered exactly.
+    '''
+    if sketches is None or not sketches.ready or window is not None:
+        return None
+    if any(value is not None for value in filters.values()):
+        return None
+    return getattr(sketches, method)(team_id, *args)
 
 def get_top(f, count=5):
     '''
     Returns the most common elements returned by f
     '''
+    @wraps(f)
     def wrapper(*args, **kwargs):
         result = f(*args, **kwargs)
         counter = Counter(result)
@@ -81,6 +209,7 @@ def to_dict(f):
     '''
     Converts a list of rows to a dict of the first element in the row to a tuple of the rest
     '''
+    @wraps(f)
     def wrapper(*args, **kwargs):
         tbl = f(*args, **kwargs)
         tbl = {row[0] : tuple(row[1:]) for row in tbl if row[0]}
@@ -89,24 +218,27 @@ def to_dict(f):
 
 
 
-@get_top
-@to_dict
-def favorite_reacts_of_user(user):
-    tbl = db.execute(REACTS_BY_USER, (user,))
-    return tbl
-
-def favorite_reacts_of_users(users):
-    return {user: favorite_reacts_of_user(user) for user in users}
+def favorite_reacts_of_user(team_id, user, count=5, window=None):
+    return most_used_reacts(team_id, user=user, count=count, window=window)
 
-@get_top
-def most_used_reacts(user=None):
-    if user:
-        return favorite_reacts_of_user(user)
+def favorite_reacts_of_users(team_id, users, window=None):
+    return {user: favorite_reacts_of_user(team_id, user, window=window) for user in users}
 
-    tbl = db.execute(ALL_REACTS)
+# Cached results of windowed commands are keyed on the window's length, so
+# they can lag the sliding window by up to the cache TTL
 
-    counter = Counter([r[2] for r in tbl])
-    return dict(counter)
+@ANALYTICS_SECONDS.timed()
+@results.cached('most_used')
+@served_by_engine
+def most_used_reacts(team_id, user=None, channel=None, count=5, window=None):
+    since = window_start(window)
+    if channel:
+        query = REACTS_IN_CHANNEL
+    elif user or since:
+        query = REACTS_BY_USER
+    else:
+        query = TOP_REACTS
+    return dict(run_query(query, count, team=team_id, user=user, channel=channel, since=since))
 
 
 def translate_token(token, users, channels):
@@ -122,128 +254,229 @@ def translate_token(token, users, channels):
 	Returns: 
 		str: translated word
 	'''
-    find = CHANNEL_EXPR.search(token)
-    if find:
-        channel_id = find.group(0)
-        return channels.get(channel_id, token)
+    if '<' not in token:
+        return token
+    return nlp.resolve_mention(token, users, channels)
 
-    find = USER_EXPR.search(token)
-    if find:
-        user_id = find.group(0)
-        return users.get(user_id, token)
 
-    return token
+_disp_names_cache = (None, -1, {})
+
+def display_names(users):
+    '''
+    Returns {user ID: display name}, rebuilt only when the users dict changes
+    '''
+    global _disp_names_cache
+    cached_users, cached_len, disp_names = _disp_names_cache
+    if cached_users is not users or cached_len != len(users):
+        disp_names = {user : users[user]['display_name'] for user in users}
+        _disp_names_cache = (users, len(users), disp_names)
+    return disp_names
 
 
 def unique_words(msgs, users, channels):
     ''' 
 	Args: 
-		msgs     (list) : list of messages
+		msgs     (iterable) : messages, consumed once
 		users    (list) : list of "escaped" Slack users
 	    channels (list) : list of "escaped" Slack channels
 
 	Returns: 
 		Counter: All unique words used in the given messages
 	'''
+    return nlp.tokenizer.count(msgs, display_names(users), channels)
 
-    disp_names = {user : users[user]['display_name'] for user in users}
-    unique_words = Counter()
-    translator = str.maketrans('', '', punc)
 
-    msgs = [msg for msg in msgs if msg]
-    for msg in msgs:
-        msg = msg.lower()
-
-        tokenized = {w.translate(translator) for w in msg.split(
-            ' ') if w.lower() not in stop_words}
-        for token in tokenized:
-            key = translate_token(token, disp_names, channels)
-            unique_words[key] += 1
-
-    return unique_words
+def translated_totals(words, disp_names, channels):
+    '''
+    {word: total} of (token, total) rows with the tokens translated, largest
+    first. A mention and the name it resolves to become the same word, so
+    their totals are added up.
+    '''
+    totals = Counter()
+    for word, total in words:
+        totals[translate_token(word, disp_names, channels)] += total
+    return dict(totals.most_common())
 
 
-@get_top
-def react_buzzword(react_name, users, channels):
+@ANALYTICS_SECONDS.timed()
+@results.cached('buzzwords', fingerprint=('users', 'channels'))
+def react_buzzword(team_id, react_name, users, channels, count=5, window=None):
     ''' 
-	Finds the words most used in messages with the given react
+	Finds the words most used in messages with the given react, counted over
+	the MessageWords index db builds at ingest
 
 	Args: 
+		team_id    (str)  : Slack team ID
 		react_name (str)  : Slack react name
 		users      (list) : List of "escaped" Slack users
 	    channels   (list) : List of "escaped" Slack channels
 	    count 	   (int)  : Number of results
+	    window     (timedelta) : Only count reacts left this recently
 
 	Returns: 
-		Counter: The most common words used in messages with the given react
+		dict: The most common words used in messages with the given react
     '''
 
-    msgs = db.execute(MESSAGES_WITH_REACT, (react_name,))
-    msgs = [msg[0] for msg in msgs]
-    return unique_words(msgs, users, channels)
+    disp_names = display_names(users)
+    words = approximate('react_words', team_id, react_name, count, window=window)
+    if words is None:
+        words = run_query(REACT_WORDS, count, team=team_id, react=react_name, since=window_start(window))
+    return translated_totals(words, disp_names, channels)
+
 
+def react_words_query(team_id, react_names, count, since):
+    '''
+    The one statement that counts the words of every react in react_names.
+    A GROUP BY over all of them is twice as fast as one per react on
+    Postgres, which hashes the groups, and half as fast on SQLite, which
+    sorts them.
 
-def most_reacted_to_posts():
+    Returns:
+        tuple: (sql, args) for rows of (react name, word, count)
+    '''
+    if not db.backend.hash_aggregate:
+        parts = [compile_query(REACT_WORDS, count, team=team_id, react=name, since=since) for name in react_names]
+        sql = ' UNION ALL '.join(REACT_WORDS_PART.format(part) for part, _ in parts)
+        return sql, tuple(arg for name, (_, args) in zip(react_names, parts) for arg in (name,) + args)
+    sql = REACT_WORDS_BY_REACT.format(
+        names=', '.join(['%s'] * len(react_names)),
+        since=' AND ' + db.backend.range_condition('Reacts.CreatedAt >= %s') if since else '',
+        limit='' if count is None else '\n    WHERE WordRank <= %s')
+    args = (team_id,) + tuple(react_names) + ((since,) if since else ()) + (() if count is None else (count,))
+    return sql, args
+
+
+@ANALYTICS_SECONDS.timed()
+@results.cached('buzzwords_by_react', fingerprint=('users', 'channels'))
+def react_buzzwords(team_id, react_names, users, channels, count=5, window=None):
+    '''
+    react_buzzword for several reacts with one query, so the time taken
+    grows with the messages the reacts are on rather than with the number
+    of reacts asked for
+
+	Args:
+		team_id     (str)   : Slack team ID
+		react_names (tuple) : Slack react names
+		users       (list)  : List of "escaped" Slack users
+	    channels    (list)  : List of "escaped" Slack channels
+	    count 	    (int)   : Number of results per react
+	    window      (timedelta) : Only count reacts left this recently
+
+	Returns:
+		dict: react name -> the most common words used in messages with it,
+		      empty for reacts that weren't used
+    '''
+    disp_names = display_names(users)
+    buzzwords = {name: {} for name in react_names}
+    if not react_names:
+        return buzzwords
+    by_react = {name: approximate('react_words', team_id, name, count, window=window) for name in react_names}
+    if None in by_react.values():
+        by_react = {name: [] for name in react_names}
+        for name, word, total in db.execute(*react_words_query(team_id, react_names, count,
+                                                                window_start(window))):
+            by_react[name].append((word, total))
+    for name, words in by_react.items():
+        buzzwords[name] = translated_totals(words, disp_names, channels)
+    return buzzwords
+
+
+@ANALYTICS_SECONDS.timed()
+@results.cached('most_reacted_to')
+@served_by_engine
+def most_reacted_to_posts(team_id, user=None, channel=None, count=5, window=None):
     ''' 
     Gets the messages with the most total reactions
 
-    If a user is given, the search is limited to just messages posted
-    by that user. Else, the every message is considered.
+    If a user or channel is given, the search is limited to just messages posted
+    by that user or in that channel. Else, the every message is considered.
+    With a window, only messages posted in it are considered.
 
 	Args: 
-        user_id (str) : Slack user ID
-        count (list)  : Number of results
+        team_id (str) : Slack team ID
+        user    (str) : Slack user ID
+        channel (str) : Slack channel ID
+        count   (int) : Number of results
+        window  (timedelta) : Length of the window
 
 	Returns: 
     	Counter: messages with the most reactions
 	'''
 
-    msgs = db.execute(MOST_REACTED_TO)
-    return msgs[:5]
-
-@get_top
-def get_common_phrases():
-    phrase_counter = Counter()
-    texts = db.execute(ALL_MESSAGE_TEXTS)
-    texts = [t[0] for t in texts]
-    phrases = []
-
-    for text in texts:
-        for phrase in ngrams(text.split(' '), 3):
-            if phrase in omit_phrases:
-                continue
-            if any(word in punc for word in phrase):
-                continue
-
-            phrase_counter[phrase] += 1
-    return phrase_counter
-
-def most_unique_reacts_on_a_post():
-    tbl = db.execute(ALL_REACTS)
-    
-    reacts = defaultdict(set)
-    for r in tbl:
-        msg_id = r[0]
-        txt = r[1]
-        key = (msg_id, txt)
-
-        react = r[2]
-        # { (MessageID, Text) : [Reacts...] }
-        reacts[key].add(react)
-
-    # Store in a list of tuple of (MessageText, [Reacts...])
-    tbl = [(key[1], reacts[key]) for key in reacts if key[1]]
-    tbl = sorted(tbl, reverse=True, key=lambda r: len(r[1]))
-
-    return tbl[:5]
+    return run_query(MOST_REACTED_TO, count, team=team_id, user=user, channel=channel,
+                     since=window_start(window))
 
+@ANALYTICS_SECONDS.timed()
+@results.cached('common_phrases')
+def get_common_phrases(team_id, count=5, window=None):
+    '''
+    Reads the most common phrases from the PhraseCounts index that db keeps
+    up to date as messages are added and removed. Phrases in a window are
+    counted from the window's messages.
+    '''
+    phrases = approximate('common_phrases', team_id, count, window=window)
+    if phrases is not None:
+        return {tuple(phrase.split(' ')): total for phrase, total in phrases}
+    if window is not None:
+        sql, args = compile_query(MESSAGE_TEXTS, None, team=team_id, since=window_start(window))
+        phrases = Counter(p for (text,) in db.stream(sql, args) for p in nlp.phrases(text))
+        return {tuple(phrase.split(' ')): total for phrase, total in phrases.most_common(count)}
+    return {tuple(phrase.split(' ')): total for phrase, total in run_query(PHRASE_TOTALS, count, team=team_id)}
+
+@ANALYTICS_SECONDS.timed()
+@results.cached('most_unique')
+@served_by_engine
+def most_unique_reacts_on_a_post(team_id, user=None, channel=None, count=5, window=None):
+    ranked = approximate('most_unique_messages', team_id, user=user, channel=channel, window=window)
+    if ranked is not None:
+        tbl = with_text(ranked, count)
+    else:
+        tbl = run_query(MOST_UNIQUE_REACTS, count, team=team_id, user=user, channel=channel,
+                        since=window_start(window))
+    if not tbl:
+        return []
+    reacts = defaultdict(set)
+    for msg_id, name in db.execute(REACT_NAMES_ON.format(', '.join(['%s'] * len(tbl))),
+                                   tuple(msg_id for msg_id, _ in tbl)):
+        reacts[msg_id].add(name)
+    # Store in a list of tuple of (MessageText, {Reacts...})
+    return [(txt, reacts[msg_id]) for msg_id, txt in tbl]
 
-def most_active():
-    tbl = db.execute(ACTIVITY_TOTALS)
-    return tbl[:5]
 
-@get_top
+def with_text(msg_ids, count):
+    '''
+    (MessageID, Text) of the first count of msg_ids with text, skipping the
+    messages MOST_UNIQUE_REACTS leaves out. Texts are read a page at a time.
+    '''
+    msg_ids = iter(msg_ids)
+    tbl = []
+    while count is None or len(tbl) < count:
+        page = list(islice(msg_ids, max(2 * (count or 0), 100)))
+        if not page:
+            break
+        texts = dict(db.execute(MESSAGE_TEXTS_ON.format(', '.join(['%s'] * len(page))), tuple(page)))
+        tbl.extend((msg_id, texts[msg_id]) for msg_id in page if texts.get(msg_id))
+    return tbl[:count]
+
+
+@ANALYTICS_SECONDS.timed()
+@results.cached('most_active')
+@served_by_engine
+def most_active(team_id, count=5, window=None):
+    if window is not None:
+        # Activity is messages plus reacts, as in the UserActivity rollup
+        since = window_start(window)
+        activity = Counter(dict(run_query(MESSAGES_BY_USER, None, team=team_id, since=since)))
+        activity.update(dict(run_query(REACTS_BY_REACTOR, None, team=team_id, since=since)))
+        return activity.most_common(count)
+    return run_query(ACTIVITY_TOTALS, count, team=team_id)
+
+@ANALYTICS_SECONDS.timed()
+@results.cached('most_reacts')
+@served_by_engine
 @to_dict
-def users_with_most_reacts():
-    tbl = db.execute(REACT_TOTALS)
+def users_with_most_reacts(team_id, count=5, window=None):
+    if window is not None:
+        return run_query(REACTS_BY_REACTOR, count, team=team_id, since=window_start(window))
+    tbl = run_query(REACT_TOTALS, count, team=team_id)
     return tbl
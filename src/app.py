@@ -1,13 +1,28 @@
 from flask import Flask, request, make_response, render_template, abort
 from bot import VALID_COMMANDS, EVENT_TYPE_SLASH_COMMAND, EVENT_TYPE_API_EVENT, Bot
 import log
+import db
+import metrics
 from celery import Celery
+from collections import deque
+from functools import wraps
 import os
+import time
 
 app = Flask(__name__)
 app.config['CELERY_BROKER_URL'] = os.getenv('REDIS_URL', 'redis://localhost:6379')
 app.config['CELERY_RESULT_BACKEND'] = os.getenv('REDIS_URL', 'redis://localhost:6379')
 
+# With ASYNC_ACK set, /listening and /react_analytics verify the token, queue
+# the event and return straight away instead of running the task in the
+# request. Slash command results are posted back to the command's response_url.
+ASYNC_ACK = os.environ.get('ASYNC_ACK', '').lower() in ('1', 'true', 'yes')
+# Number of recent ack latencies kept for ack_stats
+ACK_SAMPLES = int(os.environ.get('ACK_SAMPLES', 10000))
+
+ack_latencies = deque(maxlen=ACK_SAMPLES)
+ACK_SECONDS = metrics.histogram('ack_seconds', 'Time to respond to Slack, by endpoint', ('endpoint',))
+
 def make_celery(app):
     celery = Celery(app.import_name, broker=app.config['CELERY_BROKER_URL'], backend=app.config['CELERY_RESULT_BACKEND'])
     celery.conf.update(app.config)
@@ -20,6 +35,7 @@ def make_celery(app):
     celery.Task = ContextTask
     return celery
 
+db.init_db()
 pyBot = Bot()
 celery = make_celery(app)
 
@@ -29,6 +45,53 @@ def queue_bot_event(token, event_type, event):
     return pyBot.on_event(token, event_type, event)
 
 
+def enqueue_event(token, event_type, event):
+    '''
+    Verifies token and hands the event off without waiting for it to be
+    handled. Returns False for an invalid token.
+    '''
+    if pyBot.event_log:
+        return pyBot.on_event(token, event_type, event)
+    if not pyBot.verify_token(token):
+        return False
+    # Duplicates are dropped by on_event in the worker
+    queue_bot_event.delay(token, event_type, event)
+    return True
+
+
+def measure_ack(func):
+    '''
+    Records how long the endpoint takes to respond to Slack in ack_latencies
+    and the ack_seconds histogram
+    '''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            ack_latencies.append(elapsed * 1000)
+            ACK_SECONDS.observe(elapsed, func.__name__)
+    return wrapper
+
+
+def ack_stats():
+    '''
+    Percentiles in milliseconds of the last ACK_SAMPLES ack latencies
+    '''
+    samples = sorted(ack_latencies)
+    if not samples:
+        return {'count': 0}
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(p / 100.0 * len(samples)))]
+    return {'count': len(samples),
+            'p50_ms': percentile(50),
+            'p95_ms': percentile(95),
+            'p99_ms': percentile(99),
+            'max_ms': samples[-1]}
+
+
 @app.route("/install", methods=['GET'])
 def pre_install():
     client_id = bot.Bot.oauth['client_id']
@@ -44,6 +107,7 @@ def thanks():
 
 
 @app.route('/listening', methods=['GET', 'POST'])
+@measure_ack
 def hears():
     slack_event = request.get_json()
 
@@ -53,9 +117,12 @@ def hears():
         })
 
     if 'event' in slack_event:
-        task = queue_bot_event.apply(args=(slack_event.get('token'), EVENT_TYPE_API_EVENT, slack_event))
-        task.wait()
-        if not task:
+        if ASYNC_ACK:
+            accepted = enqueue_event(slack_event.get('token'), EVENT_TYPE_API_EVENT, slack_event)
+        else:
+            task = queue_bot_event.apply(args=(slack_event.get('token'), EVENT_TYPE_API_EVENT, slack_event))
+            accepted = task.wait()
+        if not accepted:
             message = "Invalid Slack verification token"
             # By adding "X-Slack-No-Retry" : 1 to our response headers, we turn off
             # Slack's automatic retries during development.
@@ -64,20 +131,29 @@ def hears():
     return make_response('Non-reaction event', 200)
 
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return make_response(metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE})
+
+
 def get_help_response():
     formatted_resp = ''.join(['%s %s\n' % (cmd, arg_list) for cmd, arg_list in VALID_COMMANDS.items()])
     return formatted_resp
 
 @app.route('/react_analytics', methods=['GET', 'POST'])
+@measure_ack
 def on_slash_command():
     print('slash_command received')
     slash_command = parse_slash_command(request)
     text = slash_command['text']
     response_text = get_help_response()
     if text.split(' ')[0] in VALID_COMMANDS:
-        task = queue_bot_event.apply(args=(slash_command['token'], EVENT_TYPE_SLASH_COMMAND, slash_command))
-        task.wait()
-        if not task:
+        if ASYNC_ACK:
+            accepted = enqueue_event(slash_command['token'], EVENT_TYPE_SLASH_COMMAND, slash_command)
+        else:
+            task = queue_bot_event.apply(args=(slash_command['token'], EVENT_TYPE_SLASH_COMMAND, slash_command))
+            accepted = task.wait()
+        if not accepted:
             response_text = 'Invalid token'
         else:
             response_text = ''
@@ -89,7 +165,10 @@ def parse_slash_command(request):
     result = {'token': request.form.get('token', None),
               'command': request.form.get('command', None),
               'text': request.form.get('text', None),
-              'user_id': request.form.get('user_id')}
+              'user_id': request.form.get('user_id'),
+              'team_id': request.form.get('team_id'),
+              'channel_id': request.form.get('channel_id'),
+              'response_url': request.form.get('response_url')}
 
     if not result['token']:
         abort(400)
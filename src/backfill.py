@@ -0,0 +1,250 @@
+'''
+Loads the history the bot missed, before it was installed or while it was
+down. Run from src/ with ACCESS_TOKEN set:
+
+    python backfill.py                          # every channel the token can read
+    python backfill.py --channels C123,C456
+    python backfill.py --reset                  # forget the checkpoints and start over
+
+Channels are crawled newest first with conversations.history, and threads
+with conversations.replies, BACKFILL_CONCURRENCY channels at a time. The
+calls go through SlackAPI, so every thread shares its rate limits. Each batch
+of messages and reacts is written with db.bulk_load together with the
+channel's checkpoint, so an interrupted backfill carries on from the last
+batch written. Running it again on a finished channel only loads the
+messages newer than the last run. Replies posted since then to older
+threads aren't picked up, the bot sees those as events.
+
+SLACK_API_URL (or --api-url) points it at a fake Slack server for testing.
+'''
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import db
+import log
+import metrics
+from slack_api import SlackAPI
+from util import Message, React
+
+# Channels crawled at once. Slack allows about 50 conversations.history
+# calls a minute, so more than a few only queue up behind the rate limit.
+BACKFILL_CONCURRENCY = int(os.environ.get('BACKFILL_CONCURRENCY', 4))
+# Messages written per bulk_load, replies included
+BACKFILL_BATCH_SIZE = int(os.environ.get('BACKFILL_BATCH_SIZE', 5000))
+# Messages asked for per page, Slack's maximum is 999
+BACKFILL_PAGE_SIZE = int(os.environ.get('BACKFILL_PAGE_SIZE', 999))
+# Seconds between progress lines
+BACKFILL_REPORT_INTERVAL = float(os.environ.get('BACKFILL_REPORT_INTERVAL', 10))
+CHANNEL_TYPES = 'public_channel,private_channel'
+
+CHECKPOINTS = 'SELECT ChannelID, OldestTS, NewestTS, Done FROM BackfillCheckpoints WHERE TeamID = %s'
+RESET_CHECKPOINTS = 'DELETE FROM BackfillCheckpoints WHERE TeamID = %s'
+
+ROWS_LOADED = metrics.counter('backfill_rows_total', 'Rows read from Slack history by backfill, by kind',
+                              ('kind',))
+
+
+def pages(client, method, key, **kwargs):
+    '''
+    Yields the key list of each page of a cursor paginated method
+
+    Raises:
+        RuntimeError: when a call fails
+    '''
+    cursor = None
+    while True:
+        if cursor:
+            kwargs['cursor'] = cursor
+        response = client.api_call(method, **kwargs)
+        if not response.get('ok'):
+            raise RuntimeError('%s failed: %s' % (method, response.get('error')))
+        yield response.get(key, [])
+        cursor = response.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return
+
+
+def records(team_id, channel_id, message):
+    '''
+    Returns (Message or None, [Reacts]) for a message from history. Like
+    live events, messages without a user (bot posts and most subtypes) are
+    skipped.
+    '''
+    if 'user' not in message:
+        return None, []
+    ts = message['ts']
+    msg = Message(team_id, channel_id, ts, message['user'], message.get('text', ''))
+    reacts = [React(team_id, channel_id, ts, user, reaction['name'])
+              for reaction in message.get('reactions', ()) for user in reaction.get('users', ())]
+    return msg, reacts
+
+
+class Backfill(object):
+    '''
+    Args:
+        client      (SlackAPI) : client with a token that can read the channels
+        team_id     (str)      : TeamID written on every row
+        channels    (list)     : channel IDs, default every channel listed by
+                                 conversations.list
+        concurrency (int)      : channels crawled at once
+        batch_size  (int)      : messages written per bulk_load
+        replies     (bool)     : whether to crawl threads
+    '''
+    def __init__(self, client, team_id, channels=None, concurrency=BACKFILL_CONCURRENCY,
+                 batch_size=BACKFILL_BATCH_SIZE, replies=True):
+        self.client = client
+        self.team_id = team_id
+        self.channels = channels
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.replies = replies
+        self._lock = threading.Lock()
+        self._stats = {'channels': 0, 'channels_done': 0, 'channels_failed': 0,
+                       'messages': 0, 'reacts': 0, 'batches': 0}
+        self._started = None
+
+    def list_channels(self):
+        channels = []
+        for page in pages(self.client, 'conversations.list', 'channels', types=CHANNEL_TYPES,
+                          exclude_archived='false', limit=1000):
+            channels.extend(channel['id'] for channel in page)
+        return channels
+
+    def checkpoints(self):
+        return {channel: (oldest, newest, bool(done))
+                for channel, oldest, newest, done in db.execute(CHECKPOINTS, (self.team_id,))}
+
+    def run(self):
+        '''
+        Crawls every channel. Returns stats(); failed channels are logged and
+        can be retried by running again.
+        '''
+        channels = self.channels or self.list_channels()
+        checkpoints = self.checkpoints()
+        self._stats['channels'] = len(channels)
+        self._started = time.perf_counter()
+        done = threading.Event()
+        reporter = threading.Thread(target=self._report_loop, args=(done,), daemon=True)
+        reporter.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                for channel in channels:
+                    pool.submit(self._run_channel, channel, checkpoints.get(channel))
+        finally:
+            done.set()
+            reporter.join()
+        self.report()
+        return self.stats()
+
+    def _run_channel(self, channel_id, checkpoint):
+        try:
+            self.channel(channel_id, checkpoint)
+            self._count('channels_done', 1)
+        except Exception as e:
+            self._count('channels_failed', 1)
+            log.log_error('Backfill of %s failed: %s' % (channel_id, e))
+
+    def channel(self, channel_id, checkpoint=None):
+        '''
+        Loads one channel's history, picking up from checkpoint, its
+        (OldestTS, NewestTS, Done) row
+        '''
+        oldest, newest, done = checkpoint or (None, None, False)
+        if done:
+            # Only what was posted since the last run. The checkpoint only
+            # moves once the gap is filled, so an interruption redoes it.
+            query, top = ({'oldest': newest} if newest else {}), newest
+        else:
+            # Carries on below what is loaded, or starts from the latest message
+            query, top = ({'latest': oldest} if oldest else {}), newest
+
+        msgs, reacts = [], []
+        for page in pages(self.client, 'conversations.history', 'messages', channel=channel_id,
+                          limit=BACKFILL_PAGE_SIZE, **query):
+            for message in page:
+                ts = message['ts']
+                if not done:
+                    oldest = ts if oldest is None or float(ts) < float(oldest) else oldest
+                top = ts if top is None or float(ts) > float(top) else top
+                self._add(channel_id, message, msgs, reacts)
+                if self.replies and message.get('reply_count'):
+                    for thread_page in pages(self.client, 'conversations.replies', 'messages',
+                                             channel=channel_id, ts=ts, limit=BACKFILL_PAGE_SIZE):
+                        for reply in thread_page:
+                            # The first entry of every page is the parent
+                            if reply['ts'] != ts:
+                                self._add(channel_id, reply, msgs, reacts)
+            if len(msgs) >= self.batch_size:
+                # Mid catch up the old checkpoint still stands
+                self._write(msgs, reacts, (self.team_id, channel_id, oldest,
+                                           newest if done else top, done))
+                msgs, reacts = [], []
+        self._write(msgs, reacts, (self.team_id, channel_id, oldest, top, True))
+
+    def _add(self, channel_id, message, msgs, reacts):
+        msg, msg_reacts = records(self.team_id, channel_id, message)
+        if msg:
+            msgs.append(msg)
+            reacts.extend(msg_reacts)
+
+    def _write(self, msgs, reacts, checkpoint):
+        db.bulk_load(msgs, reacts, checkpoint)
+        ROWS_LOADED.inc('message', amount=len(msgs))
+        ROWS_LOADED.inc('react', amount=len(reacts))
+        with self._lock:
+            self._stats['messages'] += len(msgs)
+            self._stats['reacts'] += len(reacts)
+            self._stats['batches'] += 1
+
+    def _count(self, key, amount):
+        with self._lock:
+            self._stats[key] += amount
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['seconds'] = time.perf_counter() - self._started if self._started else 0.0
+        stats['messages_per_sec'] = stats['messages'] / stats['seconds'] if stats['seconds'] else 0.0
+        stats['reacts_per_sec'] = stats['reacts'] / stats['seconds'] if stats['seconds'] else 0.0
+        return stats
+
+    def report(self):
+        stats = self.stats()
+        print('%d/%d channels (%d failed), %d messages, %d reacts in %.1fs: %.0f messages/s, %.0f reacts/s'
+              % (stats['channels_done'], stats['channels'], stats['channels_failed'], stats['messages'],
+                 stats['reacts'], stats['seconds'], stats['messages_per_sec'], stats['reacts_per_sec']))
+
+    def _report_loop(self, done):
+        while not done.wait(BACKFILL_REPORT_INTERVAL):
+            self.report()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channels', help='comma separated channel IDs, default every channel')
+    parser.add_argument('--team', help='TeamID to write, default the token\'s team from auth.test')
+    parser.add_argument('--concurrency', type=int, default=BACKFILL_CONCURRENCY)
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE)
+    parser.add_argument('--no-replies', action='store_true', help='skip threads')
+    parser.add_argument('--reset', action='store_true', help='forget the checkpoints and crawl everything again')
+    parser.add_argument('--database', help='database URL to use instead of DATABASE_URL')
+    parser.add_argument('--api-url', help='Slack API URL to use instead of SLACK_API_URL')
+    args = parser.parse_args()
+
+    if args.database:
+        db.use(args.database)
+    client = SlackAPI(os.environ.get('ACCESS_TOKEN'), **({'api_url': args.api_url} if args.api_url else {}))
+    team_id = args.team
+    if team_id is None:
+        response = client.api_call('auth.test')
+        if not response.get('ok'):
+            raise SystemExit('auth.test failed: %s' % response.get('error'))
+        team_id = response.get('team_id', '')
+    if args.reset:
+        db.execute(RESET_CHECKPOINTS, (team_id,))
+    backfill = Backfill(client, team_id, args.channels.split(',') if args.channels else None,
+                        concurrency=args.concurrency, batch_size=args.batch_size,
+                        replies=not args.no_replies)
+    backfill.run()
@@ -0,0 +1,714 @@
+'''
+Benchmarks for the hot paths. Run from src/:
+
+    python bench.py tokenizer [--messages N] [--repeat N]
+    python bench.py ack [--requests N] [--concurrency N]
+    python bench.py events [--messages N]
+    python bench.py sketch [--messages N] [--widths 1024,4096] [--precisions 4,8]
+    python bench.py analytics|engine|unique_words|ingest|all [--messages N] [--iterations N]
+
+analytics and ingest write a synthetic workspace (see workspace_gen) to the
+database at DATABASE_URL, or at --database, under its own team, and delete it
+afterwards unless --keep is given. A kept workspace is reused by the next run
+with the same --messages and --seed.
+
+--json FILE writes the results, and --compare FILE compares them with an
+earlier --json run, exiting with status 1 if anything is more than
+--threshold slower. Comparing runs against two backends shows them side by
+side, e.g.
+
+    python bench.py all --database sqlite:///bench.db --json sqlite.json
+    python bench.py all --compare sqlite.json
+'''
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+import nlp
+import analytics
+import util
+from workspace_gen import Workspace
+
+
+def reference_unique_words(msgs, users, channels):
+    '''
+    unique_words as it was before the batch tokenizer, kept to check the
+    output and measure the speedup against. It lowercased and stripped
+    mentions before looking them up, so they were never resolved.
+    '''
+    disp_names = {user : users[user]['display_name'] for user in users}
+    unique_words = Counter()
+    translator = str.maketrans('', '', nlp.punc)
+
+    msgs = [msg for msg in msgs if msg]
+    for msg in msgs:
+        msg = msg.lower()
+
+        tokenized = {w.translate(translator) for w in msg.split(
+            ' ') if w.lower() not in nlp.stop_words}
+        for token in tokenized:
+            key = reference_translate_token(token, disp_names, channels)
+            unique_words[key] += 1
+
+    return unique_words
+
+
+def reference_translate_token(token, users, channels):
+    find = re.search('(?<=<#)(.*?)(?=>)', token)
+    if find:
+        return channels.get(find.group(0), token)
+    find = re.search('(?<=<@)(.*?)(?=>)', token)
+    if find:
+        return users.get(find.group(0), token)
+    return token
+
+
+class ReferenceReact(object):
+    '''
+    util.React as it was before __slots__ and interning, kept to measure the
+    memory saved against
+    '''
+    def __init__(self, team_id, channel_id, time_stamp, user_id, name, created_at=None):
+        self.team_id = team_id
+        self.channel_id = channel_id
+        self.msg_id = channel_id + time_stamp
+        self.user_id = user_id
+        self.name = name
+        self.created_at = created_at or util.ts_to_datetime(time_stamp)
+
+
+def synthetic_messages(count, seed=0):
+    rng = random.Random(seed)
+    vocab = ['word%d' % i for i in range(5000)] + sorted(nlp.stop_words)
+    # Roughly Zipf distributed word frequencies
+    weights = [1.0 / (rank + 1) for rank in range(len(vocab))]
+    extras = ['<@U%d>' % i for i in range(50)] + ['<#C%d>' % i for i in range(10)] + ['!', '...', '"quoted"']
+    msgs = []
+    for _ in range(count):
+        words = rng.choices(vocab, weights, k=rng.randint(1, 40))
+        if rng.random() < 0.3:
+            words.append(rng.choice(extras))
+        if rng.random() < 0.3:
+            words = [w.capitalize() + ',' if rng.random() < 0.1 else w for w in words]
+        msgs.append(' '.join(words))
+    return msgs
+
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def percentiles(samples, elapsed=None):
+    '''
+    Summarises latency samples in seconds. per_sec is operations per second of
+    elapsed, or of the summed samples when elapsed isn't given.
+    '''
+    samples = sorted(samples)
+    total = elapsed if elapsed is not None else sum(samples)
+    def at(p):
+        return samples[min(len(samples) - 1, int(p / 100.0 * len(samples)))] * 1000
+    return {'count': len(samples),
+            'mean_ms': sum(samples) / len(samples) * 1000,
+            'p50_ms': at(50),
+            'p95_ms': at(95),
+            'p99_ms': at(99),
+            'max_ms': samples[-1] * 1000,
+            'per_sec': len(samples) / total if total else 0.0}
+
+
+def sample(func, iterations):
+    '''
+    Calls func iterations times and returns the latency of each call
+    '''
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        func(i)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def throughput(count, seconds):
+    return {'count': count, 'seconds': seconds, 'per_sec': count / seconds if seconds else 0.0}
+
+
+def print_results(results):
+    print('%-44s %8s %9s %9s %9s %11s' % ('', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'per sec'))
+    for name, r in results.items():
+        if 'p50_ms' in r:
+            print('%-44s %8d %9.2f %9.2f %9.2f %11.1f'
+                  % (name, r['count'], r['p50_ms'], r['p95_ms'], r['p99_ms'], r['per_sec']))
+        else:
+            print('%-44s %8d %9s %9s %9s %11.1f' % (name, r['count'], '', '', '', r['per_sec']))
+
+
+def bench_tokenizer(args):
+    msgs = synthetic_messages(args.messages or 100000)
+    users = {'U%d' % i: {'display_name': 'user%d' % i} for i in range(50)}
+    channels = {'C%d' % i: 'channel%d' % i for i in range(10)}
+
+    _, reference_time = timed(lambda: reference_unique_words(msgs, users, channels), args.repeat)
+    # A fresh tokenizer per run so the word cache starts cold
+    result, batch_time = timed(lambda: nlp.Tokenizer().count(msgs, analytics.display_names(users), channels),
+                               args.repeat)
+    warm, warm_time = timed(lambda: analytics.unique_words(msgs, users, channels), args.repeat)
+
+    # Mentions are resolved now where the reference stripped them, the rest
+    # has to match exactly
+    plain = [msg for msg in msgs if '<' not in msg]
+    assert nlp.Tokenizer().count(plain, analytics.display_names(users), channels) == \
+        reference_unique_words(plain, users, channels), 'batch tokenizer output differs from reference'
+    assert warm == result, 'cached tokens differ from uncached ones'
+    print('messages:          %d' % len(msgs))
+    print('reference:         %.3fs' % reference_time)
+    print('batch (cold cache): %.3fs  %.1fx' % (batch_time, reference_time / batch_time))
+    print('batch (warm cache): %.3fs  %.1fx' % (warm_time, reference_time / warm_time))
+    return {'tokenizer.reference': {'seconds': reference_time},
+            'tokenizer.cold': {'seconds': batch_time, 'speedup': reference_time / batch_time},
+            'tokenizer.warm': {'seconds': warm_time, 'speedup': reference_time / warm_time}}
+
+
+def bench_ack(args):
+    '''
+    Drives /listening and /react_analytics with concurrent clients in
+    ASYNC_ACK mode and reports the ack latency the app recorded. Events are
+    queued with whatever EVENT_CONSUMER and broker the environment points at.
+    '''
+    os.environ['ASYNC_ACK'] = '1'
+    os.environ.setdefault('VERIFICATION_TOKEN', 'bench-token')
+    import app
+
+    token = os.environ['VERIFICATION_TOKEN']
+    event = {'token': token,
+             'event': {'type': 'reaction_added', 'user': 'U1', 'reaction': 'thumbsup',
+                       'item': {'type': 'message', 'channel': 'C1', 'ts': '1500000000.000100'}}}
+    command = {'token': token, 'command': '/react_analytics', 'text': 'most_used',
+               'user_id': 'U1', 'team_id': 'T1', 'channel_id': 'C1',
+               'response_url': 'http://localhost/unused'}
+    per_client = args.requests // args.concurrency
+
+    def client():
+        test_client = app.app.test_client()
+        for i in range(per_client):
+            if i % 2:
+                test_client.post('/react_analytics', data=command)
+            else:
+                test_client.post('/listening', json=event)
+
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    stats = app.ack_stats()
+    print('requests:    %d over %d clients' % (stats['count'], args.concurrency))
+    print('throughput:  %.0f req/s' % (stats['count'] / elapsed))
+    for key in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms'):
+        print('%-12s %.2f' % (key + ':', stats[key]))
+    stats['per_sec'] = stats['count'] / elapsed
+    return {'ack': stats}
+
+
+def workspace(args, team_id):
+    return Workspace(team_id=team_id, users=args.users, messages=args.messages or 20000, seed=args.seed)
+
+
+def delete_team(team_id):
+    import db
+    msg_ids = [row[0] for row in db.execute('SELECT MessageID FROM Messages WHERE TeamID = %s', (team_id,))]
+    if msg_ids:
+        db.write_batch(msg_ids, [], [], [])
+
+
+def load_workspace(ws, batch_size):
+    '''
+    Writes ws with db.write_batch, skipped when a kept workspace of the same
+    size is already there
+    '''
+    import db
+    count = db.execute('SELECT COUNT(*) FROM Messages WHERE TeamID = %s', (ws.team_id,))[0][0]
+    if count == ws.message_count:
+        return
+    delete_team(ws.team_id)
+    msgs, reacts = [], []
+    for msg, msg_reacts in ws.generate():
+        msgs.append(msg)
+        reacts.extend(msg_reacts)
+        if len(msgs) >= batch_size:
+            db.write_batch([], msgs, [], reacts)
+            msgs, reacts = [], []
+    db.write_batch([], msgs, [], reacts)
+    db.execute('ANALYZE')
+
+
+def bench_analytics(args):
+    '''
+    Latency of every analytics command against a loaded workspace, with the
+    result cache bypassed
+    '''
+    ws = workspace(args, 'TBENCH%d' % args.seed)
+    print('loading %d messages' % ws.message_count)
+    load_workspace(ws, args.batch_size)
+    users, channels = ws.directory()
+    team = ws.team_id
+    week = timedelta(days=7)
+    rng = random.Random(args.seed)
+    # Mostly the busy users and channels, as in real use
+    pick_user = lambda i: ws.users[min(int(rng.paretovariate(1)) - 1, len(ws.users) - 1)]
+    pick_channel = lambda i: ws.channels[min(int(rng.paretovariate(1)) - 1, len(ws.channels) - 1)]
+    pick_react = lambda i: ws.react_names[min(int(rng.paretovariate(1)) - 1, len(ws.react_names) - 1)]
+
+    def uncached(func):
+        # Under the timing decorator, so __wrapped__ would be the cache
+        return func.uncached
+
+    cases = {
+        'most_used_reacts': lambda i: uncached(analytics.most_used_reacts)(team),
+        'most_used_reacts.user': lambda i: uncached(analytics.most_used_reacts)(team, user=pick_user(i)),
+        'most_used_reacts.channel': lambda i: uncached(analytics.most_used_reacts)(team, channel=pick_channel(i)),
+        'most_used_reacts.7d': lambda i: uncached(analytics.most_used_reacts)(team, window=week),
+        'most_reacted_to_posts': lambda i: uncached(analytics.most_reacted_to_posts)(team),
+        'most_reacted_to_posts.channel': lambda i: uncached(analytics.most_reacted_to_posts)(team, channel=pick_channel(i)),
+        'most_reacted_to_posts.7d': lambda i: uncached(analytics.most_reacted_to_posts)(team, window=week),
+        'most_unique_reacts_on_a_post': lambda i: uncached(analytics.most_unique_reacts_on_a_post)(team),
+        'most_unique_reacts_on_a_post.user': lambda i: uncached(analytics.most_unique_reacts_on_a_post)(team, user=pick_user(i)),
+        'react_buzzword': lambda i: uncached(analytics.react_buzzword)(team, pick_react(i), users, channels),
+        'react_buzzword.7d': lambda i: uncached(analytics.react_buzzword)(team, pick_react(i), users, channels, window=week),
+        'react_buzzwords': lambda i: uncached(analytics.react_buzzwords)(team, tuple(ws.react_names[:5]), users, channels),
+        'react_buzzwords.7d': lambda i: uncached(analytics.react_buzzwords)(team, tuple(ws.react_names[:5]), users, channels,
+                                                                             window=week),
+        'get_common_phrases': lambda i: uncached(analytics.get_common_phrases)(team),
+        'get_common_phrases.7d': lambda i: uncached(analytics.get_common_phrases)(team, window=week),
+        'most_active': lambda i: uncached(analytics.most_active)(team),
+        'most_active.7d': lambda i: uncached(analytics.most_active)(team, window=week),
+        'users_with_most_reacts': lambda i: uncached(analytics.users_with_most_reacts)(team),
+        'users_with_most_reacts.7d': lambda i: uncached(analytics.users_with_most_reacts)(team, window=week),
+    }
+    results = {}
+    for name, case in cases.items():
+        case(0)
+        results['analytics.' + name] = percentiles(sample(case, args.iterations))
+    print_results(results)
+    if not args.keep:
+        delete_team(team)
+    return results
+
+
+def bench_engine(args):
+    '''
+    Load time, memory and command latency of the in-memory engine against the
+    same workspace as bench_analytics, with memory compared to holding the
+    rows as lists of tuples
+    '''
+    import tracemalloc
+    import db
+    import engine
+    ws = workspace(args, 'TBENCH%d' % args.seed)
+    print('loading %d messages' % ws.message_count)
+    load_workspace(ws, args.batch_size)
+    team = ws.team_id
+    week = timedelta(days=7)
+
+    tracemalloc.start()
+    rows = db.execute(engine.MESSAGE_SNAPSHOT) + db.execute(engine.REACT_SNAPSHOT)
+    row_bytes = tracemalloc.get_traced_memory()[0]
+    del rows
+    tracemalloc.stop()
+
+    # Timed and measured separately, tracemalloc slows allocation down
+    tracemalloc.start()
+    measured = engine.Engine()
+    measured.reload()
+    engine_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del measured
+    eng = engine.Engine()
+    start = time.perf_counter()
+    eng.reload()
+    elapsed = time.perf_counter() - start
+    stats = eng.stats()
+
+    cases = {
+        'most_used_reacts': lambda i: eng.most_used_reacts(team),
+        'most_used_reacts.user': lambda i: eng.most_used_reacts(team, user=ws.users[i % 10]),
+        'most_used_reacts.channel': lambda i: eng.most_used_reacts(team, channel=ws.channels[i % 5]),
+        'most_used_reacts.7d': lambda i: eng.most_used_reacts(team, window=week),
+        'most_reacted_to_posts': lambda i: eng.most_reacted_to_posts(team),
+        'most_reacted_to_posts.7d': lambda i: eng.most_reacted_to_posts(team, window=week),
+        'most_unique_reacts_on_a_post': lambda i: eng.most_unique_reacts_on_a_post(team),
+        'most_active': lambda i: eng.most_active(team),
+        'most_active.7d': lambda i: eng.most_active(team, window=week),
+        'users_with_most_reacts': lambda i: eng.users_with_most_reacts(team),
+        'users_with_most_reacts.7d': lambda i: eng.users_with_most_reacts(team, window=week),
+    }
+    results = {'engine.load': throughput(stats['messages'] + stats['reacts'], elapsed)}
+    for name, case in cases.items():
+        case(0)
+        results['engine.' + name] = percentiles(sample(case, args.iterations))
+    print_results(results)
+    print('\nrows as tuples: %.1f MB, engine: %.1f MB (%.1f MB of arrays)'
+          % (row_bytes / 1e6, engine_bytes / 1e6, stats['array_bytes'] / 1e6))
+    results['engine.load'].update(bytes=engine_bytes, row_bytes=row_bytes)
+    if not args.keep:
+        delete_team(team)
+    return results
+
+
+def slack_payloads(ws):
+    '''
+    Slack API event payloads for ws, with the envelope fields Slack sends
+    '''
+    for i, (msg, reacts) in enumerate(ws.generate()):
+        channel, ts = msg.channel_id, msg.msg_id[len(msg.channel_id):]
+        envelope = {'token': 'bench-token', 'team_id': ws.team_id, 'api_app_id': 'A0BENCH',
+                    'type': 'event_callback', 'authed_users': ['U0BENCH'],
+                    'event_time': int(float(ts))}
+        yield dict(envelope, event_id='Ev%08dm' % i, event={
+            'type': 'message', 'channel': channel, 'user': msg.user_id, 'text': msg.text,
+            'ts': ts, 'event_ts': ts, 'channel_type': 'channel', 'team': ws.team_id,
+            'blocks': [{'type': 'rich_text', 'block_id': 'b%d' % i, 'elements': [
+                {'type': 'rich_text_section', 'elements': [{'type': 'text', 'text': msg.text}]}]}]})
+        for j, react in enumerate(reacts):
+            react_ts = '%.6f' % react.created_at.timestamp()
+            yield dict(envelope, event_id='Ev%08dr%d' % (i, j), event={
+                'type': 'reaction_added', 'user': react.user_id, 'reaction': react.name,
+                'item_user': msg.user_id, 'event_ts': react_ts,
+                'item': {'type': 'message', 'channel': channel, 'ts': ts}})
+
+
+def bench_events(args):
+    '''
+    Memory and queue cost of an API event as the full Slack payload and as
+    the compact Event the local event queue now carries, and the memory of
+    the React records built from them
+    '''
+    import pickle
+    import tracemalloc
+    from multiprocessing import Queue
+    from bot import Event, EVENT_TYPE_API_EVENT
+
+    ws = workspace(args, 'TEVENTS%d' % args.seed)
+    payloads = list(slack_payloads(ws))
+    count = len(payloads)
+    variants = {'full': lambda p: Event(EVENT_TYPE_API_EVENT, p),
+                'compact': lambda p: Event.compact(EVENT_TYPE_API_EVENT, p)}
+    results = {}
+    for name, make in variants.items():
+        # Payloads arrive parsed from each request's JSON, so copy them to
+        # count the memory a queued event holds on to
+        tracemalloc.start()
+        events = [make(json.loads(json.dumps(p))) for p in payloads]
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        pickled = sum(len(pickle.dumps(e)) for e in events)
+
+        queue = Queue()
+        start = time.perf_counter()
+        for e in events:
+            queue.put(e)
+        for _ in range(count):
+            queue.get()
+        elapsed = time.perf_counter() - start
+        queue.close()
+
+        results['events.' + name] = throughput(count, elapsed)
+        results['events.' + name].update(bytes_per_event=held / count, pickled_per_event=pickled / count)
+
+    fields = [util.compact_api_event(p) for p in payloads]
+    react_fields = [f for f in fields if f[0] == util.ADD_REACT]
+    records = {'reference': lambda f: ReferenceReact(*[json.loads(json.dumps(v)) for v in f[1:6]]),
+               'slots': lambda f: util.React(*[json.loads(json.dumps(v)) for v in f[1:6]])}
+    for name, make in records.items():
+        tracemalloc.start()
+        held = [make(f) for f in react_fields]
+        results['events.react.' + name] = {'count': len(held),
+                                           'bytes_per_react': tracemalloc.get_traced_memory()[0] / len(held)}
+        tracemalloc.stop()
+        del held
+
+    print('%-24s %14s %14s %14s' % ('', 'bytes/event', 'pickled bytes', 'put+get/s'))
+    for name in variants:
+        r = results['events.' + name]
+        print('%-24s %14.0f %14.0f %14.0f' % (name, r['bytes_per_event'], r['pickled_per_event'], r['per_sec']))
+    print('\n%-24s %14s' % ('', 'bytes/React'))
+    for name in records:
+        print('%-24s %14.0f' % (name, results['events.react.' + name]['bytes_per_react']))
+    return results
+
+
+def bench_unique_words(args):
+    ws = workspace(args, 'TBENCH%d' % args.seed)
+    texts = ws.texts()
+    users, channels = ws.directory()
+    analytics.unique_words(texts, users, channels)
+    samples = sample(lambda i: analytics.unique_words(texts, users, channels), args.repeat)
+    results = {'unique_words': percentiles(samples),
+               'unique_words.messages': throughput(len(texts), min(samples))}
+    print_results(results)
+    return results
+
+
+def bench_ingest(args):
+    '''
+    Events per second through EventBatcher and db.write_batch, the latency of
+    each batch write, and the latency of the single event db functions
+    '''
+    import db
+    from ingest import EventBatcher
+
+    ws = workspace(args, 'TINGEST%d' % args.seed)
+    delete_team(ws.team_id)
+    events = [(msg, reacts) for msg, reacts in ws.generate()]
+    event_count = sum(1 + len(reacts) for _, reacts in events)
+
+    batcher = EventBatcher(max_items=args.batch_size)
+    flushes = []
+    start = time.perf_counter()
+    for msg, reacts in events:
+        batcher.add_message(msg)
+        for react in reacts:
+            batcher.add_react(react)
+        if len(batcher._pending) >= args.batch_size:
+            flush_start = time.perf_counter()
+            batcher.flush()
+            flushes.append(time.perf_counter() - flush_start)
+    batcher.flush()
+    elapsed = time.perf_counter() - start
+    results = {'ingest.batch_flush': percentiles(flushes),
+               'ingest.batched_events': throughput(event_count, elapsed)}
+
+    # The single event path, on a slice so it doesn't take all day
+    single = Workspace(team_id='TSINGLE%d' % args.seed, users=args.users,
+                       messages=max(1, args.iterations), seed=args.seed + 1)
+    delete_team(single.team_id)
+    singles = list(single.generate())
+    results['ingest.add_message'] = percentiles(sample(lambda i: db.add_message(singles[i][0]), len(singles)))
+    reacts = [react for _, msg_reacts in singles for react in msg_reacts]
+    if reacts:
+        results['ingest.add_react'] = percentiles(sample(lambda i: db.add_react(reacts[i]), len(reacts)))
+
+    print_results(results)
+    if not args.keep:
+        delete_team(ws.team_id)
+    delete_team(single.team_id)
+    return results
+
+
+def sketch_batches(ws, batch_size):
+    '''
+    Yields the phrase counts, (react, word) counts and (message, react name)
+    pairs of each batch_size messages, as db records them at ingest
+    '''
+    phrases, words, pairs = Counter(), Counter(), []
+    for i, (msg, reacts) in enumerate(ws.generate()):
+        phrases.update(nlp.phrases(msg.text))
+        tokens = nlp.indexed_tokens(msg.text)
+        for react in reacts:
+            words.update((react.name, word) for word in tokens)
+            pairs.append((msg.msg_id, react.name))
+        if (i + 1) % batch_size == 0:
+            yield phrases, words, pairs
+            phrases, words, pairs = Counter(), Counter(), []
+    yield phrases, words, pairs
+
+
+def recall(estimated, true, count):
+    '''
+    Fraction of the estimated top count whose true counts make the true top
+    count, so ties don't count as misses
+    '''
+    ranked = sorted(true.values(), reverse=True)
+    if not ranked or not estimated:
+        return 1.0
+    cutoff = ranked[min(count, len(ranked)) - 1]
+    return sum(1 for key, _ in estimated[:count] if true.get(key, 0) >= cutoff) / float(len(estimated[:count]))
+
+
+def relative_error(estimated, true):
+    errors = [abs(value - true.get(key, 0)) / float(true[key]) if true.get(key) else 1.0
+              for key, value in estimated]
+    return sum(errors) / len(errors) if errors else 0.0
+
+
+def bench_sketch(args):
+    '''
+    Accuracy and memory of the approximate analytics sketches at several
+    Count-Min widths and HyperLogLog precisions, against exact counts held in
+    Counters and sets. Needs no database.
+    '''
+    import tracemalloc
+    import sketch
+    ws = workspace(args, 'TSKETCH%d' % args.seed)
+    batches = list(sketch_batches(ws, args.batch_size))
+
+    tracemalloc.start()
+    phrases, words, distinct = Counter(), Counter(), {}
+    for batch_phrases, batch_words, pairs in batches:
+        phrases.update(batch_phrases)
+        words.update(batch_words)
+        for msg_id, name in pairs:
+            distinct.setdefault(msg_id, set()).add(name)
+    exact_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    words_by_react = {}
+    for (name, word), total in words.items():
+        words_by_react.setdefault(name, Counter())[word] = total
+    reacts = [name for name, _ in Counter({name: sum(c.values()) for name, c in words_by_react.items()})
+              .most_common(10)]
+    distinct_counts = {msg_id: len(names) for msg_id, names in distinct.items()}
+    events = sum(len(pairs) for _, _, pairs in batches) + ws.message_count
+
+    def build(width, precision):
+        team = sketch.TeamSketches(width=width, precision=precision)
+        for batch_phrases, batch_words, pairs in batches:
+            team.add_phrases(batch_phrases)
+            team.add_react_words(batch_words)
+            if pairs:
+                team.reacts.add([msg_id for msg_id, _ in pairs], [name for _, name in pairs])
+        return team
+
+    configs = [(width, sketch.SKETCH_HLL_PRECISION) for width in args.widths]
+    configs += [(sketch.SKETCH_WIDTH, precision) for precision in args.precisions
+                if precision != sketch.SKETCH_HLL_PRECISION]
+    results = {}
+    rows = []
+    for width, precision in configs:
+        tracemalloc.start()
+        team = build(width, precision)
+        sketch_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del team
+        start = time.perf_counter()
+        team = build(width, precision)
+        elapsed = time.perf_counter() - start
+
+        top_phrases = team.top_phrases.top(10, team.phrases)
+        word_recall = word_error = 0.0
+        for name in reacts:
+            top_words = team.top_words[name].top(5, team.words, name + '\0')
+            word_recall += recall(top_words, words_by_react[name], 5) / len(reacts)
+            word_error += relative_error(top_words, words_by_react[name]) / len(reacts)
+        ranked = team.reacts.ranked()
+        estimates = [(msg_id, team.reacts.estimate(msg_id)) for msg_id in ranked]
+        result = throughput(events, elapsed)
+        result.update(bytes=sketch_bytes, exact_bytes=exact_bytes,
+                      phrase_recall=recall(top_phrases, phrases, 10),
+                      phrase_error=relative_error(top_phrases, phrases),
+                      word_recall=word_recall, word_error=word_error,
+                      distinct_recall=recall(estimates, distinct_counts, 10),
+                      distinct_error=relative_error(estimates, distinct_counts))
+        results['sketch.w%d.p%d' % (width, precision)] = result
+        rows.append((width, precision, result))
+
+    print_results(results)
+    print('\nexact counters and sets: %.1f MB' % (exact_bytes / 1e6))
+    print('%-8s %4s %9s %13s %13s %15s' % ('width', 'p', 'MB', 'phrases r/err', 'words r/err', 'distinct r/err'))
+    for width, precision, r in rows:
+        print('%-8d %4d %9.1f %6.2f/%5.3f %6.2f/%5.3f %8.2f/%5.3f'
+              % (width, precision, r['bytes'] / 1e6, r['phrase_recall'], r['phrase_error'],
+                 r['word_recall'], r['word_error'], r['distinct_recall'], r['distinct_error']))
+    return results
+
+
+def bench_all(args):
+    results = {}
+    for bench in (bench_unique_words, bench_ingest, bench_analytics):
+        results.update(bench(args))
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    Prints how results moved against baseline. Returns the names of the
+    results more than threshold slower.
+    '''
+    regressions = []
+    print('\n%-44s %-8s %10s %10s %8s' % ('', 'metric', 'baseline', 'current', 'change'))
+    for name, current in sorted(results.items()):
+        before = baseline.get(name)
+        if not before:
+            continue
+        # Lower is better for times, higher for rates
+        for metric, lower_is_better in (('p50_ms', True), ('p95_ms', True), ('seconds', True),
+                                        ('per_sec', False)):
+            # seconds and per_sec of a throughput result say the same thing
+            if metric == 'seconds' and 'per_sec' in current:
+                continue
+            if metric not in current or not before.get(metric):
+                continue
+            change = current[metric] / before[metric] - 1
+            slower = change if lower_is_better else -change
+            flag = ' REGRESSION' if slower > threshold else ''
+            if flag:
+                regressions.append(name)
+            print('%-44s %-8s %10.2f %10.2f %+7.1f%%%s'
+                  % (name, metric, before[metric], current[metric], change * 100, flag))
+    return regressions
+
+
+BENCHMARKS = {'tokenizer': bench_tokenizer,
+              'ack': bench_ack,
+              'events': bench_events,
+              'analytics': bench_analytics,
+              'engine': bench_engine,
+              'unique_words': bench_unique_words,
+              'ingest': bench_ingest,
+              'sketch': bench_sketch,
+              'all': bench_all}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--messages', type=int,
+                        help='messages to generate, default 100000 for tokenizer and 20000 otherwise')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=50, help='calls per analytics command')
+    parser.add_argument('--batch-size', type=int, default=500, help='messages per write_batch when loading')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--widths', type=lambda v: [int(w) for w in v.split(',')],
+                        default=[1024, 4096, 16384, 65536], help='Count-Min widths for sketch')
+    parser.add_argument('--precisions', type=lambda v: [int(p) for p in v.split(',')],
+                        default=[4, 8], help='HyperLogLog precisions for sketch')
+    parser.add_argument('--keep', action='store_true', help='leave the synthetic workspace in the database')
+    parser.add_argument('--database', help='database URL to use instead of DATABASE_URL')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='compare with the results in this file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='fraction slower than the baseline that counts as a regression')
+    args = parser.parse_args()
+    import db
+    if args.database:
+        db.use(args.database)
+    print('backend: %s' % db.backend.name)
+    results = BENCHMARKS[args.benchmark](args)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'benchmark': args.benchmark, 'args': vars(args), 'time': time.time(),
+                       'backend': db.backend.name, 'results': results}, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\nbaseline backend: %s, current backend: %s'
+              % (baseline.get('backend', 'postgres'), db.backend.name))
+        if compare(results, baseline['results'], args.threshold):
+            sys.exit(1)
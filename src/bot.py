@@ -2,12 +2,21 @@ import os
 from multiprocessing import Queue
 from multiprocessing import Process, Lock
 import re
-from slackclient import SlackClient
+import requests
+from datetime import timedelta
+from concurrent.futures import Future
+from slack_api import SlackAPI
 import analytics
 import logging
-from util import create_react, create_message
+from util import compact_api_event, encode_api_event, decode_api_event, create_record, compact_slash_command
 import db
-from time import sleep
+import dedupe
+import engine
+import sketch
+import metrics
+from directory import Directory, DIRECTORY_EVENTS
+import atexit
+from ingest import EventBatcher, EVENTS_DROPPED
 
 EVENT_TYPE_SLASH_COMMAND = 0
 EVENT_TYPE_API_EVENT = 1
@@ -21,18 +30,67 @@ COMMON_PHRASES = 'common_phrases'
 MOST_ACTIVE = 'most_active'
 
 
-VALID_COMMANDS = {MOST_USED_REACTS: '[_optional_ *@User*]',
-                  MOST_UNIQUE_REACTS_ON_POST: '[_optional_ *@User*]',
-                  MOST_REACTED_TO_MESSAGES: '[_optional_ *@User*]',
-                  REACT_BUZZWORDS: '[_required_ :react:, :react2: ...]',
-                  MOST_REACTS: '',
-                  COMMON_PHRASES: '',
-                  MOST_ACTIVE: ''}
+VALID_COMMANDS = {MOST_USED_REACTS: '[_optional_ *@User*] [_optional_ *#channel*] [_optional_ *7d*]',
+                  MOST_UNIQUE_REACTS_ON_POST: '[_optional_ *@User*] [_optional_ *#channel*] [_optional_ *7d*]',
+                  MOST_REACTED_TO_MESSAGES: '[_optional_ *@User*] [_optional_ *#channel*] [_optional_ *7d*]',
+                  REACT_BUZZWORDS: '[_required_ :react:, :react2: ...] [_optional_ *7d*]',
+                  MOST_REACTS: '[_optional_ *7d*]',
+                  COMMON_PHRASES: '[_optional_ *7d*]',
+                  MOST_ACTIVE: '[_optional_ *7d*]'}
+
+USER_ARG_EXPR = re.compile('(?<=<@)([A-Z0-9]+)')
+CHANNEL_ARG_EXPR = re.compile('(?<=<#)([A-Z0-9]+)')
+# A window like 24h, 7d or 2w, not part of a word or mention
+WINDOW_ARG_EXPR = re.compile(r'(?<![\w<@#|])(\d+)([hdw])\b')
+WINDOW_UNITS = {'h': 'hours', 'd': 'days', 'w': 'weeks'}
+# Windows reaching back further than this are all of history
+MAX_WINDOW = timedelta(days=100 * 365)
+
+# 'local' handles events in a process forked by each Bot, 'redis' appends
+# them to the durable log read by consumer.py
+EVENT_CONSUMER = os.environ.get('EVENT_CONSUMER', 'local')
+
+EVENT_TYPE_NAMES = {EVENT_TYPE_SLASH_COMMAND: 'slash_command', EVENT_TYPE_API_EVENT: 'api'}
+EVENTS_RECEIVED = metrics.counter('events_received_total', 'Events received from Slack, by type', ('type',))
+SLASH_COMMAND_SECONDS = metrics.histogram('slash_command_seconds', 'Time to answer a slash command',
+                                          ('command',))
 
 authed_teams = {}
 
+
+def parse_filters(text):
+    '''
+    Pulls the escaped user and channel (<@U123|name>, <#C123|name>) out of
+    slash command arguments.
+
+    Returns:
+        tuple: (user_id or None, channel_id or None)
+    '''
+    user = USER_ARG_EXPR.search(text)
+    channel = CHANNEL_ARG_EXPR.search(text)
+    return (user.group(0) if user else None,
+            channel.group(0) if channel else None)
+
+
+def parse_window(text):
+    '''
+    Pulls a window like 24h, 7d or 2w out of slash command arguments.
+
+    Returns:
+        timedelta or None: the window, None for all of history
+    '''
+    window = WINDOW_ARG_EXPR.search(text)
+    if not window:
+        return None
+    try:
+        window = timedelta(**{WINDOW_UNITS[window.group(2)]: int(window.group(1))})
+    except OverflowError:
+        return None
+    return window if window <= MAX_WINDOW else None
+
+
 class Bot(object):
-    def __init__(self):
+    def __init__(self, start_loop=True):
         self.oauth = {"client_id": os.environ.get("CLIENT_ID"),
                       "client_secret": os.environ.get("CLIENT_SECRET"),
                       # Scopes provide and limit permissions to what our app
@@ -40,17 +98,32 @@ class Bot(object):
                       # scope that your app will need.
                       "scope": 'bot'}
         self.verification = os.environ.get("VERIFICATION_TOKEN")
-        self.bot_client = SlackClient(os.environ.get('BOT_ACCESS_TOKEN'))
-        self.workspace_client = SlackClient(os.environ.get('ACCESS_TOKEN'))
+        self.bot_client = SlackAPI(os.environ.get('BOT_ACCESS_TOKEN'))
+        self.workspace_client = SlackAPI(os.environ.get('ACCESS_TOKEN'))
         self.event_queue = Queue()
+        self.event_log = None
+        if EVENT_CONSUMER == 'redis':
+            from consumer import EventLog, check_shared_cache
+            check_shared_cache()
+            self.event_log = EventLog()
         self.name = "reactanalyticsbot"
         self.emoji = ":robot_face:"
-        self.users_lock = Lock()
         self.reacts_lock = Lock()
-        self.users = {}
-        self.channels = {}
+        self.directory = Directory(self.workspace_client)
         self.reacts_list = set()
-        self.start()
+        # Created in the event handler process, see event_handler_loop
+        self.batcher = None
+        self.engine = None
+        self.sketches = None
+        metrics.register('directory', self.directory.stats)
+        metrics.register('slack_api_bot', lambda: self.bot_client.stats())
+        metrics.register('slack_api_workspace', lambda: self.workspace_client.stats())
+        if self.event_log:
+            metrics.register('event_log', self.event_log.stats, label='partition')
+        else:
+            metrics.register('event_queue', self.queue_stats)
+        if start_loop and not self.event_log:
+            self.start()
 
     def start(self):
         p = Process(target=self.event_handler_loop)
@@ -60,60 +133,51 @@ class Bot(object):
     API INTERACTIONS
     '''
 
-    def verify_token(self, token):
-        return self.verification == token
-
-    def load_users(self):
-        users_response = self.workspace_client.api_call('users.list',
-                                                        scope=self.oauth['scope'])
+    @property
+    def users(self):
+        return self.directory.users
 
-        ok = users_response['ok']
+    @property
+    def channels(self):
+        return self.directory.channels
 
-        if not ok:
-            print('Failed to load users')
-            print(users_response)
-            return
+    def verify_token(self, token):
+        return self.verification == token
 
-        should_continue = True
-        while should_continue:
-            next_users = users_response['members']
-            with self.users_lock:
-                for user in next_users:
-                    user_id = user['id']
-                    user_name = user['name']
-                    user_info = {'user_name': user_name}
-                    if 'display_name' in user['profile']:
-                        user_info['display_name'] = user['profile']['display_name']
-                    else:
-                        user_info['display_name'] = user_name
-                    self.users[user_id] = user_info
-            if 'response_metadata' in users_response:
-                next_cursor = users_response['response_metadata']['next_cursor']
-
-                if not next_cursor:
-                    should_continue = False
-                else:
-                    users_response = self.workspace_client.api_call('users.list',
-                                                                    scope=self.oauth['scope'],
-                                                                    cursor=next_cursor)
-                    should_continue = users_response['ok']
-            else:
-                should_continue = False
+    def send_dm(self, user_id, message):
+        '''
+        Queues message for the user's DM channel. Messages queued together
+        are posted as one.
 
+        Returns:
+            Future: resolved to whether the message was posted, already False
+            if the DM channel couldn't be opened
+        '''
+        channel_id = self.bot_client.open_dm(user_id)
+        if not channel_id:
+            future = Future()
+            future.set_result(False)
+            return future
 
-    def send_dm(self, user_id, message):
-        new_dm = self.bot_client.api_call('im.open',
-                                          user=user_id)
+        return self.bot_client.queue_message(channel_id, message, username=self.name)
 
-        if not new_dm['ok']:
+    def respond(self, event, message):
+        '''
+        Posts a slash command result to the command's response_url, only
+        visible to the user who ran it. Falls back to a DM for commands that
+        came without one.
+        '''
+        response_url = event.get('response_url')
+        if not response_url:
+            # Waits for the post, so both ways report whether it arrived
+            return self.send_dm(event['user_id'], message).result()
+        try:
+            response = requests.post(response_url, json={'response_type': 'ephemeral',
+                                                         'text': message}, timeout=10)
+        except requests.RequestException as e:
+            logging.getLogger(__name__).warning('Failed to post to response_url: %s', e)
             return False
-
-        channel_id = new_dm['channel']['id']
-        post_msg = self.bot_client.api_call('chat.postMessage',
-                                            channel=channel_id,
-                                            username=self.name,
-                                            text=message)
-        return post_msg['ok']
+        return response.ok
 
     def auth(self, code):
         response = self.bot_client.api_call('oauth.access',
@@ -123,40 +187,63 @@ class Bot(object):
         if response['ok']:
             team_id = response['team_id']
             bot_token = response['bot']['bot_access_token']
-            self.bot_client = SlackClient(bot_token)
+            self.bot_client = SlackAPI(bot_token)
 
     def auth_token(self, token):
-        auth_response = self.workspace_client.api_call('auth.test',
-                                                       token=token)
-        return auth_response['ok']
+        return self.workspace_client.auth_test(token)
 
 
     '''
     EVENT HANDLERS
     '''
 
+    def queue_stats(self):
+        try:
+            return {'depth': self.event_queue.qsize()}
+        except NotImplementedError:
+            # qsize isn't available on macOS
+            return {}
+
     def on_event(self, token, event_type, slack_event):
-        if self.verify_token(token):
-            evnt = Event(event_type, slack_event)
-            self.event_queue.put(evnt)
-        else:
+        EVENTS_RECEIVED.inc(EVENT_TYPE_NAMES.get(event_type, 'unknown'))
+        if not self.verify_token(token):
+            EVENTS_DROPPED.inc('invalid_token')
             return False
+        # Slack redelivers events it didn't get a timely ack for, drop the
+        # copies here so they never reach the database
+        event_id = slack_event.get('event_id')
+        if event_id and dedupe.events.seen(event_id):
+            EVENTS_DROPPED.inc('duplicate')
+            return True
+        try:
+            if self.event_log:
+                self.event_log.append(event_type, slack_event)
+            else:
+                event = Event.compact(event_type, slack_event)
+                if event:
+                    self.event_queue.put(event)
+                else:
+                    EVENTS_DROPPED.inc('unhandled')
+        except Exception:
+            if event_id:
+                dedupe.events.forget(event_id)
+            raise
+        return True
 
     def handle_api_event(self, event):
-        slack_event = event.event_info
-        event_type = slack_event['event']['type']
-
-        if 'subtype' in slack_event['event'] and slack_event['event']['subtype'] == 'message_deleted':
-            event_type = 'message_deleted'
+        event_info = event.event_info
+        if isinstance(event_info, bytes):
+            fields = decode_api_event(event_info)
+        elif self.directory.apply_event(event_info['event']):
+            return
+        else:
+            # Full payloads still come from the Redis event log
+            fields = compact_api_event(event_info)
+        if not fields:
+            return
 
-        if event_type == 'reaction_added':
-            db.add_react(create_react(slack_event))
-        elif event_type == 'reaction_removed':
-            db.remove_react(create_react(slack_event))
-        elif event_type == 'message':
-            db.add_message(create_message(slack_event))
-        elif event_type == 'message_deleted':
-            db.remove_message(create_message(slack_event))
+        op, obj = create_record(fields)
+        getattr(self.batcher if self.batcher else db, op)(obj)
 
 
     def handle_slash_command(self, event):
@@ -167,62 +254,57 @@ class Bot(object):
             logging.getLogger(__name__).warning('Not authed')
             return
 
-        if not self.users:
-            self.load_users()
+        # Loads the stored directory and starts refreshing it, once per process
+        self.directory.start()
 
         text = event['text'].split(' ')
-        user_id = event['user_id']
+        team_id = event.get('team_id') or ''
         command = text[0]
         args = ""
 
         # check if there are any args
         if len(text) > 1:
             args = ' '.join(text[1:])
-        try:
-            if command == MOST_USED_REACTS:
-                response = self.most_used_reacts(args)
-            elif command == MOST_REACTED_TO_MESSAGES:
-                response = self.most_reacted_to_message(args)
-            elif command == MOST_UNIQUE_REACTS_ON_POST:
-                response = self.most_unique_reacts_on_post(args)
-            elif command == REACT_BUZZWORDS:
-                response = self.react_buzzwords(args)
-            elif command == MOST_REACTS:
-                response = self.most_reacts(args)
-            elif command == COMMON_PHRASES:
-                response = self.common_phrases()
-            elif command == MOST_ACTIVE:
-                response = self.most_active()
-        except Exception as e:
-            response = 'There was an error processing your request'
-            self.send_dm(user_id, response)
-            raise e
+        with SLASH_COMMAND_SECONDS.time(command if command in VALID_COMMANDS else 'unknown'):
+            try:
+                if command == MOST_USED_REACTS:
+                    response = self.most_used_reacts(team_id, args)
+                elif command == MOST_REACTED_TO_MESSAGES:
+                    response = self.most_reacted_to_message(team_id, args)
+                elif command == MOST_UNIQUE_REACTS_ON_POST:
+                    response = self.most_unique_reacts_on_post(team_id, args)
+                elif command == REACT_BUZZWORDS:
+                    response = self.react_buzzwords(team_id, args)
+                elif command == MOST_REACTS:
+                    response = self.most_reacts(team_id, args)
+                elif command == COMMON_PHRASES:
+                    response = self.common_phrases(team_id, args)
+                elif command == MOST_ACTIVE:
+                    response = self.most_active(team_id, args)
+            except Exception as e:
+                response = 'There was an error processing your request'
+                self.respond(event, response)
+                raise e
 
-        self.send_dm(user_id, response)
+        self.respond(event, response)
 
     def user_exists(self, user):
         '''
-        Checks if user exists in cached user list. If not, reloads users (in the case that it's a new user)
-        and rechecks.
+        Checks if user is in the directory, looking up IDs it doesn't have yet
+        (in the case that it's a new user)
         '''
-        if user in self.users:
-            return True
-        else:
-            self.load_users()
-            return user in self.users
+        return self.directory.user(user) is not None
 
-    def common_phrases(self):
-        phrases = analytics.get_common_phrases()
+    def common_phrases(self, team_id, args):
+        phrases = analytics.get_common_phrases(team_id, window=parse_window(args))
         result_str = ['*Common Phrases:*']
         for p in phrases:
             result_str.append(' '.join(p))
         return '\n'.join(result_str)
 
-    def most_reacted_to_message(self, text):
-        re_object = re.search('(?<=\@)(.*?)(?=\|)', text)
-        user_id = re_object.group(0) if re_object else None
-            
-        msgs = analytics.most_reacted_to_posts()
+    def most_reacted_to_message(self, team_id, text):
+        user, channel = parse_filters(text)
+        msgs = analytics.most_reacted_to_posts(team_id, user, channel, window=parse_window(text))
 
         result_str = ['*Most reacted to posts*']
         for msg, count in msgs:
@@ -230,8 +312,8 @@ class Bot(object):
 
         return '\n'.join(result_str)
 
-    def most_reacts(self, args):
-        user_reacts = analytics.users_with_most_reacts()
+    def most_reacts(self, team_id, args):
+        user_reacts = analytics.users_with_most_reacts(team_id, window=parse_window(args))
 
         result_str = ['*Users that react the most*']
         for user, count in user_reacts.items():
@@ -241,8 +323,8 @@ class Bot(object):
                 print(user + 'not in users dictionary')
         return '\n'.join(result_str)
 
-    def most_active(self):
-        most_active = analytics.most_active()
+    def most_active(self, team_id, args):
+        most_active = analytics.most_active(team_id, window=parse_window(args))
         result_str = ['*Most active users*']
         for user, _ in most_active:
             if self.user_exists(user):
@@ -251,11 +333,9 @@ class Bot(object):
                 print(str(user) + 'not in users dictionary')
         return '\n'.join(result_str)
 
-    def most_used_reacts(self, text):
-        user_id = re.search('(?<=\@)(.*?)(?=\|)', text)
-
-        user = user_id if user_id else None
-        result = analytics.most_used_reacts(user)
+    def most_used_reacts(self, team_id, text):
+        user, channel = parse_filters(text)
+        result = analytics.most_used_reacts(team_id, user, channel, window=parse_window(text))
 
         return_str = ['*Most used reacts:*']
         for r in result:
@@ -263,11 +343,11 @@ class Bot(object):
             return_str.append(line)
         return '\n'.join(return_str)
 
-    def most_unique_reacts_on_post(self, text):
-        channel_id = re.search('(?<=\#)(.*?)(?=\|)', text)
+    def most_unique_reacts_on_post(self, team_id, text):
+        user, channel = parse_filters(text)
         result_str = ['*Messages with most unique reacts*']
 
-        result = analytics.most_unique_reacts_on_a_post()
+        result = analytics.most_unique_reacts_on_a_post(team_id, user, channel, window=parse_window(text))
 
         for msg, reacts in result:
             react_str = ' '.join([':' + r + ':' for r in reacts])
@@ -275,37 +355,68 @@ class Bot(object):
 
         return '\n'.join(result_str)
 
-    def react_buzzwords(self, text):
+    def react_buzzwords(self, team_id, text):
         if not text.strip():
             return 'specify at least one react'
 
         result_str = []
 
         reacts = re.findall('(?<=:)(.*?)(?=:)', text)
-        reacts = {r for r in reacts if r.strip(' ')}
+        reacts = tuple(sorted({r for r in reacts if r.strip(' ')}))
+        window = parse_window(text)
 
-        for r in reacts:
-            try:
-                react_buzzwords = analytics.react_buzzword(r, self.users, self.channels)
-                line = ':' + r + ':: '
-                if react_buzzwords:
-                    line += ', '.join([word for word in react_buzzwords.keys()])
-                else:
-                    line += 'React not used'
-                result_str.append(line)
+        try:
+            buzzwords = analytics.react_buzzwords(team_id, reacts, self.users, self.channels, window=window)
+        except Exception as e:
+            logging.getLogger(__name__).exception(e)
+            return 'something went wrong'
 
-            except Exception as e:
-                logging.getLogger(__name__).exception(e)
-                return 'something went wrong'
+        for r in reacts:
+            line = ':' + r + ':: '
+            if buzzwords[r]:
+                line += ', '.join([word for word in buzzwords[r].keys()])
+            else:
+                line += 'React not used'
+            result_str.append(line)
 
         return '\n'.join(result_str)
 
+    def start_engine(self):
+        '''
+        Starts the in-memory analytics engine in this process if
+        ANALYTICS_ENGINE is set
+        '''
+        if not engine.ANALYTICS_ENGINE:
+            return
+        self.engine = engine.Engine()
+        self.engine.start()
+        metrics.register('engine', self.engine.stats)
+        analytics.engine = db.engine = self.engine
+
+    def start_sketches(self):
+        '''
+        Starts keeping the sketches for approximate analytics in this process
+        if ANALYTICS_SKETCHES is set
+        '''
+        if not sketch.ANALYTICS_SKETCHES:
+            return
+        self.sketches = sketch.Sketches()
+        self.sketches.start()
+        metrics.register('sketches', self.sketches.stats)
+        analytics.sketches = db.sketches = self.sketches
+        atexit.register(self.sketches.save)
+
     def event_handler_loop(self):
+        # Before the batcher, so its atexit flush runs before the last save
+        self.start_sketches()
+        # And so every batch it commits reaches the engine
+        self.start_engine()
+        self.batcher = EventBatcher()
+        self.batcher.start()
+        metrics.register('ingest', self.batcher.stats)
+        atexit.register(self.batcher.close)
         while True:
-            while not self.event_queue.empty():
-                event = self.event_queue.get()
-                self.handle_event(event)
-            sleep(1)
+            self.handle_event(self.event_queue.get())
 
     def handle_event(self, event):
         if event.type == EVENT_TYPE_API_EVENT:
@@ -315,6 +426,25 @@ class Bot(object):
 
 
 class Event(object):
+    __slots__ = ('type', 'event_info')
+
     def __init__(self, event_type, event_info):
         self.type = event_type
         self.event_info = event_info
+
+    @classmethod
+    def compact(cls, event_type, event_info):
+        '''
+        The Event for the local event queue. API events are cut down to
+        compact_api_event's fields and marshalled, slash commands to the
+        fields the handler reads. Returns None for API events that aren't
+        handled. User and channel changes keep just the event, for the
+        directory.
+        '''
+        if event_type == EVENT_TYPE_API_EVENT:
+            event = event_info['event']
+            if event['type'] in DIRECTORY_EVENTS:
+                return cls(event_type, {'event': event})
+            fields = compact_api_event(event_info)
+            return cls(event_type, encode_api_event(fields)) if fields else None
+        return cls(event_type, compact_slash_command(event_info))
@@ -0,0 +1,215 @@
+import os
+import pickle
+import hashlib
+import inspect
+import threading
+import time
+import log
+import metrics
+from collections import OrderedDict
+from functools import wraps
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+REDIS_URL = os.environ.get('REDIS_URL')
+# Entries kept in each process before the least recently used is evicted
+ANALYTICS_CACHE_SIZE = int(os.environ.get('ANALYTICS_CACHE_SIZE', 256))
+# Seconds a result is served for even if no write bumps the generation
+ANALYTICS_CACHE_TTL = int(os.environ.get('ANALYTICS_CACHE_TTL', 600))
+KEY_PREFIX = 'react_analytics:'
+# Dicts whose fingerprint is remembered, see ResultCache.fingerprint
+FINGERPRINTS_KEPT = 8
+
+
+class ResultCache(object):
+    '''
+    Caches analytics results keyed by command, arguments and the team's write
+    generation. db bumps the generation after every committed write, so a
+    result is served until the data it was computed from changes.
+
+    Results live in a per process LRU and, when REDIS_URL is set, in Redis so
+    gunicorn and celery processes share them and see each other's bumps.
+    '''
+    def __init__(self, max_size=ANALYTICS_CACHE_SIZE, ttl=ANALYTICS_CACHE_TTL, redis_url=REDIS_URL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.redis_url = redis_url
+        self._redis = None
+        self._lock = threading.Lock()
+        self._local = OrderedDict()
+        self._generations = {}
+        self._fingerprints = OrderedDict()
+        self._stats = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'evictions': 0,
+                       'bumps': 0, 'redis_errors': 0}
+
+    def _client(self):
+        if self._redis is None and self.redis_url and redis is not None:
+            self._redis = redis.Redis.from_url(self.redis_url, socket_timeout=0.5)
+        return self._redis
+
+    def _redis_call(self, func, *args):
+        client = self._client()
+        if client is None:
+            return None
+        try:
+            return getattr(client, func)(*args)
+        except redis.RedisError as e:
+            self._stats['redis_errors'] += 1
+            log.log_error('Result cache redis error: ' + str(e))
+            return None
+
+    def generation(self, team_id=''):
+        shared = self._redis_call('get', KEY_PREFIX + 'generation:' + team_id)
+        if shared is not None:
+            return int(shared)
+        return self._generations.get(team_id, 0)
+
+    def external_generation(self, team_id=''):
+        '''
+        Bumps of team_id's generation made by other processes, as far as
+        Redis has counted them. 0 without Redis.
+        '''
+        shared = self._redis_call('get', KEY_PREFIX + 'generation:' + team_id)
+        if shared is None:
+            return 0
+        return int(shared) - self._generations.get(team_id, 0)
+
+    def external_generations(self):
+        '''
+        external_generation of every team Redis has a generation for
+        '''
+        prefix = KEY_PREFIX + 'generation:'
+        keys, cursor = [], 0
+        while True:
+            page = self._redis_call('scan', cursor, prefix + '*', 1000)
+            if page is None:
+                return {}
+            cursor, found = page
+            keys.extend(found)
+            if not cursor:
+                break
+        if not keys:
+            return {}
+        values = self._redis_call('mget', keys) or []
+        generations = {}
+        for key, value in zip(keys, values):
+            if value is not None:
+                team_id = key.decode('utf-8')[len(prefix):]
+                generations[team_id] = int(value) - self._generations.get(team_id, 0)
+        return generations
+
+    def bump(self, team_id=''):
+        '''
+        Invalidates every cached result for team_id
+        '''
+        with self._lock:
+            self._generations[team_id] = self._generations.get(team_id, 0) + 1
+            self._stats['bumps'] += 1
+        self._redis_call('incr', KEY_PREFIX + 'generation:' + team_id)
+
+    def get(self, key):
+        '''
+        Returns (hit, value)
+        '''
+        now = time.time()
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._local.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return True, entry[1]
+                del self._local[key]
+
+        shared = self._redis_call('get', self._redis_key(key))
+        if shared is not None:
+            value = pickle.loads(shared)
+            self._store_local(key, value, now)
+            self._stats['shared_hits'] += 1
+            return True, value
+
+        self._stats['misses'] += 1
+        return False, None
+
+    def set(self, key, value):
+        self._store_local(key, value, time.time())
+        self._redis_call('setex', self._redis_key(key), self.ttl, pickle.dumps(value))
+
+    def _store_local(self, key, value, now):
+        with self._lock:
+            self._local[key] = (now + self.ttl, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def _redis_key(self, key):
+        return KEY_PREFIX + 'result:' + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['size'] = len(self._local)
+        lookups = stats['hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['shared_hits']) / lookups if lookups else 0.0
+        return stats
+
+    def fingerprint(self, value):
+        '''
+        Digest of a dict's contents, such as the users and channels
+        directory. Recomputed only when the dict is replaced or changes size.
+        '''
+        with self._lock:
+            cached = self._fingerprints.get(id(value))
+            if cached is not None and cached[0] is value and cached[1] == len(value):
+                return cached[2]
+        digest = hashlib.sha1(repr(sorted(value.items())).encode('utf-8')).hexdigest()
+        with self._lock:
+            self._fingerprints[id(value)] = (value, len(value), digest)
+            while len(self._fingerprints) > FINGERPRINTS_KEPT:
+                self._fingerprints.popitem(last=False)
+        return digest
+
+    def cached(self, name, ignore=(), fingerprint=()):
+        '''
+        Decorator caching func's result by name, its arguments and the write
+        generation of its team_id argument (or '' when it has none). func
+        itself is kept as the wrapper's uncached attribute, which decorators
+        using functools.wraps carry outward.
+
+        Args:
+            name        (str)   : command name, part of the key
+            ignore      (tuple) : argument names left out of the key
+            fingerprint (tuple) : dict arguments keyed by their fingerprint
+        '''
+        def decorator(func):
+            signature = inspect.signature(func)
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                arguments = tuple((arg, self.fingerprint(value) if arg in fingerprint else value)
+                                  for arg, value in bound.arguments.items() if arg not in ignore)
+                team_id = bound.arguments.get('team_id') or ''
+                key = (name, arguments, team_id, self.generation(team_id))
+                hit, value = self.get(key)
+                if hit:
+                    return value
+                value = func(*args, **kwargs)
+                self.set(key, value)
+                return value
+            wrapper.uncached = func
+            return wrapper
+        return decorator
+
+
+results = ResultCache()
+metrics.register('cache', results.stats)
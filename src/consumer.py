@@ -0,0 +1,266 @@
+'''
+Durable event pipeline. The web process appends verified Slack events to
+Redis streams with EventLog and consumer processes read them back with
+EventConsumer. Run the consumers from src/:
+
+    python consumer.py                 # one process per partition
+    python consumer.py --partitions 0,1
+    python consumer.py --stats
+'''
+import os
+import json
+import socket
+import time
+import zlib
+import log
+import metrics
+from multiprocessing import Process
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
+# Events are spread over this many streams by channel, each read by exactly
+# one consumer so events in a channel are handled in order
+EVENT_PARTITIONS = int(os.environ.get('EVENT_PARTITIONS', 4))
+# Streams are trimmed to roughly this many entries
+EVENT_LOG_MAXLEN = int(os.environ.get('EVENT_LOG_MAXLEN', 1000000))
+# Entries read per XREADGROUP and how long it blocks waiting for them
+CONSUMER_BATCH_SIZE = int(os.environ.get('CONSUMER_BATCH_SIZE', 200))
+CONSUMER_BLOCK_MS = int(os.environ.get('CONSUMER_BLOCK_MS', 5000))
+# Unacknowledged entries idle this long are claimed and retried
+CONSUMER_RETRY_IDLE_MS = int(os.environ.get('CONSUMER_RETRY_IDLE_MS', 30000))
+# Entries delivered this many times go to the dead letter stream
+CONSUMER_MAX_DELIVERIES = int(os.environ.get('CONSUMER_MAX_DELIVERIES', 5))
+
+STREAM_PREFIX = 'react_analytics:events:'
+DEAD_LETTER_STREAM = 'react_analytics:events:dead'
+GROUP = 'event-consumers'
+
+DEAD_LETTERS = metrics.counter('events_dead_lettered_total', 'Events moved to the dead letter stream')
+
+
+def partition_key(event_type, event_info):
+    '''
+    Channel of an API event, or the requesting user of a slash command
+    '''
+    event = event_info.get('event', {})
+    if 'item' in event:
+        return event['item'].get('channel', '')
+    channel = event.get('channel')
+    if isinstance(channel, dict):
+        # channel_created and channel_rename carry the whole channel
+        channel = channel.get('id')
+    return channel or event_info.get('user_id') or ''
+
+
+class EventLog(object):
+    '''
+    Append-only log of Slack events in EVENT_PARTITIONS Redis streams
+    '''
+    def __init__(self, redis_url=REDIS_URL, partitions=EVENT_PARTITIONS):
+        self.partitions = partitions
+        self.redis = redis.Redis.from_url(redis_url)
+        self._groups_ready = False
+
+    def stream(self, partition):
+        return STREAM_PREFIX + str(partition)
+
+    def partition_for(self, key):
+        # crc32 rather than hash() so every process agrees
+        return zlib.crc32(key.encode('utf-8')) % self.partitions
+
+    def ensure_groups(self):
+        if self._groups_ready:
+            return
+        for partition in range(self.partitions):
+            try:
+                self.redis.xgroup_create(self.stream(partition), GROUP, id='0', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+        self._groups_ready = True
+
+    def append(self, event_type, event_info):
+        self.ensure_groups()
+        partition = self.partition_for(partition_key(event_type, event_info))
+        return self.redis.xadd(self.stream(partition), encode_event(event_type, event_info),
+                               maxlen=EVENT_LOG_MAXLEN, approximate=True)
+
+    def stats(self):
+        '''
+        Queue depth per partition: entries in the stream, entries not yet
+        delivered to a consumer (lag) and delivered but unacknowledged entries
+        (pending)
+        '''
+        self.ensure_groups()
+        result = {}
+        for partition in range(self.partitions):
+            stream = self.stream(partition)
+            group = [g for g in self.redis.xinfo_groups(stream) if g['name'] in (GROUP, GROUP.encode())][0]
+            lag = group.get('lag')
+            if lag is None:
+                # Redis < 7 does not report lag, count what is past the last delivered ID
+                last = group['last-delivered-id']
+                last = last.decode() if isinstance(last, bytes) else last
+                lag = len(self.redis.xrange(stream, '(' + last, '+', count=10000))
+            result[partition] = {'length': self.redis.xlen(stream),
+                                 'lag': lag,
+                                 'pending': group['pending']}
+        result['dead_letters'] = self.redis.xlen(DEAD_LETTER_STREAM)
+        return result
+
+
+def check_shared_cache():
+    '''
+    Events are written by consumer processes and commands answered by the
+    web process, whose cached results only see the consumers' generation
+    bumps through Redis. Without REDIS_URL they would be served stale for
+    up to ANALYTICS_CACHE_TTL, so this refuses to start instead.
+
+    Raises:
+        RuntimeError: when the result cache isn't shared
+    '''
+    import cache
+    if not cache.results.redis_url:
+        raise RuntimeError('EVENT_CONSUMER=redis needs REDIS_URL set so cached analytics see the consumers\' writes')
+
+
+def encode_event(event_type, event_info):
+    return {'type': event_type, 'event': json.dumps(event_info)}
+
+
+def decode_event(fields):
+    return int(fields[b'type']), json.loads(fields[b'event'])
+
+
+class EventConsumer(object):
+    '''
+    Reads one partition of the EventLog with a blocking XREADGROUP and hands
+    the events to the bot. API events are written as one batch per read and
+    acknowledged only after the batch commits, so nothing is lost if the
+    process dies. Unacknowledged entries are retried after
+    CONSUMER_RETRY_IDLE_MS and dead lettered after CONSUMER_MAX_DELIVERIES.
+
+    Slash commands post their answer to the user, so they are acknowledged
+    before they run and never retried: a command that fails answers at
+    most once rather than once per delivery.
+    '''
+    def __init__(self, bot, event_log, partition, name=None):
+        from bot import Event, EVENT_TYPE_SLASH_COMMAND
+
+        self.Event = Event
+        self.slash_command = EVENT_TYPE_SLASH_COMMAND
+        self.bot = bot
+        self.event_log = event_log
+        self.redis = event_log.redis
+        self.stream = event_log.stream(partition)
+        self.name = name or '%s-%d-%d' % (socket.gethostname(), os.getpid(), partition)
+        self._last_claim = 0
+
+    def run(self):
+        from ingest import EventBatcher
+
+        # No background thread, the consumer flushes after every read
+        self.bot.batcher = EventBatcher(max_items=CONSUMER_BATCH_SIZE)
+        metrics.register('ingest', self.bot.batcher.stats)
+        # No engine or sketches, they would only see this partition's events
+        self.event_log.ensure_groups()
+        log.log_info('Consuming ' + self.stream + ' as ' + self.name)
+        while True:
+            self.poll()
+
+    def poll(self):
+        entries = self.claim_stale()
+        if not entries:
+            response = self.redis.xreadgroup(GROUP, self.name, {self.stream: '>'},
+                                             count=CONSUMER_BATCH_SIZE, block=CONSUMER_BLOCK_MS)
+            entries = response[0][1] if response else []
+        if entries:
+            self.process(entries)
+        return len(entries)
+
+    def claim_stale(self):
+        now = time.time()
+        if now - self._last_claim < CONSUMER_RETRY_IDLE_MS / 1000.0:
+            return []
+        self._last_claim = now
+        pending = self.redis.xpending_range(self.stream, GROUP, min='-', max='+',
+                                            count=CONSUMER_BATCH_SIZE, idle=CONSUMER_RETRY_IDLE_MS)
+        if not pending:
+            return []
+
+        retry = []
+        for entry in pending:
+            if entry['times_delivered'] >= CONSUMER_MAX_DELIVERIES:
+                self.dead_letter(entry['message_id'])
+            else:
+                retry.append(entry['message_id'])
+        if not retry:
+            return []
+        claimed = self.redis.xclaim(self.stream, GROUP, self.name, CONSUMER_RETRY_IDLE_MS, retry)
+        return [entry for entry in claimed if entry[1]]
+
+    def dead_letter(self, entry_id):
+        entries = self.redis.xrange(self.stream, entry_id, entry_id)
+        if entries:
+            fields = dict(entries[0][1])
+            fields[b'stream'] = self.stream
+            fields[b'id'] = entry_id
+            self.redis.xadd(DEAD_LETTER_STREAM, fields)
+        self.redis.xack(self.stream, GROUP, entry_id)
+        DEAD_LETTERS.inc()
+        log.log_error('Dead lettered %s from %s' % (entry_id, self.stream))
+
+    def process(self, entries):
+        handled = []
+        for entry_id, fields in entries:
+            try:
+                event_type, event_info = decode_event(fields)
+                if event_type == self.slash_command:
+                    self.redis.xack(self.stream, GROUP, entry_id)
+                self.bot.handle_event(self.Event(event_type, event_info))
+                if event_type != self.slash_command:
+                    handled.append(entry_id)
+            except Exception as e:
+                # API events are left unacknowledged so they are retried
+                log.log_error('Failed to handle %s: %s' % (entry_id, e))
+
+        try:
+            self.bot.batcher.flush(retry=False)
+        except Exception as e:
+            log.log_error('Failed to write batch from %s: %s' % (self.stream, e))
+            return
+        if handled:
+            self.redis.xack(self.stream, GROUP, *handled)
+
+
+def consume(partition):
+    from bot import Bot
+    check_shared_cache()
+    bot = Bot(start_loop=False)
+    EventConsumer(bot, EventLog(), partition).run()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--partitions', help='comma separated partitions to consume, default all')
+    parser.add_argument('--stats', action='store_true', help='print queue depth and lag and exit')
+    args = parser.parse_args()
+
+    if args.stats:
+        print(json.dumps(EventLog().stats(), indent=2))
+    else:
+        if args.partitions:
+            partitions = [int(p) for p in args.partitions.split(',')]
+        else:
+            partitions = list(range(EVENT_PARTITIONS))
+        processes = [Process(target=consume, args=(partition,)) for partition in partitions]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
@@ -1,9 +1,25 @@
-import traceback
 import os
+import io
+import re
+import sqlite3
+import threading
+import time
 import log
-from functools import wraps
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import nlp
+import cache
+import metrics
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import count
+from functools import wraps, lru_cache
+from collections import namedtuple, Counter
+
+try:
+    import psycopg2
+    from psycopg2.pool import ThreadedConnectionPool
+    from psycopg2.extras import execute_values
+except ImportError:
+    psycopg2 = None
 
 
 CREATE_MESSAGES_TABLE = '''CREATE TABLE IF NOT EXISTS Messages (
@@ -18,96 +34,1301 @@ CREATE_REACTS_TABLE = '''CREATE TABLE IF NOT EXISTS Reacts (
   ReactName    varchar(40),
   FOREIGN KEY (MessageID) REFERENCES Messages (MessageID))
 '''
+
+# Rollups kept up to date by the writers below so analytics can read top-N
+# straight from them. Everything is counted per team and every index leads
+# with TeamID, so a team's reads only touch its own rows. rebuild_rollups
+# recomputes them from Reacts/Messages.
+CREATE_ROLLUP_TABLES = '''
+CREATE TABLE IF NOT EXISTS ReactCounts (
+    TeamID     varchar(40) NOT NULL,
+    ReactName  varchar(40) NOT NULL,
+    Count      integer NOT NULL,
+    PRIMARY KEY (TeamID, ReactName));
+CREATE INDEX IF NOT EXISTS react_counts_count_idx ON ReactCounts (TeamID, Count DESC);
+
+CREATE TABLE IF NOT EXISTS UserReactCounts (
+    TeamID     varchar(40) NOT NULL,
+    UserID     varchar(40) NOT NULL,
+    Count      integer NOT NULL,
+    PRIMARY KEY (TeamID, UserID));
+CREATE INDEX IF NOT EXISTS user_react_counts_count_idx ON UserReactCounts (TeamID, Count DESC);
+
+CREATE TABLE IF NOT EXISTS UserActivity (
+    TeamID     varchar(40) NOT NULL,
+    UserID     varchar(40) NOT NULL,
+    Count      integer NOT NULL,
+    PRIMARY KEY (TeamID, UserID));
+CREATE INDEX IF NOT EXISTS user_activity_count_idx ON UserActivity (TeamID, Count DESC);
+
+CREATE TABLE IF NOT EXISTS MessageReactCounts (
+    MessageID       varchar(40) PRIMARY KEY,
+    TeamID          varchar(40) NOT NULL,
+    Total           integer NOT NULL,
+    DistinctReacts  integer NOT NULL);
+CREATE INDEX IF NOT EXISTS message_react_counts_total_idx ON MessageReactCounts (TeamID, Total DESC);
+CREATE INDEX IF NOT EXISTS message_react_counts_distinct_idx ON MessageReactCounts (TeamID, DistinctReacts DESC);
+'''
+
+# (team, phrase) -> number of times it occurs across the team's messages, see
+# nlp.phrases
+CREATE_PHRASE_TABLE = '''
+CREATE TABLE IF NOT EXISTS PhraseCounts (
+    TeamID     varchar(40) NOT NULL,
+    Phrase     TEXT NOT NULL,
+    Count      integer NOT NULL,
+    PRIMARY KEY (TeamID, Phrase));
+CREATE INDEX IF NOT EXISTS phrase_counts_count_idx ON PhraseCounts (TeamID, Count DESC);
+'''
+
+# (MessageID, token) postings for every distinct token in a message, see
+# nlp.message_tokens. Lets react_buzzword count words with a join.
+CREATE_MESSAGE_WORDS_TABLE = '''
+CREATE TABLE IF NOT EXISTS MessageWords (
+    MessageID  varchar(40),
+    Word       TEXT,
+    PRIMARY KEY (MessageID, Word));
+'''
+
+ROLLUP_TABLES = ['ReactCounts', 'UserReactCounts', 'UserActivity', 'MessageReactCounts']
+
+REBUILD_ROLLUPS = [
+    '''INSERT INTO ReactCounts (TeamID, ReactName, Count)
+    SELECT TeamID, ReactName, COUNT(*) FROM Reacts WHERE ReactName IS NOT NULL GROUP BY TeamID, ReactName''',
+    '''INSERT INTO UserReactCounts (TeamID, UserID, Count)
+    SELECT TeamID, UserID, COUNT(*) FROM Reacts WHERE UserID IS NOT NULL GROUP BY TeamID, UserID''',
+    '''INSERT INTO UserActivity (TeamID, UserID, Count)
+    SELECT TeamID, UserID, COUNT(*) FROM
+    (SELECT TeamID, UserID FROM Messages UNION ALL SELECT TeamID, UserID FROM Reacts) AS t
+    WHERE UserID IS NOT NULL GROUP BY TeamID, UserID''',
+    '''INSERT INTO MessageReactCounts (MessageID, TeamID, Total, DistinctReacts)
+    SELECT Reacts.MessageID, Messages.TeamID, COUNT(*), COUNT(DISTINCT Reacts.ReactName) FROM Reacts
+    INNER JOIN Messages ON Messages.MessageID=Reacts.MessageID GROUP BY Reacts.MessageID, Messages.TeamID''',
+]
+
+# The rollups and phrase counts as migrations 6 and 8 created them, before
+# they were scoped by team
+CREATE_UNSCOPED_ROLLUP_TABLES = '''
+CREATE TABLE IF NOT EXISTS ReactCounts (
+    ReactName  varchar(40) PRIMARY KEY,
+    Count      integer NOT NULL);
+CREATE INDEX IF NOT EXISTS react_counts_count_idx ON ReactCounts (Count DESC);
+
+CREATE TABLE IF NOT EXISTS UserReactCounts (
+    UserID     varchar(40) PRIMARY KEY,
+    Count      integer NOT NULL);
+CREATE INDEX IF NOT EXISTS user_react_counts_count_idx ON UserReactCounts (Count DESC);
+
+CREATE TABLE IF NOT EXISTS UserActivity (
+    UserID     varchar(40) PRIMARY KEY,
+    Count      integer NOT NULL);
+CREATE INDEX IF NOT EXISTS user_activity_count_idx ON UserActivity (Count DESC);
+
+CREATE TABLE IF NOT EXISTS MessageReactCounts (
+    MessageID       varchar(40) PRIMARY KEY,
+    Total           integer NOT NULL,
+    DistinctReacts  integer NOT NULL);
+CREATE INDEX IF NOT EXISTS message_react_counts_total_idx ON MessageReactCounts (Total DESC);
+CREATE INDEX IF NOT EXISTS message_react_counts_distinct_idx ON MessageReactCounts (DistinctReacts DESC);
+'''
+
+REBUILD_UNSCOPED_ROLLUPS = '''
+TRUNCATE ReactCounts, UserReactCounts, UserActivity, MessageReactCounts;
+INSERT INTO ReactCounts
+    SELECT ReactName, COUNT(*) FROM Reacts WHERE ReactName IS NOT NULL GROUP BY ReactName;
+INSERT INTO UserReactCounts
+    SELECT UserID, COUNT(*) FROM Reacts WHERE UserID IS NOT NULL GROUP BY UserID;
+INSERT INTO UserActivity
+    SELECT UserID, COUNT(*) FROM (SELECT UserID FROM Messages UNION ALL SELECT UserID FROM Reacts) AS t
+    WHERE UserID IS NOT NULL GROUP BY UserID;
+INSERT INTO MessageReactCounts
+    SELECT MessageID, COUNT(*), COUNT(DISTINCT ReactName) FROM Reacts GROUP BY MessageID;
+'''
+
+CREATE_UNSCOPED_PHRASE_TABLE = '''
+CREATE TABLE IF NOT EXISTS PhraseCounts (
+    Phrase     TEXT PRIMARY KEY,
+    Count      integer NOT NULL);
+CREATE INDEX IF NOT EXISTS phrase_counts_count_idx ON PhraseCounts (Count DESC);
+'''
+
+# Progress of backfill.py through each channel's history. Messages older than
+# OldestTS and up to NewestTS are loaded, and Done is set once the crawl has
+# reached the start of the channel.
+CREATE_CHECKPOINTS_TABLE = '''CREATE TABLE IF NOT EXISTS BackfillCheckpoints (
+    TeamID     varchar(40) NOT NULL,
+    ChannelID  varchar(40) NOT NULL,
+    OldestTS   varchar(20),
+    NewestTS   varchar(20),
+    Done       BOOLEAN NOT NULL DEFAULT FALSE,
+    UpdatedAt  timestamptz,
+    PRIMARY KEY (TeamID, ChannelID))'''
+
+# sketch.Sketches of each team, saved every SKETCH_SAVE_INTERVAL so the
+# approximate analytics survive restarts. BYTEA has NUMERIC affinity in
+# SQLite, which stores bytes as a BLOB.
+CREATE_SKETCHES_TABLE = '''CREATE TABLE IF NOT EXISTS Sketches (
+    TeamID     varchar(40) PRIMARY KEY,
+    Data       BYTEA NOT NULL,
+    UpdatedAt  timestamptz)'''
+
+# The embedded backend starts from the current schema instead of replaying
+# MIGRATIONS, which are written for Postgres. CreatedAt holds seconds since the
+# epoch, see SQLiteBackend.
+CREATE_SQLITE_TABLES = '''
+CREATE TABLE IF NOT EXISTS Messages (
+    MessageID  varchar(40) PRIMARY KEY,
+    UserID     varchar(40),
+    Text       TEXT,
+    ChannelID  varchar(40),
+    TeamID     varchar(40) NOT NULL DEFAULT '',
+    CreatedAt  timestamptz);
+CREATE INDEX IF NOT EXISTS messages_team_user_id_idx ON Messages (TeamID, UserID);
+CREATE INDEX IF NOT EXISTS messages_team_channel_id_idx ON Messages (TeamID, ChannelID);
+CREATE INDEX IF NOT EXISTS messages_team_created_at_idx ON Messages (TeamID, CreatedAt);
+
+CREATE TABLE IF NOT EXISTS Reacts (
+    MessageID  varchar(40) REFERENCES Messages (MessageID),
+    UserID     varchar(40),
+    ReactName  varchar(40),
+    TeamID     varchar(40) NOT NULL DEFAULT '',
+    CreatedAt  timestamptz,
+    CONSTRAINT reacts_message_user_react_key UNIQUE (MessageID, UserID, ReactName));
+CREATE INDEX IF NOT EXISTS reacts_team_react_name_idx ON Reacts (TeamID, ReactName, MessageID);
+CREATE INDEX IF NOT EXISTS reacts_team_user_id_idx ON Reacts (TeamID, UserID, ReactName);
+CREATE INDEX IF NOT EXISTS reacts_team_created_at_idx ON Reacts (TeamID, CreatedAt);
+'''
+
+# postgresql://... selects Postgres, sqlite:///relative/path.db or
+# sqlite:////absolute/path.db the embedded SQLite backend
 DATABASE_URL = os.environ.get('DATABASE_URL')
+DATABASE_SSLMODE = os.environ.get('DATABASE_SSLMODE', 'require')
+
+# SQLite page cache per connection, and how much of the file is memory mapped
+SQLITE_CACHE_KB = int(os.environ.get('SQLITE_CACHE_KB', 65536))
+SQLITE_MMAP_MB = int(os.environ.get('SQLITE_MMAP_MB', 256))
+# Seconds a connection waits for another process's write to finish
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 10))
+# Prepared statements kept per connection
+SQLITE_STATEMENT_CACHE = int(os.environ.get('SQLITE_STATEMENT_CACHE', 512))
+
+# Rows per statement for multi-row VALUES writes
+VALUES_PAGE_SIZE = 1000
+# Rows fetched per round trip by stream()
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 2000))
+# Messages per transaction when a migration rewrites their derived rows
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', 1000))
+
+# Pool settings are per process, so the total number of connections is
+# DB_POOL_MAX * (gunicorn workers + celery workers)
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 4))
+# Seconds a connection may live before it is closed instead of returned to the pool
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800))
+# Connections idle for longer than this are pinged before being handed out
+DB_POOL_CHECK_IDLE = float(os.environ.get('DB_POOL_CHECK_IDLE', 30))
+
 
 def get_connection():
-    return psycopg2.connect(DATABASE_URL, sslmode='require')
+    return psycopg2.connect(DATABASE_URL, sslmode=DATABASE_SSLMODE)
+
+class ConnectionPool(object):
+    '''
+    Process local pool of long lived connections.
+
+    The pool is rebuilt lazily after a fork so gunicorn/celery children never
+    share sockets with their parent. Connections are pinged when they have been
+    idle for a while and recycled once they reach max_lifetime.
+    '''
+    def __init__(self, minconn, maxconn, max_lifetime, check_idle):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_lifetime = max_lifetime
+        self.check_idle = check_idle
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        # Anything inherited from the parent process is dropped without being
+        # closed; closing would terminate the parent's sessions
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._pool = None
+        self._created = {}
+        self._last_used = {}
+
+    def _get_pool(self):
+        if self._pid != os.getpid():
+            self._reset()
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadedConnectionPool(self.minconn, self.maxconn, DATABASE_URL,
+                                                        sslmode=DATABASE_SSLMODE)
+        return self._pool
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        now = time.time()
+        if now - self._created.setdefault(id(conn), now) > self.max_lifetime:
+            return False
+        if now - self._last_used.get(id(conn), now) < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        pool = self._get_pool()
+        self._slots.acquire()
+        try:
+            while True:
+                conn = pool.getconn()
+                if self._healthy(conn):
+                    return conn
+                self._discard(pool, conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        pool = self._get_pool()
+        try:
+            if close or conn.closed or time.time() - self._created.get(id(conn), 0) > self.max_lifetime:
+                self._discard(pool, conn)
+            else:
+                self._last_used[id(conn)] = time.time()
+                pool.putconn(conn)
+        finally:
+            self._slots.release()
+
+    def _discard(self, pool, conn):
+        self._created.pop(id(conn), None)
+        self._last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def closeall(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.closeall()
+        self._reset()
+
+
+SCHEMA_VERSION_TABLE = '''CREATE TABLE IF NOT EXISTS SchemaVersion (
+    Version      integer PRIMARY KEY,
+    Description  TEXT,
+    AppliedAt    timestamptz DEFAULT now())
+'''
+
+# Key for pg_advisory_lock so only one process runs migrations at a time
+MIGRATION_LOCK_ID = 72657163
+
+# Keeps the first of any identical reacts so the unique index can be built
+DEDUPE_REACTS = '''DELETE FROM Reacts a USING Reacts b
+    WHERE a.ctid > b.ctid AND a.MessageID = b.MessageID
+    AND a.UserID = b.UserID AND a.ReactName = b.ReactName
+'''
+
+ADD_REACTS_UNIQUE = '''DO $$ BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'reacts_message_user_react_key') THEN
+        ALTER TABLE Reacts ADD CONSTRAINT reacts_message_user_react_key
+            UNIQUE USING INDEX reacts_message_user_react_key;
+    END IF;
+END $$
+'''
+
+
+# statements are SQL strings or callables taking a cursor. Migrations marked
+# concurrent run outside a transaction, which CREATE INDEX CONCURRENTLY needs,
+# so each of their statements has to be safe to re-run. SQLite files get their
+# tables as they are now, so only run the sqlite statements of the migrations
+# made since the file was created, for changes to the data itself.
+Migration = namedtuple('Migration', ['version', 'description', 'statements', 'concurrent', 'sqlite'],
+                       defaults=[()])
+
 
-def create_tables(conn):
+def concurrent_index(name, definition, unique=False):
+    '''
+    Builds an index without blocking writes. name has to be lowercase.
+    '''
+    def build(cursor):
+        # An interrupted concurrent build leaves an INVALID index behind that
+        # IF NOT EXISTS would happily skip
+        cursor.execute('''SELECT 1 FROM pg_class JOIN pg_index ON pg_index.indexrelid = pg_class.oid
+                          WHERE pg_class.relname = %s AND NOT pg_index.indisvalid''', (name,))
+        if cursor.fetchone():
+            cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS ' + name)
+        cursor.execute('CREATE %sINDEX CONCURRENTLY IF NOT EXISTS %s ON %s'
+                       % ('UNIQUE ' if unique else '', name, definition))
+    return build
+
+
+def _primary_key(cursor, table):
+    cursor.execute('''SELECT pg_attribute.attname FROM pg_index JOIN pg_attribute
+                      ON pg_attribute.attrelid = pg_index.indrelid AND pg_attribute.attnum = ANY(pg_index.indkey)
+                      WHERE pg_index.indrelid = %s::regclass AND pg_index.indisprimary''', (table.lower(),))
+    return {row[0] for row in cursor.fetchall()}
+
+
+def _index_definition(cursor, name):
+    cursor.execute('SELECT indexdef FROM pg_indexes WHERE indexname = %s', (name,))
+    row = cursor.fetchone()
+    return row[0].lower() if row else ''
+
+
+def scope_by_team(table, key, indexes):
+    '''
+    Adds TeamID to a rollup table from migration 6 or 8, and leads its
+    primary key (key) and indexes ([(name, columns)]) with it. The rows
+    already there count for team '', the column's default, so nothing is
+    recounted. Every step is a short lock or a concurrent index build, and is
+    skipped once done.
+    '''
+    def scope(cursor):
+        cursor.execute("ALTER TABLE %s ADD COLUMN IF NOT EXISTS TeamID varchar(40) NOT NULL DEFAULT ''" % table)
+        if key and _primary_key(cursor, table) == {key.lower()}:
+            pkey, index = table.lower() + '_pkey', table.lower() + '_team_pkey'
+            concurrent_index(index, '%s (TeamID, %s)' % (table, key), unique=True)(cursor)
+            # The index takes the constraint's name
+            cursor.execute('ALTER TABLE %s DROP CONSTRAINT %s, ADD CONSTRAINT %s PRIMARY KEY USING INDEX %s'
+                           % (table, pkey, pkey, index))
+        for name, columns in indexes:
+            if 'teamid' not in _index_definition(cursor, name):
+                cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS ' + name)
+                concurrent_index(name, '%s (%s)' % (table, columns))(cursor)
+    return scope
+
+
+def backfill_channel_ids(cursor):
+    # MessageID is the channel ID followed by a Slack ts (10 digits, a dot and
+    # 6 digits). Updated in small batches so no long transaction holds row locks.
+    while True:
+        cursor.execute('''UPDATE Messages SET ChannelID = regexp_replace(MessageID, '[0-9]{10}\\.[0-9]{6}$', '')
+                          WHERE MessageID IN (SELECT MessageID FROM Messages WHERE ChannelID IS NULL LIMIT 5000)''')
+        if cursor.rowcount == 0:
+            break
+
+
+def backfill_created_at(cursor):
+    # Messages take the ts in their MessageID (see backfill_channel_ids). When
+    # a react was left was never stored, so old reacts get their message's time.
+    while True:
+        cursor.execute('''UPDATE Messages SET CreatedAt = to_timestamp(substring(MessageID FROM '[0-9]{10}\\.[0-9]{6}$')::numeric)
+                          WHERE MessageID IN (SELECT MessageID FROM Messages WHERE CreatedAt IS NULL
+                                              AND MessageID ~ '[0-9]{10}\\.[0-9]{6}$' LIMIT 5000)''')
+        if cursor.rowcount == 0:
+            break
+    while True:
+        cursor.execute('''UPDATE Reacts SET CreatedAt = Messages.CreatedAt FROM Messages
+                          WHERE Reacts.MessageID = Messages.MessageID AND Reacts.ctid IN
+                          (SELECT Reacts.ctid FROM Reacts JOIN Messages ON Messages.MessageID = Reacts.MessageID
+                           WHERE Reacts.CreatedAt IS NULL AND Messages.CreatedAt IS NOT NULL LIMIT 5000)''')
+        if cursor.rowcount == 0:
+            break
+
+
+def rebuild_rollup_tables(cursor):
+    backend.truncate(cursor, ROLLUP_TABLES)
+    for statement in REBUILD_ROLLUPS:
+        cursor.execute(statement)
+
+
+def rebuild_phrase_counts(cursor):
+    backend.truncate(cursor, ['PhraseCounts'])
+    texts = backend.stream_cursor(cursor.connection, 'rebuild_phrase_counts')
+    texts.execute('SELECT TeamID, Text FROM Messages')
+    while True:
+        rows = texts.fetchmany(STREAM_BATCH_SIZE)
+        if not rows:
+            break
+        _bump(cursor, 'PhraseCounts', ('TeamID', 'Phrase'),
+              Counter((team, p) for team, text in rows for p in nlp.phrases(text)))
+    texts.close()
+
+
+def rebuild_unscoped_phrase_counts(cursor):
+    cursor.execute('TRUNCATE PhraseCounts')
+    texts = cursor.connection.cursor(name='rebuild_phrase_counts')
+    texts.execute('SELECT Text FROM Messages')
+    while True:
+        rows = texts.fetchmany(STREAM_BATCH_SIZE)
+        if not rows:
+            break
+        _bump(cursor, 'PhraseCounts', ('Phrase',), Counter((p,) for (text,) in rows for p in nlp.phrases(text)))
+    texts.close()
+
+
+def rebuild_message_words(cursor):
+    backend.truncate(cursor, ['MessageWords'])
+    texts = backend.stream_cursor(cursor.connection, 'rebuild_message_words')
+    texts.execute('SELECT MessageID, Text FROM Messages')
+    while True:
+        rows = texts.fetchmany(STREAM_BATCH_SIZE)
+        if not rows:
+            break
+        _insert_message_words(cursor, rows)
+    texts.close()
+
+
+def reindex_message_words(cursor):
+    '''
+    Rewrites the word postings MIGRATION_BATCH_SIZE messages at a time, each
+    batch in its own short transaction, so writers only ever wait for one
+    batch. Messages written meanwhile are indexed by the writers themselves.
+    '''
+    last = ''
+    while True:
+        cursor.execute(backend.begin)
+        try:
+            # Locked until the batch commits, so a delete can't leave postings behind
+            cursor.execute('SELECT MessageID, Text FROM Messages WHERE MessageID > %s ORDER BY MessageID LIMIT %s'
+                           + backend.lock_rows, (last, MIGRATION_BATCH_SIZE))
+            rows = cursor.fetchall()
+            if rows:
+                cursor.execute('DELETE FROM MessageWords WHERE MessageID > %s AND MessageID <= %s',
+                               (last, rows[-1][0]))
+                _insert_message_words(cursor, rows)
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        if len(rows) < MIGRATION_BATCH_SIZE:
+            break
+        last = rows[-1][0]
+
+
+def retag_message_react_counts(cursor):
+    # Rows used to take the lowest TeamID among a message's reacts. Only
+    # messages in shared channels differ, fixed a batch per statement.
+    while True:
+        cursor.execute('''UPDATE MessageReactCounts
+                          SET TeamID = (SELECT TeamID FROM Messages WHERE Messages.MessageID = MessageReactCounts.MessageID)
+                          WHERE MessageID IN (SELECT MessageReactCounts.MessageID FROM MessageReactCounts
+                          INNER JOIN Messages ON Messages.MessageID = MessageReactCounts.MessageID
+                          WHERE MessageReactCounts.TeamID <> Messages.TeamID LIMIT %s)''', (MIGRATION_BATCH_SIZE,))
+        if cursor.rowcount == 0:
+            break
+
+
+MIGRATIONS = [
+    Migration(1, 'Create Messages and Reacts',
+              [CREATE_MESSAGES_TABLE, CREATE_REACTS_TABLE], False),
+    # MESSAGES_WITH_REACT filters on ReactName and joins on MessageID
+    Migration(2, 'Index Reacts by ReactName',
+              [concurrent_index('reacts_react_name_idx', 'Reacts (ReactName, MessageID)')], True),
+    # REACTS_BY_USER filters on UserID, REACT_TOTALS groups by it
+    Migration(3, 'Index Reacts by UserID',
+              [concurrent_index('reacts_user_id_idx', 'Reacts (UserID, ReactName)')], True),
+    # ACTIVITY_TOTALS groups Messages by UserID
+    Migration(4, 'Index Messages by UserID',
+              [concurrent_index('messages_user_id_idx', 'Messages (UserID)')], True),
+    # Also serves remove_react and every join on Reacts.MessageID
+    Migration(5, 'Make (MessageID, UserID, ReactName) unique in Reacts',
+              [DEDUPE_REACTS,
+               concurrent_index('reacts_message_user_react_key', 'Reacts (MessageID, UserID, ReactName)', unique=True),
+               ADD_REACTS_UNIQUE], True),
+    # Migration 10 scopes the rollups and phrase counts by team
+    Migration(6, 'Add rollup tables',
+              [CREATE_UNSCOPED_ROLLUP_TABLES, REBUILD_UNSCOPED_ROLLUPS], False),
+    # For the per-channel filters in analytics. The channel used to only be
+    # available as the prefix of MessageID.
+    Migration(7, 'Add Messages.ChannelID',
+              ['ALTER TABLE Messages ADD COLUMN IF NOT EXISTS ChannelID varchar(40)',
+               backfill_channel_ids,
+               concurrent_index('messages_channel_id_idx', 'Messages (ChannelID)')], True),
+    Migration(8, 'Add phrase counts',
+              [CREATE_UNSCOPED_PHRASE_TABLE, rebuild_unscoped_phrase_counts], False),
+    Migration(9, 'Add message word index',
+              [CREATE_MESSAGE_WORDS_TABLE, rebuild_message_words], False),
+    # Rows written before this belong to team ''. A constant default doesn't
+    # rewrite the tables, and the rollups already hold team ''s counts.
+    Migration(10, 'Add TeamID and scope rollups by team',
+              ["ALTER TABLE Messages ADD COLUMN IF NOT EXISTS TeamID varchar(40) NOT NULL DEFAULT ''",
+               "ALTER TABLE Reacts ADD COLUMN IF NOT EXISTS TeamID varchar(40) NOT NULL DEFAULT ''",
+               scope_by_team('ReactCounts', 'ReactName', [('react_counts_count_idx', 'TeamID, Count DESC')]),
+               scope_by_team('UserReactCounts', 'UserID', [('user_react_counts_count_idx', 'TeamID, Count DESC')]),
+               scope_by_team('UserActivity', 'UserID', [('user_activity_count_idx', 'TeamID, Count DESC')]),
+               scope_by_team('MessageReactCounts', None,
+                             [('message_react_counts_total_idx', 'TeamID, Total DESC'),
+                              ('message_react_counts_distinct_idx', 'TeamID, DistinctReacts DESC')]),
+               scope_by_team('PhraseCounts', 'Phrase', [('phrase_counts_count_idx', 'TeamID, Count DESC')])],
+              True),
+    # Every analytics query filters on TeamID first. These replace the
+    # indexes from migrations 2, 3, 4 and 7.
+    Migration(11, 'Lead Reacts and Messages indexes with TeamID',
+              [concurrent_index('reacts_team_react_name_idx', 'Reacts (TeamID, ReactName, MessageID)'),
+               concurrent_index('reacts_team_user_id_idx', 'Reacts (TeamID, UserID, ReactName)'),
+               concurrent_index('messages_team_user_id_idx', 'Messages (TeamID, UserID)'),
+               concurrent_index('messages_team_channel_id_idx', 'Messages (TeamID, ChannelID)'),
+               'DROP INDEX CONCURRENTLY IF EXISTS reacts_react_name_idx',
+               'DROP INDEX CONCURRENTLY IF EXISTS reacts_user_id_idx',
+               'DROP INDEX CONCURRENTLY IF EXISTS messages_user_id_idx',
+               'DROP INDEX CONCURRENTLY IF EXISTS messages_channel_id_idx'], True),
+    # For the windowed analytics, which read a team's recent rows with a
+    # range scan on these indexes rather than the all time rollups
+    Migration(12, 'Add Messages.CreatedAt and Reacts.CreatedAt',
+              ['ALTER TABLE Messages ADD COLUMN IF NOT EXISTS CreatedAt timestamptz',
+               'ALTER TABLE Reacts ADD COLUMN IF NOT EXISTS CreatedAt timestamptz',
+               backfill_created_at,
+               concurrent_index('messages_team_created_at_idx', 'Messages (TeamID, CreatedAt)'),
+               concurrent_index('reacts_team_created_at_idx', 'Reacts (TeamID, CreatedAt)')], True),
+    Migration(13, 'Add backfill checkpoints', [CREATE_CHECKPOINTS_TABLE], False),
+    Migration(14, 'Add sketches', [CREATE_SKETCHES_TABLE], False),
+    # Mentions used to be indexed lowercased without their <@ >, so
+    # react_buzzword couldn't resolve them to names
+    Migration(15, 'Reindex message words with mentions', [reindex_message_words], True,
+              [reindex_message_words]),
+    # Most reacted to and most unique are about a team's own messages
+    Migration(16, "Count MessageReactCounts towards the message's team", [retag_message_react_counts], True,
+              [retag_message_react_counts]),
+]
+
+
+def _run_statement(cursor, statement):
+    if callable(statement):
+        statement(cursor)
+    else:
+        cursor.execute(statement)
+
+
+def migrate():
+    '''
+    Applies any migrations in MIGRATIONS that are not recorded in SchemaVersion.
+    '''
+    conn = get_connection()
+    conn.autocommit = True
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor
-        cursor.execute(CREATE_MESSAGES_TABLE)
-        cursor.execute(CREATE_REACTS_TABLE)
-    except Exception as e:
-        pass
+        cursor.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_ID,))
+        cursor.execute(SCHEMA_VERSION_TABLE)
+        cursor.execute('SELECT Version FROM SchemaVersion')
+        applied = {row[0] for row in cursor.fetchall()}
+
+        for migration in MIGRATIONS:
+            if migration.version in applied:
+                continue
+            log.log_info('Applying migration %d: %s' % (migration.version, migration.description))
+            conn.autocommit = migration.concurrent
+            try:
+                for statement in migration.statements:
+                    _run_statement(cursor, statement)
+                cursor.execute('INSERT INTO SchemaVersion (Version, Description) VALUES (%s, %s)',
+                               (migration.version, migration.description))
+                if not migration.concurrent:
+                    conn.commit()
+            except Exception:
+                if not migration.concurrent:
+                    conn.rollback()
+                raise
+            finally:
+                conn.autocommit = True
     finally:
-        conn.commit()
+        try:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK_ID,))
+        finally:
+            conn.close()
+
+
+# Backends. Everything above MIGRATIONS and all of analytics is written in the
+# SQL that Postgres and SQLite share: %s parameters, CTEs instead of VALUES
+# aliases or USING, ON CONFLICT and RETURNING (SQLite 3.35+). What differs is
+# kept to the methods below: connections and transactions, parameter style,
+# multi-row VALUES, server side cursors, TRUNCATE, how LIMIT is lifted and
+# planner hints, and whether GROUP BY hashes or sorts.
+
+class PostgresBackend(object):
+    '''
+    Postgres through a process local ConnectionPool, brought up to date by
+    migrate
+    '''
+    name = 'postgres'
+    # LIMIT argument meaning no limit
+    no_limit = None
+    # GROUP BY hashes, so one over many keys costs about the sum of one per key
+    hash_aggregate = True
+    # Explicit transactions in autocommit migrations, and locking the rows read
+    begin = 'BEGIN'
+    lock_rows = ' FOR SHARE'
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def init(self):
+        if psycopg2 is None:
+            raise RuntimeError('psycopg2 is needed for ' + DATABASE_URL)
+        migrate()
+
+    def connection(self):
+        return self.pool.connection()
+
+    def cursor(self, conn):
+        return conn.cursor()
+
+    def stream_cursor(self, conn, name):
+        # Server side, so only the current batch is held in memory
+        return conn.cursor(name=name)
+
+    def execute_values(self, cursor, sql, rows, fetch=False):
+        '''
+        Runs sql, which has one VALUES %s, with rows expanded into it
+        VALUES_PAGE_SIZE at a time. Returns the rows of every page with fetch.
+        '''
+        return execute_values(cursor, sql, rows, page_size=VALUES_PAGE_SIZE, fetch=fetch)
+
+    def truncate(self, cursor, tables):
+        cursor.execute('TRUNCATE ' + ', '.join(tables))
+
+    def stage(self, cursor, table, columns, rows):
+        '''
+        Creates the temporary table (columns is its column list) for this
+        transaction and loads rows into it with one COPY
+        '''
+        cursor.execute('CREATE TEMP TABLE %s (%s) ON COMMIT DROP' % (table, columns))
+        data = io.StringIO()
+        for row in rows:
+            data.write('\t'.join([_copy_field(value) for value in row]))
+            data.write('\n')
+        data.seek(0)
+        cursor.copy_expert('COPY %s FROM STDIN' % table, data)
+
+    def range_condition(self, condition):
+        '''
+        condition, a range test such as a window's start, as the planner should
+        see it
+        '''
+        return condition
+
+
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def _copy_field(value):
+    '''
+    value in COPY's text format
+    '''
+    if value is None:
+        return '\\N'
+    return str(value).translate(COPY_ESCAPES)
+
+
+@lru_cache(maxsize=1024)
+def qmark(sql):
+    '''
+    Rewrites psycopg2's %s parameters (and %% escapes) in sql for sqlite3
+    '''
+    return re.sub('%([s%])', lambda m: '?' if m.group(1) == 's' else '%', sql)
+
+
+class SQLiteCursor(sqlite3.Cursor):
+    '''
+    sqlite3 cursor taking the same SQL and parameters as a psycopg2 one
+    '''
+    def execute(self, sql, args=None):
+        return super(SQLiteCursor, self).execute(qmark(sql), args or ())
+
+
+class SQLiteBackend(object):
+    '''
+    Embedded SQLite database for single node installs, no server needed.
+
+    Every thread keeps its own connection, reopened after a fork. The file is
+    in WAL mode so readers never wait for the writer, and writers from other
+    threads or processes wait up to SQLITE_BUSY_TIMEOUT for each other.
+    sqlite3 keeps each connection's last SQLITE_STATEMENT_CACHE statements
+    prepared, and the SQL for full VALUES pages repeats, so the writers mostly
+    reuse prepared statements. Timestamps are stored as seconds since the epoch.
+    '''
+    name = 'sqlite'
+    no_limit = -1
+    # GROUP BY sorts, which is cheaper a few groups at a time
+    hash_aggregate = False
+    # Takes the write lock up front, which keeps every row as it was read
+    begin = 'BEGIN IMMEDIATE'
+    lock_rows = ''
+
+    PRAGMAS = ['journal_mode = WAL',
+               # Commits survive the process crashing but not the machine losing
+               # power, the usual trade off with WAL
+               'synchronous = NORMAL',
+               'foreign_keys = ON',
+               'temp_store = MEMORY',
+               'cache_size = -%d' % SQLITE_CACHE_KB,
+               'mmap_size = %d' % (SQLITE_MMAP_MB * 1024 * 1024)]
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        sqlite3.register_adapter(datetime, lambda d: d.timestamp())
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None,
+                               check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE)
+        for pragma in self.PRAGMAS:
+            conn.execute('PRAGMA ' + pragma)
+        return conn
+
+    def init(self):
+        conn = self._connect()
+        try:
+            # 0 for a new file
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            conn.executescript('BEGIN IMMEDIATE;' + CREATE_SQLITE_TABLES + CREATE_ROLLUP_TABLES
+                               + CREATE_PHRASE_TABLE + CREATE_MESSAGE_WORDS_TABLE + ';'
+                               + CREATE_CHECKPOINTS_TABLE + ';' + CREATE_SKETCHES_TABLE + ';COMMIT;')
+            cursor = self.cursor(conn)
+            for migration in MIGRATIONS:
+                if not version or migration.version <= version:
+                    continue
+                if migration.sqlite:
+                    log.log_info('Applying migration %d: %s' % (migration.version, migration.description))
+                for statement in migration.sqlite:
+                    _run_statement(cursor, statement)
+                conn.execute('PRAGMA user_version = %d' % migration.version)
+            conn.execute('PRAGMA user_version = %d' % MIGRATIONS[-1].version)
+        finally:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.pid, local.conn, local.depth = os.getpid(), self._connect(), 0
+        conn = local.conn
+        # A query run while a stream() from the same thread is being read
+        # shares its transaction
+        outer = local.depth == 0
+        if outer:
+            conn.execute('BEGIN')
+        local.depth += 1
+        try:
+            yield conn
+            if outer:
+                conn.commit()
+        except BaseException:
+            if outer and conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            local.depth -= 1
+
+    def cursor(self, conn):
+        return conn.cursor(SQLiteCursor)
+
+    def stream_cursor(self, conn, name):
+        # sqlite3 already steps through results as they are fetched
+        return self.cursor(conn)
+
+    def execute_values(self, cursor, sql, rows, fetch=False):
+        rows = list(rows)
+        result = []
+        for start in range(0, len(rows), VALUES_PAGE_SIZE):
+            page = rows[start:start + VALUES_PAGE_SIZE]
+            row = '(' + ', '.join(['%s'] * len(page[0])) + ')'
+            cursor.execute(sql.replace('%s', ', '.join([row] * len(page)), 1),
+                           [value for r in page for value in r])
+            if fetch:
+                result.extend(cursor.fetchall())
+        return result if fetch else None
+
+    def truncate(self, cursor, tables):
+        for table in tables:
+            cursor.execute('DELETE FROM ' + table)
+
+    def stage(self, cursor, table, columns, rows):
+        # No COPY, but executemany runs one prepared insert for every row.
+        # Temporary tables last as long as the connection, so it is emptied
+        # instead of dropped.
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS %s (%s)' % (table, columns))
+        cursor.execute('DELETE FROM ' + table)
+        if rows:
+            cursor.executemany('INSERT INTO %s VALUES (%s)' % (table, ', '.join(['?'] * len(rows[0]))), rows)
+
+    def range_condition(self, condition):
+        # Without STAT4 statistics SQLite guesses a range keeps a quarter of the
+        # rows, and after ANALYZE prefers an index that saves a sort over the
+        # (TeamID, CreatedAt) range scan. Windows are usually a small part of
+        # a team's history.
+        return 'likelihood(%s, 0.05)' % condition
+
+
+def get_backend(url=DATABASE_URL):
+    if url and url.startswith('sqlite:'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    return PostgresBackend(ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_MAX_LIFETIME, DB_POOL_CHECK_IDLE))
+
+
+backend = get_backend()
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+def use(url):
+    '''
+    Switches to the database at url, for tools that take it as an argument
+    '''
+    global DATABASE_URL, backend, _schema_ready
+    with _schema_lock:
+        DATABASE_URL = url
+        backend = get_backend(url)
+        _schema_ready = False
+
+def init_db():
+    '''
+    Brings the schema up to date. Called once at startup rather than on every query.
+    '''
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        backend.init()
+        _schema_ready = True
+
+CALL_SECONDS = metrics.histogram('db_call_seconds', 'Latency of db functions, including the connection checkout',
+                                 ('function',))
+QUERY_SECONDS = metrics.histogram('db_query_seconds', 'Latency of the queries run with execute and stream',
+                                  ('statement',))
+# Tables a statement reads or writes, and the names its WITH clause defines
+STATEMENT_TABLES = re.compile(r'\b(?:FROM|JOIN|INTO|UPDATE)\s+(?!SET\b)([A-Za-z_]\w*)', re.IGNORECASE)
+CTE_NAMES = re.compile(r'(?:\bWITH|,)\s*([A-Za-z_]\w*)\s*(?:\([^()]*\))?\s+AS\s*\(', re.IGNORECASE)
+WRITE_VERBS = re.compile(r'\b(INSERT|DELETE|UPDATE)\b', re.IGNORECASE)
+
+@lru_cache(maxsize=1024)
+def statement_name(query):
+    '''
+    Label for query in db_query_seconds: its verb and the tables it touches,
+    e.g. 'SELECT Reacts MessageWords'. Built from the SQL rather than being
+    the SQL, so statements generated per call (IN lists, a UNION ALL part
+    per react) share a label and the number of labels stays bounded.
+    '''
+    write = WRITE_VERBS.search(query)
+    verb = write.group(1) if write else query.split(None, 1)[0]
+    ctes = {name.lower() for name in CTE_NAMES.findall(query)}
+    tables = []
+    for table in STATEMENT_TABLES.findall(query):
+        if table.lower() not in ctes and table not in tables:
+            tables.append(table)
+    return ' '.join([verb.upper()] + tables)
 
 def psycopg2_cur(func):
     '''
     DB connection handler
     '''
+    timer = CALL_SECONDS.timed(func.__name__)
+
     @wraps(func)
     def wrapper(*args, **kwargs):
+        if not _schema_ready:
+            init_db()
+        with backend.connection() as conn:
+            cursor = backend.cursor(conn)
+            try:
+                return func(cursor, *args, **kwargs)
+            finally:
+                cursor.close()
+    return timer(wrapper)
+
+
+
+def _bump(cursor, table, key, counts):
+    '''
+    Adds counts ({key values: delta}) to a rollup table. key is the tuple of
+    columns making up the table's primary key.
+    '''
+    # Sorted so concurrent batches lock rollup rows in the same order
+    rows = sorted(k + (v,) for k, v in counts.items() if None not in k and v)
+    if not rows:
+        return
+    backend.execute_values(cursor, '''INSERT INTO {table} ({key}, Count) VALUES %s
+                    ON CONFLICT ({key}) DO UPDATE SET Count = {table}.Count + EXCLUDED.Count
+                    '''.format(table=table, key=', '.join(key)), rows)
+
+
+def _apply_react_deltas(cursor, rows, sign):
+    '''
+    Updates the rollups for (MessageID, TeamID, UserID, ReactName, CreatedAt)
+    rows that were just inserted (sign=1) or deleted (sign=-1)
+    '''
+    if not rows:
+        return
+    pending = _recording()
+    if pending is not None:
+        # Before _delete_messages drops the words of the reacted messages
+        pending.append(('reacts', sign, [(r[0], r[1], r[3]) for r in rows],
+                        _message_words(cursor, {r[0] for r in rows})))
+    events = _engine_events()
+    if events is not None:
+        events.append(('reacts', sign, rows))
+    _bump(cursor, 'ReactCounts', ('TeamID', 'ReactName'),
+          {k: sign * v for k, v in Counter((r[1], r[3]) for r in rows).items()})
+    users = Counter((r[1], r[2]) for r in rows)
+    _bump(cursor, 'UserReactCounts', ('TeamID', 'UserID'), {k: sign * v for k, v in users.items()})
+    _bump(cursor, 'UserActivity', ('TeamID', 'UserID'), {k: sign * v for k, v in users.items()})
+
+    # A react name is new to a message when every row for it was just inserted,
+    # and gone from it when no rows are left
+    changed = Counter((r[0], r[3]) for r in rows)
+    remaining = backend.execute_values(cursor, '''WITH v (MessageID, ReactName) AS (VALUES %s)
+                    SELECT v.MessageID, v.ReactName,
+                    (SELECT COUNT(*) FROM Reacts WHERE Reacts.ReactName = v.ReactName
+                     AND Reacts.MessageID = v.MessageID),
+                    (SELECT TeamID FROM Messages WHERE Messages.MessageID = v.MessageID)
+                    FROM v''', sorted(changed), fetch=True)
+    distinct = Counter()
+    teams = {}
+    for msg_id, name, n, team in remaining:
+        if (sign > 0 and n == changed[(msg_id, name)]) or (sign < 0 and n == 0):
+            distinct[msg_id] += sign
+        teams[msg_id] = team
+
+    # Reacts on a message in a channel shared between workspaces arrive with
+    # each one's TeamID. They all count towards the message's own team, one
+    # row per message. Reacts reference Messages, so the message is there.
+    totals = Counter(r[0] for r in rows)
+    deltas = sorted((msg_id, teams[msg_id], sign * total, distinct[msg_id])
+                    for msg_id, total in totals.items())
+    backend.execute_values(cursor, '''INSERT INTO MessageReactCounts (MessageID, TeamID, Total, DistinctReacts) VALUES %s
+                    ON CONFLICT (MessageID) DO UPDATE SET
+                    Total = MessageReactCounts.Total + EXCLUDED.Total,
+                    DistinctReacts = MessageReactCounts.DistinctReacts + EXCLUDED.DistinctReacts
+                    ''', deltas)
+
+
+def _insert_message_words(cursor, rows):
+    '''
+    Writes the word postings for (MessageID, Text) rows
+    '''
+    postings = [(msg_id, token) for msg_id, text in rows for token in nlp.indexed_tokens(text)]
+    if postings:
+        backend.execute_values(cursor, 'INSERT INTO MessageWords (MessageID, Word) VALUES %s ON CONFLICT DO NOTHING',
+                               postings)
+
+
+# sketch.Sketches fed the rows each write changes, set by the bot when
+# ANALYTICS_SKETCHES is on. The writers below record the changes while their
+# transaction runs and they are applied once it has committed, so a batch
+# that fails and is retried isn't counted twice.
+sketches = None
+_changes = threading.local()
+
+# engine.Engine kept current the same way, set by the bot when
+# ANALYTICS_ENGINE is enabled. It is given the rows as the writers return them.
+engine = None
+
+def _recording():
+    '''
+    The list of sketch changes of the write running in this thread, or None
+    '''
+    return getattr(_changes, 'pending', None)
+
+
+def _engine_events():
+    '''
+    The list of engine events of the write running in this thread, or None
+    '''
+    return getattr(_changes, 'events', None)
+
+
+def _message_words(cursor, msg_ids):
+    '''
+    Returns {MessageID: [words]} from the MessageWords index
+    '''
+    words = {}
+    rows = backend.execute_values(cursor, '''WITH v (MessageID) AS (VALUES %s)
+                    SELECT MessageID, Word FROM MessageWords WHERE MessageID IN (SELECT MessageID FROM v)''',
+                    sorted((msg_id,) for msg_id in msg_ids), fetch=True)
+    for msg_id, word in rows:
+        words.setdefault(msg_id, []).append(word)
+    return words
+
+
+def bumps_generation(func):
+    '''
+    Invalidates cached analytics results once func's transaction has committed,
+    after passing what it changed to the sketches and the engine. func returns
+    the set of teams whose data it changed.
+    '''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        _changes.pending = [] if sketches is not None else None
+        _changes.events = [] if engine is not None else None
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            create_tables(conn)
-            ret_val = func(cursor, *args, **kwargs)
+            teams = func(*args, **kwargs)
+            changes, events = _changes.pending, _changes.events
         finally:
-            conn.commit()
-            conn.close()
-        return ret_val
+            _changes.pending = _changes.events = None
+        if changes:
+            sketches.apply(changes)
+        if events:
+            engine.apply(events)
+        for team_id in teams or ():
+            cache.results.bump(team_id)
+        return teams
     return wrapper
 
 
+# Set based writers shared by the single event functions below and by
+# ingest.EventBatcher. Each takes a list so a whole batch is one statement,
+# keeps the rollups current in the same transaction and returns the set of
+# teams whose rows changed.
+
+def _delete_messages(cursor, msg_ids):
+    if not msg_ids:
+        return set()
+    rows = [(msg_id,) for msg_id in msg_ids]
+    # Reacts reference Messages, so they have to go first
+    _apply_react_deltas(cursor, backend.execute_values(cursor, '''WITH v (MessageID) AS (VALUES %s)
+                    DELETE FROM Reacts WHERE MessageID IN (SELECT MessageID FROM v)
+                    RETURNING MessageID, TeamID, UserID, ReactName, CreatedAt''', rows, fetch=True), -1)
+    deleted = backend.execute_values(cursor, '''WITH v (MessageID) AS (VALUES %s)
+                    DELETE FROM Messages WHERE MessageID IN (SELECT MessageID FROM v)
+                    RETURNING TeamID, UserID, Text, MessageID''', rows, fetch=True)
+    pending = _recording()
+    if pending is not None and deleted:
+        pending.append(('messages', -1, [(r[3], r[0], r[2]) for r in deleted]))
+    events = _engine_events()
+    if events is not None and deleted:
+        events.append(('messages', -1, [(r[3], r[0]) for r in deleted]))
+    _bump(cursor, 'UserActivity', ('TeamID', 'UserID'),
+          {k: -v for k, v in Counter((r[0], r[1]) for r in deleted).items()})
+    _bump(cursor, 'PhraseCounts', ('TeamID', 'Phrase'),
+          {k: -v for k, v in Counter((r[0], p) for r in deleted for p in nlp.phrases(r[2])).items()})
+    for table in ('MessageReactCounts', 'MessageWords'):
+        backend.execute_values(cursor, '''WITH v (MessageID) AS (VALUES %s)
+                        DELETE FROM {} WHERE MessageID IN (SELECT MessageID FROM v)'''.format(table), rows)
+    return {r[0] for r in deleted}
+
+
+def _insert_messages(cursor, msgs):
+    if not msgs:
+        return set()
+    rows = [(msg.msg_id, msg.team_id, msg.user_id, msg.text, msg.channel_id, msg.created_at) for msg in msgs]
+    inserted = backend.execute_values(cursor, '''INSERT INTO Messages (MessageID, TeamID, UserID, Text, ChannelID, CreatedAt) VALUES %s
+                    ON CONFLICT (MessageID) DO NOTHING RETURNING MessageID, TeamID, UserID, Text, ChannelID, CreatedAt''',
+                    rows, fetch=True)
+    return _messages_inserted(cursor, inserted)
+
+
+def _messages_inserted(cursor, inserted):
+    '''
+    Updates the rollups and text indexes for (MessageID, TeamID, UserID, Text,
+    ChannelID, CreatedAt) rows that were just inserted
+    '''
+    pending = _recording()
+    if pending is not None and inserted:
+        pending.append(('messages', 1, [(r[0], r[1], r[3]) for r in inserted]))
+    events = _engine_events()
+    if events is not None and inserted:
+        events.append(('messages', 1, inserted))
+    _bump(cursor, 'UserActivity', ('TeamID', 'UserID'), Counter((r[1], r[2]) for r in inserted))
+    _bump(cursor, 'PhraseCounts', ('TeamID', 'Phrase'),
+          Counter((r[1], p) for r in inserted for p in nlp.phrases(r[3])))
+    _insert_message_words(cursor, [(r[0], r[3]) for r in inserted])
+    return {r[1] for r in inserted}
+
+
+def _delete_reacts(cursor, reacts):
+    if not reacts:
+        return set()
+    rows = [(react.msg_id, react.user_id, react.name) for react in reacts]
+    deleted = backend.execute_values(cursor, '''WITH v (MessageID, UserID, ReactName) AS (VALUES %s)
+                    DELETE FROM Reacts WHERE (MessageID, UserID, ReactName) IN
+                    (SELECT MessageID, UserID, ReactName FROM v)
+                    RETURNING MessageID, TeamID, UserID, ReactName, CreatedAt''', rows, fetch=True)
+    _apply_react_deltas(cursor, deleted, -1)
+    return {r[1] for r in deleted}
+
+
+def _insert_reacts(cursor, reacts):
+    if not reacts:
+        return set()
+    rows = [(react.msg_id, react.team_id, react.user_id, react.name, react.created_at) for react in reacts]
+    # Reacts on messages we never saw are dropped instead of failing the batch.
+    # NOT EXISTS keeps out duplicates on databases still building the unique index.
+    inserted = backend.execute_values(cursor, '''WITH v (MessageID, TeamID, UserID, ReactName, CreatedAt) AS (VALUES %s)
+                    INSERT INTO Reacts (MessageID, TeamID, UserID, ReactName, CreatedAt)
+                    SELECT v.MessageID, v.TeamID, v.UserID, v.ReactName, CAST(v.CreatedAt AS timestamptz)
+                    FROM v WHERE EXISTS (SELECT 1 FROM Messages WHERE Messages.MessageID = v.MessageID)
+                    AND NOT EXISTS (SELECT 1 FROM Reacts r WHERE r.MessageID = v.MessageID
+                                    AND r.UserID = v.UserID AND r.ReactName = v.ReactName)
+                    ON CONFLICT DO NOTHING
+                    RETURNING MessageID, TeamID, UserID, ReactName, CreatedAt''', rows, fetch=True)
+    _apply_react_deltas(cursor, inserted, 1)
+    return {r[1] for r in inserted}
 
+
+@bumps_generation
 @psycopg2_cur
 def remove_message(cursor, msg):
     if not msg:
-        return
-    query = 'DELETE FROM Messages WHERE MessageID = %s'
-    cursor.execute(query, (msg.msg_id,))
+        return set()
+    return _delete_messages(cursor, [msg.msg_id])
 
 
+@bumps_generation
 @psycopg2_cur
 def add_message(cursor, msg):
     if not msg:
-        return
-    try:
-        cursor.execute('INSERT INTO Messages VALUES (%s, %s, %s);',
-                       (msg.msg_id, msg.user_id, msg.text))
-    except Exception as e:
-        print(e)
-        print(traceback.print_exc())
+        return set()
+    return _insert_messages(cursor, [msg])
 
 
 @psycopg2_cur
 def execute(cursor, query, args=None):
-    cursor.execute(query, args)
-    result = []
-    row = cursor.fetchone()
-    while row:
-        result.append(row)
-        row = cursor.fetchone()
-    return result
+    with QUERY_SECONDS.time(statement_name(query)):
+        cursor.execute(query, args)
+        # Statements that return no rows, such as ANALYZE, have no description
+        return cursor.fetchall() if cursor.description is not None else []
+
+
+_stream_ids = count()
+
+def stream(query, args=None, batch_size=STREAM_BATCH_SIZE):
+    '''
+    Like execute, but returns an iterator over the rows of a server side
+    cursor, fetched batch_size rows at a time, so memory use does not
+    depend on the size of the result.
+    '''
+    if not _schema_ready:
+        init_db()
+    with backend.connection() as conn:
+        cursor = backend.stream_cursor(conn, 'stream_%d' % next(_stream_ids))
+        # Only the time spent in the database, not in the caller's loop
+        elapsed = 0.0
+        try:
+            start = time.perf_counter()
+            cursor.execute(query, args)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                elapsed += time.perf_counter() - start
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+                start = time.perf_counter()
+        finally:
+            cursor.close()
+            QUERY_SECONDS.observe(elapsed, statement_name(query))
 
 
 
+@bumps_generation
 @psycopg2_cur
 def add_react(cursor, react):
     if not react:
-        return
-    try:
-        cursor.execute('INSERT INTO Reacts VALUES(%s, %s, %s);', (react.msg_id, react.user_id, react.name))
-    except Exception as e:
-        print(e)
-        print(traceback.print_exc())
-
-
+        return set()
+    return _insert_reacts(cursor, [react])
 
 
+@bumps_generation
 @psycopg2_cur
 def remove_react(cursor, react):
     if not react:
-        return
-    args = (react.msg_id, react.user_id, react.name)
-    cursor.execute('''DELETE FROM Reacts WHERE MessageID=%s
-                    AND UserID=%s AND ReactName=%s;''', args)
+        return set()
+    return _delete_reacts(cursor, [react])
 
 
+@bumps_generation
+@psycopg2_cur
+def write_batch(cursor, message_removes, message_adds, react_removes, react_adds,
+                early_react_removes=(), early_react_adds=()):
+    '''
+    Applies a coalesced batch of events in one transaction. Removals run before
+    inserts so that a remove followed by an add of the same key ends up present.
+    The early reacts, see ingest.coalesce, are written before the messages.
+    '''
+    teams = _delete_reacts(cursor, early_react_removes)
+    teams |= _insert_reacts(cursor, early_react_adds)
+    teams |= _delete_messages(cursor, message_removes)
+    teams |= _insert_messages(cursor, message_adds)
+    teams |= _delete_reacts(cursor, react_removes)
+    teams |= _insert_reacts(cursor, react_adds)
+    return teams
+
+
+STAGED_MESSAGE_COLUMNS = '''MessageID varchar(40), TeamID varchar(40), UserID varchar(40), Text TEXT,
+    ChannelID varchar(40), CreatedAt timestamptz'''
+STAGED_REACT_COLUMNS = '''MessageID varchar(40), TeamID varchar(40), UserID varchar(40), ReactName varchar(40),
+    CreatedAt timestamptz'''
+# WHERE true lets SQLite tell ON CONFLICT from a join constraint
+INSERT_STAGED_MESSAGES = '''INSERT INTO Messages (MessageID, TeamID, UserID, Text, ChannelID, CreatedAt)
+    SELECT MessageID, TeamID, UserID, Text, ChannelID, CreatedAt FROM StagedMessages WHERE true
+    ON CONFLICT (MessageID) DO NOTHING RETURNING MessageID, TeamID, UserID, Text, ChannelID, CreatedAt'''
+INSERT_STAGED_REACTS = '''INSERT INTO Reacts (MessageID, TeamID, UserID, ReactName, CreatedAt)
+    SELECT v.MessageID, v.TeamID, v.UserID, v.ReactName, v.CreatedAt FROM StagedReacts v
+    WHERE EXISTS (SELECT 1 FROM Messages WHERE Messages.MessageID = v.MessageID)
+    ON CONFLICT DO NOTHING
+    RETURNING MessageID, TeamID, UserID, ReactName, CreatedAt'''
+SAVE_CHECKPOINT = '''INSERT INTO BackfillCheckpoints (TeamID, ChannelID, OldestTS, NewestTS, Done, UpdatedAt)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON CONFLICT (TeamID, ChannelID) DO UPDATE SET OldestTS = EXCLUDED.OldestTS,
+    NewestTS = EXCLUDED.NewestTS, Done = EXCLUDED.Done, UpdatedAt = EXCLUDED.UpdatedAt'''
 
 
+@bumps_generation
+@psycopg2_cur
+def bulk_load(cursor, msgs, reacts, checkpoint=None):
+    '''
+    Inserts history in one transaction, staging the rows with COPY (or
+    executemany on SQLite) and inserting them with one statement per table
+    rather than VALUES pages. Rows already present are skipped, so loading
+    the same history twice is harmless.
+
+    Args:
+        msgs       (list)  : Messages
+        reacts     (list)  : Reacts, on msgs or on messages already stored
+        checkpoint (tuple) : (TeamID, ChannelID, OldestTS, NewestTS, Done)
+                             saved in the same transaction
+    '''
+    teams = set()
+    if msgs:
+        backend.stage(cursor, 'StagedMessages', STAGED_MESSAGE_COLUMNS,
+                      [(m.msg_id, m.team_id, m.user_id, m.text, m.channel_id, m.created_at) for m in msgs])
+        cursor.execute(INSERT_STAGED_MESSAGES)
+        teams |= _messages_inserted(cursor, cursor.fetchall())
+    if reacts:
+        backend.stage(cursor, 'StagedReacts', STAGED_REACT_COLUMNS,
+                      [(r.msg_id, r.team_id, r.user_id, r.name, r.created_at) for r in reacts])
+        cursor.execute(INSERT_STAGED_REACTS)
+        inserted = cursor.fetchall()
+        _apply_react_deltas(cursor, inserted, 1)
+        teams |= {r[1] for r in inserted}
+    if checkpoint:
+        cursor.execute(SAVE_CHECKPOINT, tuple(checkpoint) + (datetime.now(timezone.utc),))
+    return teams
+
+
+@bumps_generation
+@psycopg2_cur
+def rebuild_rollups(cursor):
+    '''
+    Recomputes every rollup table and text index from Reacts and Messages to
+    repair drift
+    '''
+    rebuild_rollup_tables(cursor)
+    rebuild_phrase_counts(cursor)
+    rebuild_message_words(cursor)
+    cursor.execute('SELECT DISTINCT TeamID FROM Messages')
+    return {row[0] for row in cursor.fetchall()}
 
 
 @psycopg2_cur
@@ -123,3 +1344,13 @@ def get_message_text_from_ids(cursor, msg_ids):
     return result
 
 
+
+
+if __name__ == '__main__':
+    import sys
+    commands = {'migrate': init_db,
+                'rebuild_rollups': rebuild_rollups}
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        print('usage: python db.py [%s]' % '|'.join(commands))
+        sys.exit(1)
+    commands[sys.argv[1]]()
@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+import log
+import metrics
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+REDIS_URL = os.environ.get('REDIS_URL')
+# Seconds an event_id is remembered. Slack gives up retrying after a few
+# minutes, so this only needs to outlast its retry schedule.
+DEDUPE_WINDOW = int(os.environ.get('DEDUPE_WINDOW', 3600))
+# event_ids kept in each process before the least recently seen is evicted
+DEDUPE_LRU_SIZE = int(os.environ.get('DEDUPE_LRU_SIZE', 100000))
+KEY_PREFIX = 'react_analytics:event_id:'
+
+
+class EventDeduplicator(object):
+    '''
+    Remembers Slack event_ids for DEDUPE_WINDOW seconds so redelivered
+    events are dropped before they are queued.
+
+    IDs are kept in a per process LRU and, when REDIS_URL is set, in Redis
+    with SET NX EX so a retry landing on another gunicorn or celery process
+    is caught too. If Redis is unreachable only the local LRU is used.
+    '''
+    def __init__(self, window=DEDUPE_WINDOW, max_size=DEDUPE_LRU_SIZE, redis_url=REDIS_URL):
+        self.window = window
+        self.max_size = max_size
+        self.redis_url = redis_url
+        self._redis = None
+        self._lock = threading.Lock()
+        self._local = OrderedDict()
+        self._stats = {'checked': 0, 'duplicates': 0, 'local_duplicates': 0,
+                       'redis_errors': 0}
+
+    def _client(self):
+        if self._redis is None and self.redis_url and redis is not None:
+            self._redis = redis.Redis.from_url(self.redis_url, socket_timeout=0.5)
+        return self._redis
+
+    def seen(self, event_id):
+        '''
+        Records event_id and returns True if it was already recorded within
+        the window, False the first time it is seen.
+        '''
+        now = time.time()
+        with self._lock:
+            self._stats['checked'] += 1
+            expires = self._local.get(event_id)
+            if expires is not None and expires > now:
+                self._local.move_to_end(event_id)
+                self._stats['duplicates'] += 1
+                self._stats['local_duplicates'] += 1
+                return True
+            self._local[event_id] = now + self.window
+            self._local.move_to_end(event_id)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+        client = self._client()
+        if client is None:
+            return False
+        try:
+            first = client.set(KEY_PREFIX + event_id, 1, nx=True, ex=self.window)
+        except redis.RedisError as e:
+            self._stats['redis_errors'] += 1
+            log.log_error('Event dedupe redis error: ' + str(e))
+            return False
+        if not first:
+            with self._lock:
+                self._stats['duplicates'] += 1
+            return True
+        return False
+
+    def forget(self, event_id):
+        '''
+        Removes event_id so a retry of an event that failed to queue is
+        accepted
+        '''
+        with self._lock:
+            self._local.pop(event_id, None)
+        client = self._client()
+        if client is None:
+            return
+        try:
+            client.delete(KEY_PREFIX + event_id)
+        except redis.RedisError as e:
+            self._stats['redis_errors'] += 1
+            log.log_error('Event dedupe redis error: ' + str(e))
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['size'] = len(self._local)
+        return stats
+
+
+events = EventDeduplicator()
+metrics.register('dedupe', events.stats)
@@ -0,0 +1,312 @@
+import os
+import json
+import threading
+import time
+import log
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+REDIS_URL = os.environ.get('REDIS_URL')
+# Seconds before the full user and channel lists are crawled again
+DIRECTORY_TTL = int(os.environ.get('DIRECTORY_TTL', 6 * 3600))
+# Seconds between checks for a stale directory or a newer snapshot in Redis
+DIRECTORY_CHECK_INTERVAL = int(os.environ.get('DIRECTORY_CHECK_INTERVAL', 60))
+# Seconds an ID that users.info / conversations.info didn't find is not looked up again
+DIRECTORY_NEGATIVE_TTL = int(os.environ.get('DIRECTORY_NEGATIVE_TTL', 600))
+KEY_PREFIX = 'react_analytics:directory:'
+# Errors that mean Slack doesn't know the ID, rather than that the call failed
+NOT_FOUND_ERRORS = ('user_not_found', 'channel_not_found')
+CHANNEL_TYPES = 'public_channel,private_channel'
+# Slack events that change a user or channel, see Directory.apply_event
+USER_EVENTS = ('user_change', 'team_join')
+CHANNEL_EVENTS = ('channel_created', 'channel_rename', 'channel_deleted')
+DIRECTORY_EVENTS = USER_EVENTS + CHANNEL_EVENTS
+
+
+def user_info(user):
+    '''
+    The fields kept for a users.list / users.info member
+    '''
+    profile = user.get('profile', {})
+    return {'user_name': user['name'],
+            'display_name': profile.get('display_name', user['name'])}
+
+
+class Directory(object):
+    '''
+    Users ({user ID: {'user_name', 'display_name'}}) and channels
+    ({channel ID: name}) of the workspace.
+
+    The full lists are crawled with users.list / conversations.list from a
+    background thread every DIRECTORY_TTL seconds. With REDIS_URL set the
+    result is stored in Redis, where other processes load it from instead of
+    crawling themselves. IDs missing from the lists are looked up one at a time
+    with users.info / conversations.info, and IDs Slack doesn't know are
+    remembered for DIRECTORY_NEGATIVE_TTL seconds. Lookups never crawl.
+    User and channel change events update single entries between crawls.
+
+    A refresh or change event replaces the users and channels dicts rather than updating them,
+    so callers caching on the dicts' identity see the change.
+    '''
+    def __init__(self, client, redis_url=REDIS_URL, ttl=DIRECTORY_TTL,
+                 negative_ttl=DIRECTORY_NEGATIVE_TTL):
+        self.client = client
+        self.redis_url = redis_url
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.users = {}
+        self.channels = {}
+        self._redis = None
+        self._missing = {}
+        self._loaded_at = None
+        self._version = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats = {'lookups': 0, 'misses': 0, 'negative_hits': 0,
+                       'api_lookups': 0, 'crawls': 0, 'loads': 0, 'changes': 0, 'errors': 0}
+
+    def _client(self):
+        if self._redis is None and self.redis_url and redis is not None:
+            self._redis = redis.Redis.from_url(self.redis_url, socket_timeout=2)
+        return self._redis
+
+    def start(self):
+        '''
+        Loads the snapshot stored in Redis and starts the refresh thread, once
+        per process. Called by the first lookup.
+        '''
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._try(self.load)
+            self._thread = threading.Thread(target=self._run, name='directory-refresh')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def user(self, user_id):
+        '''
+        Returns the user's info, or None if Slack doesn't know the ID
+        '''
+        return self._lookup(user_id, self.users, self._fetch_user)
+
+    def channel(self, channel_id):
+        '''
+        Returns the channel's name, or None if Slack doesn't know the ID
+        '''
+        return self._lookup(channel_id, self.channels, self._fetch_channel)
+
+    def _lookup(self, entity_id, entities, fetch):
+        self.start()
+        self._stats['lookups'] += 1
+        if entity_id in entities:
+            return entities[entity_id]
+        self._stats['misses'] += 1
+        if self._missing.get(entity_id, 0) > time.time():
+            self._stats['negative_hits'] += 1
+            return None
+
+        self._stats['api_lookups'] += 1
+        try:
+            value = fetch(entity_id)
+        except Exception as e:
+            # Not remembered as missing, the next lookup tries again
+            self._stats['errors'] += 1
+            log.log_error('Directory lookup of %s failed: %s' % (entity_id, e))
+            return None
+        if value is None:
+            self._missing[entity_id] = time.time() + self.negative_ttl
+        return value
+
+    def _check(self, method, response):
+        '''
+        Returns False if Slack doesn't know the ID, raises if the call failed
+        '''
+        if response.get('ok'):
+            return True
+        if response.get('error') in NOT_FOUND_ERRORS:
+            return False
+        raise RuntimeError('%s failed: %s' % (method, response.get('error')))
+
+    def _fetch_user(self, user_id):
+        response = self.client.api_call('users.info', user=user_id)
+        if not self._check('users.info', response):
+            return None
+        info = user_info(response['user'])
+        self.users[user_id] = info
+        self._store('users', {user_id: info})
+        return info
+
+    def _fetch_channel(self, channel_id):
+        response = self.client.api_call('conversations.info', channel=channel_id)
+        if not self._check('conversations.info', response):
+            return None
+        name = response['channel']['name']
+        self.channels[channel_id] = name
+        self._store('channels', {channel_id: name})
+        return name
+
+    def _store(self, kind, entries):
+        client = self._client()
+        if client is not None and entries:
+            client.hset(KEY_PREFIX + kind,
+                        mapping={k: json.dumps(v) for k, v in entries.items()})
+
+    def apply_event(self, event):
+        '''
+        Updates the entry a user or channel change event is about, here and
+        in Redis, where other processes pick it up on their next check.
+
+        Args:
+            event (dict) : the 'event' of a Slack API event
+
+        Returns:
+            bool: True if the event was a directory change
+        '''
+        event_type = event.get('type')
+        if event_type in USER_EVENTS:
+            user = event['user']
+            self._change('users', user['id'], user_info(user))
+        elif event_type == 'channel_deleted':
+            self._change('channels', event['channel'], None)
+        elif event_type in CHANNEL_EVENTS:
+            channel = event['channel']
+            self._change('channels', channel['id'], channel['name'])
+        else:
+            return False
+        return True
+
+    def _change(self, kind, entity_id, value):
+        '''
+        Sets or, with value None, removes one entry
+        '''
+        entities = dict(getattr(self, kind))
+        if value is None:
+            entities.pop(entity_id, None)
+        else:
+            entities[entity_id] = value
+            self._missing.pop(entity_id, None)
+        setattr(self, kind, entities)
+        self._stats['changes'] += 1
+
+        client = self._client()
+        if client is None:
+            return
+        pipe = client.pipeline()
+        if value is None:
+            pipe.hdel(KEY_PREFIX + kind, entity_id)
+        else:
+            pipe.hset(KEY_PREFIX + kind, entity_id, json.dumps(value))
+        pipe.incr(KEY_PREFIX + 'version')
+        _, version = pipe.execute()
+        # Unless another process changed something in between, there is
+        # nothing new to load
+        if self._version is not None and version == self._version + 1:
+            self._version = version
+
+    def _crawl(self, method, key, **kwargs):
+        '''
+        Pages through a list method. Returns None if any page fails.
+        '''
+        entries = []
+        cursor = None
+        while True:
+            if cursor:
+                kwargs['cursor'] = cursor
+            response = self.client.api_call(method, limit=1000, **kwargs)
+            if not response.get('ok'):
+                log.log_error('%s failed: %s' % (method, response.get('error')))
+                return None
+            entries.extend(response[key])
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return entries
+
+    def refresh(self):
+        '''
+        Crawls the full user and channel lists and stores them. With Redis,
+        only one process crawls at a time and the others load its result.
+        '''
+        client = self._client()
+        if client is not None and not client.set(KEY_PREFIX + 'crawl_lock', os.getpid(),
+                                                 nx=True, ex=600):
+            return False
+
+        try:
+            members = self._crawl('users.list', 'members')
+            conversations = self._crawl('conversations.list', 'channels', types=CHANNEL_TYPES)
+            if members is None or conversations is None:
+                return False
+            users = {user['id']: user_info(user) for user in members}
+            channels = {channel['id']: channel['name'] for channel in conversations}
+
+            now = time.time()
+            if client is not None:
+                pipe = client.pipeline()
+                pipe.delete(KEY_PREFIX + 'users', KEY_PREFIX + 'channels')
+                if users:
+                    pipe.hset(KEY_PREFIX + 'users', mapping={k: json.dumps(v) for k, v in users.items()})
+                if channels:
+                    pipe.hset(KEY_PREFIX + 'channels', mapping={k: json.dumps(v) for k, v in channels.items()})
+                pipe.set(KEY_PREFIX + 'refreshed', now)
+                pipe.execute()
+
+            self.users, self.channels = users, channels
+            self._missing = {}
+            self._loaded_at = now
+            self._stats['crawls'] += 1
+            return True
+        finally:
+            if client is not None:
+                client.delete(KEY_PREFIX + 'crawl_lock')
+
+    def load(self):
+        '''
+        Loads the directory stored in Redis by the last refresh and the
+        changes since. Returns when it was crawled, or None if there is no
+        stored directory.
+        '''
+        client = self._client()
+        if client is None:
+            return None
+        refreshed, version = client.mget(KEY_PREFIX + 'refreshed', KEY_PREFIX + 'version')
+        if refreshed is None:
+            return None
+        refreshed = float(refreshed)
+        version = int(version or 0)
+        if refreshed != self._loaded_at or version != self._version:
+            pipe = client.pipeline()
+            pipe.hgetall(KEY_PREFIX + 'users')
+            pipe.hgetall(KEY_PREFIX + 'channels')
+            users, channels = pipe.execute()
+            self.users = {k.decode(): json.loads(v) for k, v in users.items()}
+            self.channels = {k.decode(): json.loads(v) for k, v in channels.items()}
+            self._loaded_at = refreshed
+            self._version = version
+            self._stats['loads'] += 1
+        return refreshed
+
+    def _run(self):
+        while True:
+            refreshed = self._try(self.load) if self._client() else self._loaded_at
+            if refreshed is None or time.time() - refreshed > self.ttl:
+                self._try(self.refresh)
+            time.sleep(DIRECTORY_CHECK_INTERVAL)
+
+    def _try(self, func, *args):
+        try:
+            return func(*args)
+        except Exception as e:
+            self._stats['errors'] += 1
+            log.log_error('Directory %s failed: %s' % (func.__name__, e))
+            return None
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['users'] = len(self.users)
+        stats['channels'] = len(self.channels)
+        stats['age'] = time.time() - self._loaded_at if self._loaded_at else None
+        return stats
@@ -0,0 +1,610 @@
+'''
+In-process columnar copy of Messages and Reacts for the analytics commands
+that only count things.
+
+Message IDs, user IDs, channel IDs and react names are interned to integer
+codes, and each team's messages and reacts are kept as NumPy arrays of those
+codes, so a command is a few masks and a bincount instead of a query. Texts
+aren't kept, the few messages a command returns are read back by ID.
+
+The engine is loaded from the database and db hands it the rows every write
+in this process commits, see db.bumps_generation. Writes from other
+processes (another worker's event handler, backfill.py) show up as
+generation bumps in the shared result cache, and a team with any since the
+load is answered by the SQL queries until the next reload, every
+ENGINE_RELOAD_INTERVAL seconds. Without REDIS_URL there are no shared bumps
+to see. The EVENT_CONSUMER=redis consumers don't run the engine, as each
+only sees its own partition. Enable it with ANALYTICS_ENGINE=numpy.
+'''
+import os
+import threading
+import time
+from datetime import datetime
+import log
+import db
+import cache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+ANALYTICS_ENGINE = os.environ.get('ANALYTICS_ENGINE')
+# Seconds between reloads from the database
+ENGINE_RELOAD_INTERVAL = int(os.environ.get('ENGINE_RELOAD_INTERVAL', 3600))
+# Reacts added since the key index was last built are found through a dict,
+# which is folded into the index once it holds this many
+ENGINE_COMPACT_AFTER = int(os.environ.get('ENGINE_COMPACT_AFTER', 50000))
+
+MESSAGE_SNAPSHOT = "SELECT TeamID, MessageID, UserID, ChannelID, CreatedAt, Text <> '' FROM Messages"
+# Reacts with their message's team first
+REACT_SNAPSHOT = '''SELECT Messages.TeamID, Reacts.TeamID, Reacts.MessageID, Reacts.UserID, Reacts.ReactName,
+    Reacts.CreatedAt FROM Reacts INNER JOIN Messages ON Messages.MessageID=Reacts.MessageID'''
+MESSAGE_TEXTS_BY_ID = 'SELECT MessageID, Text FROM Messages WHERE MessageID IN ({})'
+
+
+def _epoch(created_at):
+    # CreatedAt comes back as a datetime from Postgres and as seconds from SQLite
+    if created_at is None:
+        return float('nan')
+    if isinstance(created_at, datetime):
+        return created_at.timestamp()
+    return float(created_at)
+
+
+class Interner(object):
+    '''
+    Gives each distinct value a small integer code, in order of first use
+    '''
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def get(self, value):
+        return self.codes.get(value)
+
+    def __len__(self):
+        return len(self.values)
+
+
+class Columns(object):
+    '''
+    Equal length NumPy arrays that grow by doubling. Reading a column by name
+    gives a view of its used part.
+    '''
+    def __init__(self, **dtypes):
+        self.size = 0
+        self._arrays = {name: np.zeros(16, dtype) for name, dtype in dtypes.items()}
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_arrays'][name][:self.size]
+        except KeyError:
+            raise AttributeError(name)
+
+    def set(self, row, **values):
+        for name, value in values.items():
+            self._arrays[name][row] = value
+
+    def append(self, **values):
+        '''
+        Appends one row and returns its index
+        '''
+        self.reserve(self.size + 1)
+        row = self.size
+        self.size += 1
+        self.set(row, **values)
+        return row
+
+    def extend(self, **arrays):
+        size = len(next(iter(arrays.values())))
+        self.reserve(self.size + size)
+        for name, values in arrays.items():
+            self._arrays[name][self.size:self.size + size] = values
+        self.size += size
+
+    def reserve(self, size):
+        capacity = len(next(iter(self._arrays.values())))
+        if size <= capacity:
+            return
+        capacity = max(size, capacity * 2)
+        for name, array in self._arrays.items():
+            grown = np.zeros(capacity, array.dtype)
+            grown[:self.size] = array[:self.size]
+            self._arrays[name] = grown
+
+    def nbytes(self):
+        return sum(array.nbytes for array in self._arrays.values())
+
+
+class Team(object):
+    '''
+    One team's messages and the reacts on them. A message's row is its code in
+    the team's messages interner, a react's msg column is its message's row
+    and its team column the code of the react's own TeamID, which in a
+    channel shared between workspaces can be another team's. Removed rows
+    are marked dead rather than deleted.
+    '''
+    def __init__(self):
+        self.messages = Interner()
+        self.message_cols = Columns(user=np.int32, channel=np.int32, created=np.float64,
+                                    has_text=np.bool_, alive=np.bool_)
+        self.react_cols = Columns(msg=np.int32, user=np.int32, react=np.int32, pair=np.int32,
+                                  team=np.int32, created=np.float64, alive=np.bool_)
+        # (user code, react code) -> code, so a react's key fits in an int64
+        self.pairs = Interner()
+        self._keys = np.zeros(0, np.int64)
+        self._key_rows = np.zeros(0, np.int32)
+        self._recent = {}
+        # Bumped on every change, for memoizing derived arrays
+        self.version = 0
+        self._memo = {}
+
+    def index_keys(self):
+        '''
+        Rebuilds the sorted key index over every react row
+        '''
+        cols = self.react_cols
+        keys = (cols.msg.astype(np.int64) << 32) | cols.pair
+        order = np.argsort(keys, kind='stable')
+        self._keys = keys[order]
+        self._key_rows = order.astype(np.int32)
+        self._recent = {}
+
+    def find_react(self, key):
+        row = self._recent.get(key)
+        if row is None and len(self._keys):
+            i = np.searchsorted(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                row = int(self._key_rows[i])
+        return row
+
+    def add_message(self, msg_id, user, channel, created, has_text):
+        row = self.messages.code(msg_id)
+        if row < self.message_cols.size:
+            # Messages are keyed on their ID, so only a deleted one is replaced
+            if self.message_cols.alive[row]:
+                return False
+            self.message_cols.set(row, user=user, channel=channel, created=created,
+                                  has_text=has_text, alive=True)
+        else:
+            self.message_cols.append(user=user, channel=channel, created=created,
+                                     has_text=has_text, alive=True)
+        self.version += 1
+        return True
+
+    def remove_message(self, msg_id):
+        row = self.messages.get(msg_id)
+        if row is None or not self.message_cols.alive[row]:
+            return False
+        self.message_cols.alive[row] = False
+        reacts = self.react_cols
+        reacts.alive[reacts.msg == row] = False
+        self.version += 1
+        return True
+
+    def add_react(self, msg_id, user, react, team, created):
+        msg_row = self.messages.get(msg_id)
+        # Reacts on messages we never saw are dropped, as db does
+        if msg_row is None or not self.message_cols.alive[msg_row]:
+            return False
+        pair = self.pairs.code((user, react))
+        key = (msg_row << 32) | pair
+        row = self.find_react(key)
+        if row is None:
+            row = self.react_cols.append(msg=msg_row, user=user, react=react, pair=pair, team=team,
+                                         created=created, alive=True)
+            self._recent[key] = row
+            if len(self._recent) >= ENGINE_COMPACT_AFTER:
+                self.index_keys()
+        elif self.react_cols.alive[row]:
+            return False
+        else:
+            self.react_cols.set(row, team=team, created=created, alive=True)
+        self.version += 1
+        return True
+
+    def remove_react(self, msg_id, user, react):
+        msg_row, pair = self.messages.get(msg_id), self.pairs.get((user, react))
+        if msg_row is None or pair is None:
+            return False
+        row = self.find_react((msg_row << 32) | pair)
+        if row is None or not self.react_cols.alive[row]:
+            return False
+        self.react_cols.alive[row] = False
+        self.version += 1
+        return True
+
+    def memo(self, name, compute):
+        '''
+        compute() cached until the team next changes
+        '''
+        cached = self._memo.get(name)
+        if cached is None or cached[0] != self.version:
+            cached = self._memo[name] = (self.version, compute())
+        return cached[1]
+
+    def nbytes(self):
+        return (self.message_cols.nbytes() + self.react_cols.nbytes()
+                + self._keys.nbytes + self._key_rows.nbytes)
+
+
+class State(object):
+    '''
+    Everything one load of the engine builds. Codes are shared by every team.
+    Reacts are kept by their message's team, and react_hosts has the teams
+    holding the reacts of each react TeamID, usually just that team.
+    '''
+    def __init__(self):
+        self.users = Interner()
+        self.channels = Interner()
+        self.react_names = Interner()
+        self.team_ids = Interner()
+        self.teams = {}
+        self.react_hosts = {}
+        # cache.results.external_generations() from before the load
+        self.external = {}
+
+    def team(self, team_id):
+        team = self.teams.get(team_id)
+        if team is None:
+            team = self.teams[team_id] = Team()
+        return team
+
+    def host(self, msg_id, team_id):
+        '''
+        (team ID, Team) of the team msg_id was posted in, trying team_id
+        first. (None, None) for a message never seen.
+        '''
+        team = self.teams.get(team_id)
+        if team is not None and team.messages.get(msg_id) is not None:
+            return team_id, team
+        for host_id, team in self.teams.items():
+            if team.messages.get(msg_id) is not None:
+                return host_id, team
+        return None, None
+
+    # The events take the rows db's writers return
+
+    def add_message(self, msg_id, team_id, user_id, text, channel_id, created_at):
+        return self.team(team_id).add_message(msg_id, self.users.code(user_id), self.channels.code(channel_id),
+                                              _epoch(created_at), bool(text))
+
+    def remove_message(self, msg_id, team_id):
+        team = self.teams.get(team_id)
+        return team is not None and team.remove_message(msg_id)
+
+    def add_react(self, msg_id, team_id, user_id, name, created_at):
+        host_id, host = self.host(msg_id, team_id)
+        if host is None:
+            return False
+        self.react_hosts.setdefault(team_id, set()).add(host_id)
+        return host.add_react(msg_id, self.users.code(user_id), self.react_names.code(name),
+                              self.team_ids.code(team_id), _epoch(created_at))
+
+    def remove_react(self, msg_id, team_id, user_id, name, created_at=None):
+        user, react = self.users.get(user_id), self.react_names.get(name)
+        _, host = self.host(msg_id, team_id)
+        if host is None or user is None or react is None:
+            return False
+        return host.remove_react(msg_id, user, react)
+
+    def apply(self, events):
+        '''
+        Applies db's (table, sign, rows) events in order
+        '''
+        for table, sign, rows in events:
+            op = getattr(self, ('add_' if sign > 0 else 'remove_') + table[:-1])
+            for row in rows:
+                op(*row)
+
+    def load(self):
+        '''
+        Reads every message and react from the database. Rows are collected
+        per team and copied into the arrays at the end.
+        '''
+        messages = {}
+        for team_id, msg_id, user_id, channel_id, created_at, has_text in db.stream(MESSAGE_SNAPSHOT):
+            # MessageID is the primary key, so codes are handed out in row order
+            self.team(team_id).messages.code(msg_id)
+            rows = messages.setdefault(team_id, ([], [], [], []))
+            rows[0].append(self.users.code(user_id))
+            rows[1].append(self.channels.code(channel_id))
+            rows[2].append(_epoch(created_at))
+            rows[3].append(bool(has_text))
+        for team_id, (users, channels, created, has_text) in messages.items():
+            self.teams[team_id].message_cols.extend(user=users, channel=channels, created=created,
+                                                    has_text=has_text, alive=np.ones(len(users), np.bool_))
+
+        reacts = {}
+        for host_id, team_id, msg_id, user_id, name, created_at in db.stream(REACT_SNAPSHOT):
+            host = self.teams.get(host_id)
+            # Messages posted since the first snapshot was read
+            msg_row = host.messages.get(msg_id) if host is not None else None
+            if msg_row is None:
+                continue
+            self.react_hosts.setdefault(team_id, set()).add(host_id)
+            user, react = self.users.code(user_id), self.react_names.code(name)
+            rows = reacts.setdefault(host_id, ([], [], [], [], [], []))
+            rows[0].append(msg_row)
+            rows[1].append(user)
+            rows[2].append(react)
+            rows[3].append(host.pairs.code((user, react)))
+            rows[4].append(self.team_ids.code(team_id))
+            rows[5].append(_epoch(created_at))
+        for host_id, (msg_rows, users, names, pairs, teams, created) in reacts.items():
+            self.teams[host_id].react_cols.extend(msg=msg_rows, user=users, react=names, pair=pairs, team=teams,
+                                                  created=created, alive=np.ones(len(users), np.bool_))
+        for team in self.teams.values():
+            team.index_keys()
+
+
+def _top(counts, count, names, skip=None):
+    '''
+    The count largest non zero entries of counts as [(names[code], n)], largest
+    first. All of them when count is None.
+    '''
+    counts = counts.copy()
+    if skip is not None and skip < len(counts):
+        counts[skip] = 0
+    nonzero = np.flatnonzero(counts)
+    if count is not None and len(nonzero) > count:
+        nonzero = nonzero[np.argpartition(-counts[nonzero], count - 1)[:count]]
+    nonzero = nonzero[np.argsort(-counts[nonzero], kind='stable')]
+    return [(names[code], int(counts[code])) for code in nonzero]
+
+
+class Engine(object):
+    '''
+    Answers most_used_reacts, users_with_most_reacts, most_reacted_to_posts,
+    most_unique_reacts_on_a_post and most_active with the same arguments and
+    results as analytics. db passes it the rows each write commits, see apply.
+    '''
+    def __init__(self, reload_interval=ENGINE_RELOAD_INTERVAL):
+        if np is None:
+            raise RuntimeError('numpy is needed for the analytics engine')
+        self.reload_interval = reload_interval
+        self.state = None
+        self._lock = threading.Lock()
+        # Events applied while a reload is reading the database, replayed onto
+        # the new state so none are lost
+        self._replay = None
+        self._thread = None
+        self._stats = {'loads': 0, 'load_seconds': 0.0, 'loaded_at': None,
+                       'events': 0, 'queries': 0, 'stale': 0, 'errors': 0}
+
+    @property
+    def ready(self):
+        return self.state is not None
+
+    def serves(self, team_id):
+        '''
+        Whether the engine has every write to team_id: it has loaded and no
+        other process has bumped the team's generation since
+        '''
+        state = self.state
+        if state is None:
+            return False
+        if cache.results.external_generation(team_id) != state.external.get(team_id, 0):
+            self._stats['stale'] += 1
+            return False
+        return True
+
+    def start(self):
+        '''
+        Loads in a background thread and reloads every reload_interval seconds.
+        analytics uses the database until the first load finishes.
+        '''
+        self._thread = threading.Thread(target=self._run, name='analytics-engine')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.reload()
+            except Exception as e:
+                self._stats['errors'] += 1
+                log.log_error('Analytics engine reload failed: ' + str(e))
+            time.sleep(self.reload_interval)
+
+    def reload(self):
+        start = time.time()
+        with self._lock:
+            self._replay = []
+        state = State()
+        try:
+            # Before reading, so a write committed while the load runs counts
+            # as one it may have missed
+            state.external = cache.results.external_generations()
+            state.load()
+        finally:
+            with self._lock:
+                replay, self._replay = self._replay, None
+        with self._lock:
+            for events in replay:
+                state.apply(events)
+            self.state = state
+        self._stats['loads'] += 1
+        self._stats['load_seconds'] = time.time() - start
+        self._stats['loaded_at'] = start
+
+    def apply(self, events):
+        '''
+        Applies the (table, sign, rows) events of a committed write, as
+        recorded by db
+        '''
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append(events)
+            if self.state is not None:
+                self.state.apply(events)
+            self._stats['events'] += sum(len(rows) for _, _, rows in events)
+
+    def _since(self, window):
+        return None if window is None else time.time() - window.total_seconds()
+
+    def _react_mask(self, state, team, user=None, channel=None, since=None):
+        '''
+        Mask of the team's live reacts left by user, in channel and since.
+        None if a filter matches nothing.
+        '''
+        cols = team.react_cols
+        mask = cols.alive.copy()
+        if user is not None:
+            code = state.users.get(user)
+            if code is None:
+                return None
+            mask &= cols.user == code
+        if channel is not None:
+            code = state.channels.get(channel)
+            if code is None:
+                return None
+            mask &= team.message_cols.channel[cols.msg] == code
+        if since is not None:
+            mask &= cols.created >= since
+        return mask
+
+    def _message_mask(self, state, team, user=None, channel=None, since=None):
+        cols = team.message_cols
+        mask = cols.alive.copy()
+        for value, interner, column in ((user, state.users, cols.user),
+                                        (channel, state.channels, cols.channel)):
+            if value is not None:
+                code = interner.get(value)
+                if code is None:
+                    return None
+                mask &= column == code
+        if since is not None:
+            mask &= cols.created >= since
+        return mask
+
+    def _bincount(self, team, name, column, mask, size, unfiltered):
+        # Counts over all of a team's live rows only change with an event,
+        # so they're kept until the next one
+        if unfiltered:
+            counts = team.memo(name, lambda: np.bincount(column[mask]))
+        else:
+            counts = np.bincount(column[mask])
+        if len(counts) < size:
+            counts = np.pad(counts, (0, size - len(counts)))
+        return counts
+
+    def _react_counts(self, state, team_id, column, size, user=None, since=None, unfiltered=False):
+        '''
+        Counts of column over the reacts left with team_id's TeamID, on
+        whichever team's messages. The react SQL queries without a channel
+        filter on the react's TeamID. None if a filter matches nothing.
+        '''
+        code = state.team_ids.get(team_id)
+        counts = np.zeros(size, np.int64)
+        for host_id in state.react_hosts.get(team_id, ()):
+            host = state.teams[host_id]
+            mask = self._react_mask(state, host, user=user, since=since)
+            if mask is None:
+                return None
+            mask &= host.react_cols.team == code
+            counts += self._bincount(host, (column, team_id), getattr(host.react_cols, column), mask, size,
+                                     unfiltered)
+        return counts
+
+    def _query(self, team_id):
+        self._stats['queries'] += 1
+        state = self.state
+        return state, state.teams.get(team_id)
+
+    def most_used_reacts(self, team_id, user=None, channel=None, count=5, window=None):
+        with self._lock:
+            state, team = self._query(team_id)
+            size = len(state.react_names)
+            if channel is not None:
+                # REACTS_IN_CHANNEL goes by the message's team
+                mask = team and self._react_mask(state, team, user, channel, self._since(window))
+                counts = None if mask is None else self._bincount(team, None, team.react_cols.react, mask, size,
+                                                                  False)
+            else:
+                counts = self._react_counts(state, team_id, 'react', size, user, self._since(window),
+                                            user is None and window is None)
+            if counts is None:
+                return {}
+            return dict(_top(counts, count, state.react_names.values, state.react_names.get(None)))
+
+    def users_with_most_reacts(self, team_id, count=5, window=None):
+        with self._lock:
+            state = self._query(team_id)[0]
+            counts = self._react_counts(state, team_id, 'user', len(state.users), since=self._since(window),
+                                        unfiltered=window is None)
+            return {user: (n,) for user, n in _top(counts, count, state.users.values, state.users.get(None))
+                    if user}
+
+    def most_active(self, team_id, count=5, window=None):
+        with self._lock:
+            state, team = self._query(team_id)
+            since = self._since(window)
+            counts = self._react_counts(state, team_id, 'user', len(state.users), since=since,
+                                        unfiltered=window is None)
+            if team is not None:
+                messages = self._message_mask(state, team, since=since)
+                counts += self._bincount(team, 'posters', team.message_cols.user, messages, len(state.users),
+                                         window is None)
+            return _top(counts, count, state.users.values, state.users.get(None))
+
+    def most_reacted_to_posts(self, team_id, user=None, channel=None, count=5, window=None):
+        with self._lock:
+            state, team = self._query(team_id)
+            mask = team and self._message_mask(state, team, user, channel, self._since(window))
+            if mask is None:
+                return []
+            totals = team.memo('totals', lambda: np.bincount(team.react_cols.msg[team.react_cols.alive],
+                                                             minlength=team.message_cols.size))
+            top = _top(np.where(mask, totals, 0), count, team.messages.values)
+        texts = self._texts([msg_id for msg_id, _ in top])
+        # Messages deleted since, as the SQL join leaves them out
+        return [(texts[msg_id], total) for msg_id, total in top if msg_id in texts]
+
+    def most_unique_reacts_on_a_post(self, team_id, user=None, channel=None, count=5, window=None):
+        with self._lock:
+            state, team = self._query(team_id)
+            mask = team and self._message_mask(state, team, user, channel, self._since(window))
+            if mask is None:
+                return []
+            cols = team.react_cols
+            width = max(1, len(state.react_names))
+
+            def distinct():
+                pairs = np.unique(cols.msg[cols.alive].astype(np.int64) * width + cols.react[cols.alive])
+                return np.bincount(pairs // width, minlength=team.message_cols.size)
+
+            counts = np.where(mask & team.message_cols.has_text, team.memo('distinct', distinct), 0)
+            top = _top(counts, count, range(len(counts)))
+            rows = np.array([row for row, _ in top], dtype=np.int32)
+            on_top = cols.alive & np.isin(cols.msg, rows)
+            reacts = {}
+            for row, name in zip(cols.msg[on_top].tolist(), cols.react[on_top].tolist()):
+                reacts.setdefault(row, set()).add(state.react_names.values[name])
+            msg_ids = [team.messages.values[row] for row, _ in top]
+        texts = self._texts(msg_ids)
+        return [(texts[msg_id], reacts[row]) for msg_id, (row, _) in zip(msg_ids, top) if msg_id in texts]
+
+    def _texts(self, msg_ids):
+        if not msg_ids:
+            return {}
+        return dict(db.execute(MESSAGE_TEXTS_BY_ID.format(', '.join(['%s'] * len(msg_ids))), tuple(msg_ids)))
+
+    def stats(self):
+        stats = dict(self._stats)
+        state = self.state
+        if state is not None:
+            stats['teams'] = len(state.teams)
+            stats['messages'] = sum(team.message_cols.size for team in state.teams.values())
+            stats['reacts'] = sum(team.react_cols.size for team in state.teams.values())
+            stats['array_bytes'] = sum(team.nbytes() for team in state.teams.values())
+        return stats
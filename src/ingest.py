@@ -0,0 +1,230 @@
+import os
+import threading
+import time
+import log
+from collections import Counter
+import db
+import metrics
+from util import ADD_MESSAGE, REMOVE_MESSAGE, ADD_REACT, REMOVE_REACT
+
+
+# A batch is flushed when it reaches INGEST_BATCH_SIZE events or when its
+# oldest event has waited INGEST_BATCH_MS milliseconds, whichever comes first
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 500))
+INGEST_BATCH_MS = int(os.environ.get('INGEST_BATCH_MS', 200))
+# Times a failing batch is retried before it is dropped
+INGEST_MAX_RETRIES = int(os.environ.get('INGEST_MAX_RETRIES', 3))
+
+EVENTS_INGESTED = metrics.counter('events_ingested_total', 'API events written to the database, by op', ('op',))
+EVENTS_DROPPED = metrics.counter('events_dropped_total', 'Events dropped before reaching the database, by reason',
+                                 ('reason',))
+
+
+def coalesce(ops):
+    '''
+    Reduces an ordered list of (op, obj) pairs to the sets of rows to delete and
+    insert, keeping the outcome of applying the ops one at a time.
+
+    React ops that come before the batch's first op on their message saw the
+    message as it is in the database, so they are returned separately and
+    written before the messages. Later ones are written after, except while
+    the message is deleted in the batch, when they are dropped: there is no
+    message to react to and its reacts are already gone.
+
+    Returns:
+        tuple: (message_removes, message_adds, react_removes, react_adds,
+                early_react_removes, early_react_adds)
+    '''
+    messages = {}   # msg_id -> [removed, Message or None]
+    early = {}      # (msg_id, user_id, name) -> [React to delete or None, [React...]]
+    reacts = {}
+    reacts_by_msg = {}
+
+    for op, obj in ops:
+        if op == ADD_MESSAGE:
+            state = messages.setdefault(obj.msg_id, [False, None])
+            # Messages are keyed on their ID, so only the first insert sticks
+            if state[1] is None:
+                state[1] = obj
+        elif op == REMOVE_MESSAGE:
+            messages[obj.msg_id] = [True, None]
+            # Deleting a message deletes its reacts, including ones added earlier
+            # in this batch
+            for key in reacts_by_msg.get(obj.msg_id, ()):
+                reacts[key][1] = []
+        elif op in (ADD_REACT, REMOVE_REACT):
+            message = messages.get(obj.msg_id)
+            if message is None:
+                states = early
+            elif message[0] and message[1] is None:
+                continue
+            else:
+                states = reacts
+                reacts_by_msg.setdefault(obj.msg_id, set()).add((obj.msg_id, obj.user_id, obj.name))
+            state = states.setdefault((obj.msg_id, obj.user_id, obj.name), [None, []])
+            if op == ADD_REACT:
+                # A user can only leave a given react on a message once
+                state[1] = [obj]
+            else:
+                state[0] = obj
+                state[1] = []
+
+    message_removes = [msg_id for msg_id, (removed, _) in messages.items() if removed]
+    message_adds = [msg for _, msg in messages.values() if msg is not None]
+    return (message_removes, message_adds) + _react_rows(reacts) + _react_rows(early)
+
+
+def _react_rows(reacts):
+    return ([removed for removed, _ in reacts.values() if removed is not None],
+            [react for _, adds in reacts.values() for react in adds])
+
+
+class EventBatcher(object):
+    '''
+    Write-behind buffer between the event queue and db. Events are collected
+    and written with db.write_batch from a background thread.
+
+    Exposes the same add/remove functions as db so callers can use either.
+    '''
+    def __init__(self, max_items=INGEST_BATCH_SIZE, max_latency_ms=INGEST_BATCH_MS,
+                 writer=db.write_batch):
+        self.max_items = max_items
+        self.max_latency = max_latency_ms / 1000.0
+        self.writer = writer
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._oldest = None
+        self._failures = 0
+        self._closed = False
+        self._thread = None
+        self._stats = {'flushes': 0,
+                       'events': 0,
+                       'rows': 0,
+                       'dropped': 0,
+                       'last_flush_size': 0,
+                       'last_flush_ms': 0.0,
+                       'max_flush_ms': 0.0,
+                       'total_flush_ms': 0.0,
+                       'last_rows_per_sec': 0.0}
+
+    def add_message(self, msg):
+        self._put(ADD_MESSAGE, msg)
+
+    def remove_message(self, msg):
+        self._put(REMOVE_MESSAGE, msg)
+
+    def add_react(self, react):
+        self._put(ADD_REACT, react)
+
+    def remove_react(self, react):
+        self._put(REMOVE_REACT, react)
+
+    def _put(self, op, obj):
+        if not obj:
+            return
+        with self._cond:
+            if not self._pending:
+                self._oldest = time.time()
+            self._pending.append((op, obj))
+            # Wake the flusher to start the latency timer, or to flush a full batch
+            if len(self._pending) == 1 or len(self._pending) >= self.max_items:
+                self._cond.notify()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='event-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._pending:
+                        wait = self._oldest + self.max_latency - time.time()
+                        if wait <= 0 or len(self._pending) >= self.max_items:
+                            break
+                    else:
+                        wait = None
+                    self._cond.wait(wait)
+                if self._closed:
+                    return
+            self.flush()
+
+    def flush(self, retry=True):
+        '''
+        Writes everything pending as one transaction. Returns the number of
+        events flushed.
+
+        On failure the events are kept and retried, up to INGEST_MAX_RETRIES
+        times. With retry=False they are dropped and the error is raised
+        instead, for callers that redeliver events themselves.
+        '''
+        with self._flush_lock:
+            return self._flush(retry)
+
+    def _flush(self, retry):
+        with self._cond:
+            ops, self._pending = self._pending, []
+            self._oldest = None
+        if not ops:
+            return 0
+
+        batch = coalesce(ops)
+        start = time.time()
+        try:
+            self.writer(*batch)
+        except Exception as e:
+            if not retry:
+                raise
+            self._failures += 1
+            if self._failures > INGEST_MAX_RETRIES:
+                log.log_error('Dropping batch of %d events after %d failures: %s'
+                              % (len(ops), self._failures, e))
+                self._failures = 0
+                self._stats['dropped'] += len(ops)
+                EVENTS_DROPPED.inc('batch_failed', amount=len(ops))
+            else:
+                log.log_error('Batch write failed, will retry: ' + str(e))
+                with self._cond:
+                    self._pending = ops + self._pending
+                    self._oldest = start
+            return 0
+        self._failures = 0
+        for op, op_count in Counter(op for op, _ in ops).items():
+            EVENTS_INGESTED.inc(op, amount=op_count)
+
+        elapsed_ms = (time.time() - start) * 1000
+        rows = sum(len(part) for part in batch)
+        stats = self._stats
+        stats['flushes'] += 1
+        stats['events'] += len(ops)
+        stats['rows'] += rows
+        stats['last_flush_size'] = len(ops)
+        stats['last_flush_ms'] = elapsed_ms
+        stats['max_flush_ms'] = max(stats['max_flush_ms'], elapsed_ms)
+        stats['total_flush_ms'] += elapsed_ms
+        stats['last_rows_per_sec'] = rows / (elapsed_ms / 1000) if elapsed_ms else 0.0
+        return len(ops)
+
+    def stats(self):
+        '''
+        Returns flush size, flush latency and throughput numbers for tuning
+        INGEST_BATCH_SIZE and INGEST_BATCH_MS.
+        '''
+        stats = dict(self._stats)
+        flushes = stats['flushes']
+        stats['pending'] = len(self._pending)
+        stats['mean_flush_size'] = stats['events'] / flushes if flushes else 0.0
+        stats['mean_flush_ms'] = stats['total_flush_ms'] / flushes if flushes else 0.0
+        stats['rows_per_sec'] = (stats['rows'] / (stats['total_flush_ms'] / 1000)
+                                 if stats['total_flush_ms'] else 0.0)
+        return stats
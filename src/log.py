@@ -1,8 +1,17 @@
-import inspect
+import os
+import sys
+import json
+import time
 import logging
+import metrics
 
 logging.basicConfig(level=logging.WARNING)
 
+# 'json' prints one JSON object per line for log collectors
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+
+LOG_MESSAGES = metrics.counter('log_messages_total', 'Messages logged, by level', ('level',))
+
 def log_error(msg):
     log(msg, logging.ERROR)
 
@@ -13,5 +22,13 @@ def log_debug(msg):
     log(msg, logging.DEBUG)
 
 def log(msg, level):
-    calling_function = inspect.stack()[2][3]
-    print('From ' + calling_function + ": " + msg)
\ No newline at end of file
+    # Only looks up the caller of log_*, inspect.stack() builds (and reads
+    # the source of) every frame on the stack
+    calling_function = sys._getframe(2).f_code.co_name
+    level_name = logging.getLevelName(level)
+    LOG_MESSAGES.inc(level_name)
+    if LOG_FORMAT == 'json':
+        print(json.dumps({'time': time.time(), 'level': level_name, 'pid': os.getpid(),
+                          'function': calling_function, 'message': msg}))
+    else:
+        print('From ' + calling_function + ": " + msg)
@@ -0,0 +1,431 @@
+'''
+Prometheus metrics, served by app.py on /metrics. Modules create their
+counters, gauges and histograms at import time and update them in place:
+
+    EVENTS_DROPPED = metrics.counter('events_dropped_total', 'Events dropped', ('reason',))
+    EVENTS_DROPPED.inc('duplicate')
+
+    QUERY_SECONDS = metrics.histogram('db_query_seconds', 'Query latency', ('statement',))
+    with QUERY_SECONDS.time(name):
+        ...
+
+Objects that already keep a stats() dict register it with register() and
+its numbers are exported as gauges when metrics are rendered.
+
+Events are handled in a process forked from the web process (or in
+consumer.py), so every process writes its metrics to METRICS_DIR each
+METRICS_EXPORT_INTERVAL seconds and render() merges the files it finds
+there: counters and histograms are summed over processes and gauges get a
+pid label. When a process has exited its counters and histograms are
+added to EXITED_FILE before its file is removed, so the totals never go
+down and Prometheus doesn't see a counter reset.
+'''
+import os
+import atexit
+import json
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import wraps
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+METRICS_PREFIX = 'react_analytics_'
+# Shared by every process on the host, empty to only render this process
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'react_analytics_metrics'))
+METRICS_EXPORT_INTERVAL = float(os.environ.get('METRICS_EXPORT_INTERVAL', 10))
+# Exports not rewritten for this many intervals are checked for an exited process
+METRICS_STALE_INTERVALS = 3
+# Totals of the exited processes, in METRICS_DIR
+EXITED_FILE = 'exited.json'
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_metrics = OrderedDict()
+_collectors = OrderedDict()
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = METRICS_PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def samples(self):
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        if _exporter is None:
+            start_exporter()
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        if _exporter is None:
+            start_exporter()
+        with self._lock:
+            self._values[labels] = value
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Histogram(Metric):
+    '''
+    Cumulative buckets with the Prometheus le semantics. A sample is
+    [bucket counts, sum], the last bucket being +Inf.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        if _exporter is None:
+            start_exporter()
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            sample = self._values.get(labels)
+            if sample is None:
+                sample = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            sample[0][bucket] += 1
+            sample[1] += value
+
+    def samples(self):
+        with self._lock:
+            return [[list(labels), [list(counts), total]] for labels, (counts, total) in self._values.items()]
+
+    def time(self, *labels):
+        '''
+        Context manager observing the seconds its block takes
+        '''
+        return _Timer(self, labels)
+
+    def timed(self, label=None):
+        '''
+        Decorator observing the seconds each call takes, labelled with label
+        or the function's name
+        '''
+        def decorator(func):
+            name = label or func.__name__
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, name)
+            return wrapper
+        return decorator
+
+
+def _get_or_create(cls, name, help, labels, **kwargs):
+    metric = _metrics.get(METRICS_PREFIX + name)
+    if metric is None:
+        metric = _metrics[METRICS_PREFIX + name] = cls(name, help, labels, **kwargs)
+    return metric
+
+def counter(name, help, labels=()):
+    return _get_or_create(Counter, name, help, labels)
+
+def gauge(name, help, labels=()):
+    return _get_or_create(Gauge, name, help, labels)
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return _get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+
+def register(name, stats, label=None):
+    '''
+    Exports the numbers in the dict stats() returns as gauges named
+    <name>_<key>. Nested dicts, such as EventLog.stats()'s per partition
+    numbers, are exported with their key as the label named label.
+    Registering a name again replaces its collector.
+    '''
+    _collectors[name] = (stats, label)
+    if _exporter is None:
+        start_exporter()
+
+
+def _collect():
+    collected = OrderedDict()
+    for name, (stats, label) in list(_collectors.items()):
+        try:
+            values = stats()
+        except Exception:
+            continue
+        for key, value in values.items():
+            if isinstance(value, dict) and label:
+                for sub_key, sub_value in value.items():
+                    _add_collected(collected, name, sub_key, [label], [str(key)], sub_value)
+            else:
+                _add_collected(collected, name, key, [], [], value)
+    return collected
+
+def _add_collected(collected, name, key, label_names, label_values, value):
+    if isinstance(value, bool):
+        value = int(value)
+    if not isinstance(value, (int, float)):
+        return
+    metric_name = '%s%s_%s' % (METRICS_PREFIX, name, key)
+    metric = collected.setdefault(metric_name, {'kind': 'gauge', 'help': '%s stats %s' % (name, key),
+                                                'labels': label_names, 'samples': []})
+    metric['samples'].append([label_values, value])
+
+
+def snapshot():
+    '''
+    This process's metrics and collected stats in a JSON friendly form
+    '''
+    result = OrderedDict()
+    for name, metric in list(_metrics.items()):
+        result[name] = {'kind': metric.kind, 'help': metric.help, 'labels': list(metric.labels),
+                        'samples': metric.samples()}
+        if metric.kind == 'histogram':
+            result[name]['buckets'] = list(metric.buckets)
+    result.update(_collect())
+    return {'pid': os.getpid(), 'time': time.time(), 'metrics': result}
+
+
+def _write(path, snap):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snap, f)
+    os.replace(path + '.tmp', path)
+
+
+def export():
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _write(os.path.join(METRICS_DIR, '%d.json' % os.getpid()), snapshot())
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # Removed or half written by its process, picked up next time
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        pass
+    return True
+
+
+def _exports():
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return []
+    stale = time.time() - METRICS_STALE_INTERVALS * METRICS_EXPORT_INTERVAL
+    result = []
+    exited = []
+    for file_name in os.listdir(METRICS_DIR):
+        pid = file_name[:-len('.json')]
+        if not file_name.endswith('.json') or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        path = os.path.join(METRICS_DIR, file_name)
+        try:
+            if os.path.getmtime(path) < stale and not _alive(int(pid)):
+                exited.append(path)
+                continue
+        except OSError:
+            continue
+        snap = _read(path)
+        if snap is not None:
+            result.append(snap)
+    if exited:
+        _fold_exited(exited)
+    snap = _read(os.path.join(METRICS_DIR, EXITED_FILE))
+    if snap is not None:
+        result.append(snap)
+    return result
+
+
+def _fold_exited(paths):
+    '''
+    Adds the counters and histograms in the exports of exited processes to
+    EXITED_FILE and removes the exports. Gauges are dropped with them.
+    '''
+    lock = open(os.path.join(METRICS_DIR, EXITED_FILE + '.lock'), 'w')
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        exited_path = os.path.join(METRICS_DIR, EXITED_FILE)
+        # Another process may have folded some of them while this one waited
+        snaps = [snap for snap in map(_read, [exited_path] + paths) if snap is not None]
+        merged = _merge(snaps)
+        _write(exited_path, {'pid': 'exited', 'time': time.time(),
+                             'metrics': _unmerge(merged, kinds=('counter', 'histogram'))})
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    finally:
+        lock.close()
+
+
+def _unmerge(merged, kinds):
+    '''
+    _merge's result back in the snapshot form, keeping the metrics of kinds
+    '''
+    result = OrderedDict()
+    for name, metric in merged.items():
+        if metric['kind'] not in kinds:
+            continue
+        result[name] = {'kind': metric['kind'], 'help': metric['help'], 'labels': metric['labels'],
+                        'samples': [[list(labels), list(value) if metric['kind'] == 'histogram' else value]
+                                    for labels, value in metric['samples'].items()]}
+        if metric['buckets'] is not None:
+            result[name]['buckets'] = metric['buckets']
+    return result
+
+
+def _export_loop():
+    while True:
+        time.sleep(METRICS_EXPORT_INTERVAL)
+        try:
+            export()
+        except OSError:
+            pass
+
+
+def start_exporter():
+    '''
+    Starts writing this process's metrics to METRICS_DIR, once per process.
+    Called on the first update or register() so processes that never
+    record anything don't export.
+    '''
+    global _exporter
+    with _exporter_lock:
+        if _exporter is not None:
+            return
+        _exporter = threading.Thread(target=_export_loop, daemon=True)
+        if METRICS_DIR:
+            _exporter.start()
+            # What was counted since the last export
+            atexit.register(_export_at_exit)
+
+
+def _export_at_exit():
+    try:
+        export()
+    except OSError:
+        pass
+
+
+def _after_fork():
+    # The child starts from zero rather than counting the parent's events twice
+    global _exporter, _exporter_lock
+    _exporter = None
+    _exporter_lock = threading.Lock()
+    for metric in _metrics.values():
+        metric._lock = threading.Lock()
+        metric.reset()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _merge(snapshots):
+    merged = OrderedDict()
+    for snap in snapshots:
+        pid = str(snap['pid'])
+        for name, metric in snap['metrics'].items():
+            into = merged.get(name)
+            if into is None:
+                labels = metric['labels'] + (['pid'] if metric['kind'] == 'gauge' else [])
+                into = merged[name] = {'kind': metric['kind'], 'help': metric['help'], 'labels': labels,
+                                       'buckets': metric.get('buckets'), 'samples': OrderedDict()}
+            samples = into['samples']
+            for labels, value in metric['samples']:
+                if metric['kind'] == 'gauge':
+                    samples[tuple(labels) + (pid,)] = value
+                elif metric['kind'] == 'counter':
+                    samples[tuple(labels)] = samples.get(tuple(labels), 0) + value
+                else:
+                    counts, total = samples.get(tuple(labels), ([0] * len(value[0]), 0.0))
+                    samples[tuple(labels)] = ([a + b for a, b in zip(counts, value[0])], total + value[1])
+    return merged
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)) + '}'
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    '''
+    Every process's metrics in the Prometheus text exposition format
+    '''
+    lines = []
+    for name, metric in _merge([snapshot()] + _exports()).items():
+        lines.append('# HELP %s %s' % (name, metric['help'].replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE %s %s' % (name, metric['kind']))
+        names = metric['labels']
+        for labels, value in metric['samples'].items():
+            if metric['kind'] != 'histogram':
+                lines.append('%s%s %s' % (name, _labels(names, labels), _number(value)))
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, bucket_count in zip(list(metric['buckets']) + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (name, _labels(names + ['le'], list(labels) + [bound]),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (name, _labels(names, labels), _number(total)))
+            lines.append('%s_count%s %d' % (name, _labels(names, labels), cumulative))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,196 @@
+import string
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from nltk.util import ngrams
+
+up_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+stop_words_file = up_dir + '/stopwords.txt'
+stop_words = set(line.strip() for line in open(stop_words_file))
+stop_words.add('')
+
+punc = string.punctuation
+# Not sure what codec these two characters are from
+# but they are different than the quotes found in
+# string.punctuation and are not being removed
+punc += '”'
+punc += '“'
+
+# Messages we don't want used in the common_phrases method
+# because they're posted by slack
+omit_phrases = ['joined the channel', 'left the channel',
+                'pinned a message', 'uploaded a file']
+
+PHRASE_LENGTH = 3
+# Longer phrases are skipped, they are almost always URLs or code and would not
+# fit in a btree index entry
+MAX_PHRASE_CHARS = 200
+
+
+def phrases(text):
+    '''
+    Splits a message into the phrases counted by common_phrases. This is the
+    only place phrases are normalized and filtered, and it runs once per
+    message at ingest.
+
+	Args:
+		text (str) : message text
+
+	Returns:
+		list: phrases as space joined strings, repeated as often as they occur
+    '''
+    if not text:
+        return []
+    result = []
+    for phrase in ngrams(text.split(' '), PHRASE_LENGTH):
+        if any(word in punc for word in phrase):
+            continue
+        phrase = ' '.join(phrase)
+        if phrase in omit_phrases or len(phrase) > MAX_PHRASE_CHARS:
+            continue
+        result.append(phrase)
+    return result
+
+
+# Longer tokens are dropped from the word index for the same reason
+MAX_TOKEN_CHARS = 200
+translator = str.maketrans('', '', punc)
+
+
+# One pass over a token finds channel (<#C123>) and user (<@U123>) mentions.
+# Only the '<' is consumed so a mention nested inside another is still found.
+# Slack adds the name to some mentions (<#C123|general>), which is ignored.
+MENTION_EXPR = re.compile('<(?=([#@])([^|>]*)[^>]*>)')
+# A mention in a word, pulled out before the word is lowercased and its
+# punctuation stripped, either of which would lose the ID
+MENTION_TOKEN = re.compile('<[#@][^<>]*>')
+# Cached word translations are dropped once the cache gets this big
+TOKEN_CACHE_SIZE = 200000
+
+
+class Tokenizer(object):
+    '''
+    Batch tokenizer behind message_tokens and analytics.unique_words.
+
+    Every distinct raw word is translated (mention pulled out, or lowercased
+    and punctuation stripped) and interned once, then looked up, so repeated
+    words cost a dict hit. Counting goes through Counter.update over all
+    messages at once. One tokenizer is shared by the worker threads, so the
+    cache is only touched under a lock.
+    '''
+    def __init__(self, cache_size=TOKEN_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _translate_words(self, words):
+        with self._lock:
+            cache = self._cache
+            missing = [w for w in words if w not in cache]
+            if missing:
+                if len(cache) + len(missing) > self.cache_size:
+                    cache.clear()
+                    missing = words
+                for w in missing:
+                    cache[w] = translate_word(w)
+            tokens = {cache[w] for w in words}
+        # Stop words translate to None
+        tokens.discard(None)
+        return tokens
+
+    def tokens(self, text):
+        '''
+        Returns the set of distinct tokens in text. Stop words are checked
+        before punctuation is stripped, and mentions are kept as they are
+        written.
+        '''
+        if not text:
+            return set()
+        return self._translate_words(set(text.split(' ')))
+
+    def tokenize_batch(self, texts):
+        '''
+        Returns a token set for each non empty text
+        '''
+        return [self.tokens(text) for text in texts if text]
+
+    def count(self, texts, users, channels):
+        '''
+        Counts the number of texts each token appears in, with mentions
+        translated to display/channel names
+
+	Args:
+		texts    (iterable) : message texts
+		users    (dict)     : user ID -> display name
+		channels (dict)     : channel ID -> channel name
+
+	Returns:
+		Counter: token -> number of messages
+        '''
+        counts = Counter()
+        for token_set in self.tokenize_batch(texts):
+            counts.update(token_set)
+
+        # Only tokens that can hold a mention need the regex
+        mentions = [token for token in counts if '<' in token]
+        for token in mentions:
+            key = resolve_mention(token, users, channels)
+            if key != token:
+                counts[key] += counts.pop(token)
+        return counts
+
+
+def translate_word(word):
+    '''
+    Returns the token for a word of a message, or None for stop words
+    '''
+    if '<' in word:
+        mention = MENTION_TOKEN.search(word)
+        if mention:
+            return sys.intern(mention.group(0))
+    word = word.lower()
+    if word in stop_words:
+        return None
+    return sys.intern(word.translate(translator))
+
+
+def resolve_mention(token, users, channels):
+    '''
+    Converts a token holding an escaped channel or user to its name. Channels
+    win over users, and unknown IDs leave the token unchanged.
+    '''
+    user_id = None
+    for match in MENTION_EXPR.finditer(token):
+        if match.group(1) == '#':
+            return channels.get(match.group(2), token)
+        if user_id is None:
+            user_id = match.group(2)
+    if user_id is not None:
+        return users.get(user_id, token)
+    return token
+
+
+tokenizer = Tokenizer()
+
+
+def message_tokens(text):
+    '''
+    Splits a message into the set of words react_buzzword counts. Stop words
+    are checked before punctuation is stripped.
+
+	Args:
+		text (str) : message text
+
+	Returns:
+		set: distinct tokens in the message
+    '''
+    return tokenizer.tokens(text)
+
+
+def indexed_tokens(text):
+    '''
+    Tokens from message_tokens that are stored in the MessageWords index
+    '''
+    return [t for t in message_tokens(text) if len(t) <= MAX_TOKEN_CHARS]
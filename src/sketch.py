@@ -0,0 +1,761 @@
+'''
+Approximate analytics for very large workspaces. Enable with
+ANALYTICS_SKETCHES=on and get_common_phrases, react_buzzword and
+most_unique_reacts_on_a_post are answered from fixed size sketches instead
+of the PhraseCounts and MessageWords tables:
+
+    phrases          Count-Min Sketch of trigram counts, plus the candidates
+                     for the top SKETCH_TOP_K phrases
+    buzzwords        one Count-Min Sketch of (react, word) counts, plus the
+                     candidates for each react's top SKETCH_REACT_TOP_K words
+    unique reacts    a HyperLogLog of react names per message, for up to
+                     SKETCH_MESSAGES messages
+
+Error bounds, with N the total count in a Count-Min Sketch (every trigram
+occurrence, or every word of every reacted message once per react):
+
+    counts      never under the true count while nothing is removed, and
+                over it by at most e / SKETCH_WIDTH * N with probability
+                1 - exp(-SKETCH_DEPTH). With the defaults, 0.004% of N in
+                98% of cases. Conservative updates keep the actual error
+                far below the bound, see CountMinSketch.add.
+    top-K       a key is dropped from the candidates only when its estimate
+                falls below the floor of the kept ones, and let back in with
+                its full count the next time it is updated, so any key more
+                common than the floor plus the count error is listed.
+    distinct    standard error 1.04 / sqrt(2 ** SKETCH_HLL_PRECISION), 13%
+                at the default 6, but the few names on a typical message are
+                counted with linear counting, which is close to exact until
+                most registers are set.
+
+Memory per team is 2 * SKETCH_DEPTH * SKETCH_WIDTH * 4 bytes for the two
+Count-Min Sketches (2 MiB by default), SKETCH_MESSAGES * (2 **
+SKETCH_HLL_PRECISION + 4) bytes of registers (6.8 MB) plus the message IDs,
+and up to twice SKETCH_TOP_K phrases and SKETCH_REACT_TOP_K words per react
+name. When SKETCH_MESSAGES messages have reacts, the half with the fewest
+are dropped and start again from zero if reacted to later. Past
+SKETCH_MAX_BYTES of arrays across all teams, the least recently used teams
+are saved and dropped from memory, and read back from the Sketches table
+the next time a write or command needs them.
+
+db records the rows every write adds or deletes and the sketches are updated
+once the write commits. They are saved to the Sketches table every
+SKETCH_SAVE_INTERVAL seconds and when the process exits, and loaded from it
+at startup, or built from the database the first time. Each is stored as a
+versioned header and the raw arrays, see TeamSketches.dumps, and rows of
+another version are rebuilt like ones with other settings. A crash loses
+the changes since the last save. Rebuild them with
+
+    python sketch.py --rebuild
+
+after a crash, after backfill.py (which writes from its own process), or to
+change the settings. Sketches are kept by the process handling events, so
+approximate mode is for the local event queue, not EVENT_CONSUMER=redis.
+
+What the sketches can't answer is left to the exact queries: commands with a
+window, user or channel. With ANALYTICS_ENGINE on as well, the engine
+answers most_unique_reacts_on_a_post exactly. Removed reacts are subtracted from the buzzword
+counts but stay in the distinct counts, which a HyperLogLog can't take back.
+'''
+import os
+import heapq
+import json
+import math
+import struct
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from hashlib import blake2b
+from operator import itemgetter
+import db
+import log
+import nlp
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+ANALYTICS_SKETCHES = os.environ.get('ANALYTICS_SKETCHES')
+# Counters per row and rows of each Count-Min Sketch
+SKETCH_WIDTH = int(os.environ.get('SKETCH_WIDTH', 65536))
+SKETCH_DEPTH = int(os.environ.get('SKETCH_DEPTH', 4))
+# Phrases, and words per react name, that can be listed
+SKETCH_TOP_K = int(os.environ.get('SKETCH_TOP_K', 100))
+SKETCH_REACT_TOP_K = int(os.environ.get('SKETCH_REACT_TOP_K', 25))
+# 2 ** precision one byte registers per message
+SKETCH_HLL_PRECISION = int(os.environ.get('SKETCH_HLL_PRECISION', 6))
+# Messages with a HyperLogLog, per team
+SKETCH_MESSAGES = int(os.environ.get('SKETCH_MESSAGES', 100000))
+# Seconds between saves to the Sketches table
+SKETCH_SAVE_INTERVAL = int(os.environ.get('SKETCH_SAVE_INTERVAL', 300))
+# Bytes of arrays kept in memory across all teams, 1 GiB or about a hundred
+# teams with full HyperLogLogs at the defaults
+SKETCH_MAX_BYTES = int(os.environ.get('SKETCH_MAX_BYTES', 1 << 30))
+
+# Most recently saved first, those are loaded until SKETCH_MAX_BYTES
+LOAD_SKETCHES = 'SELECT TeamID, Data FROM Sketches ORDER BY UpdatedAt DESC'
+LOAD_TEAM_SKETCH = 'SELECT Data FROM Sketches WHERE TeamID = %s'
+SAVE_SKETCH = '''INSERT INTO Sketches (TeamID, Data, UpdatedAt) VALUES (%s, %s, %s)
+    ON CONFLICT (TeamID) DO UPDATE SET Data = EXCLUDED.Data, UpdatedAt = EXCLUDED.UpdatedAt'''
+MESSAGE_TEXTS = 'SELECT MessageID, TeamID, Text FROM Messages'
+REACT_NAMES = 'SELECT MessageID, TeamID, ReactName FROM Reacts'
+REACT_WORDS = '''SELECT Reacts.TeamID, Reacts.ReactName, MessageWords.Word FROM Reacts
+    INNER JOIN MessageWords ON MessageWords.MessageID=Reacts.MessageID'''
+# Rows applied at a time when building from the database
+BUILD_BATCH_SIZE = 10000
+
+# Start of a saved TeamSketches: magic, format version and the length of the
+# JSON that follows, see TeamSketches.dumps
+SKETCH_MAGIC = b'RASK'
+SKETCH_FORMAT = 1
+SKETCH_HEADER = struct.Struct('<4sHI')
+
+
+def hash64(keys):
+    '''
+    Stable 64 bit hashes of strings as a uint64 array. hash() is salted per
+    process, and the sketches outlive it.
+    '''
+    return np.frombuffer(b''.join([blake2b(key.encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+                                   for key in keys]), '<u8')
+
+
+class CountMinSketch(object):
+    '''
+    Counts of string keys in depth rows of width counters. A key adds to one
+    counter per row and its estimate is the smallest of them, see the module
+    docstring for the bounds. Counts can be subtracted again, as long as no
+    key is removed more often than it was added.
+    '''
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), np.int32)
+        self.total = 0
+        self._rows = np.arange(depth, dtype=np.uint64)[:, None]
+
+    def _columns(self, hashes):
+        # Row i uses low + i * high, two hashes are as good as depth of them
+        low = hashes & np.uint64(0xffffffff)
+        high = (hashes >> np.uint64(32)) | np.uint64(1)
+        return ((low + self._rows * high) % np.uint64(self.width)).astype(np.intp)
+
+    def add(self, keys, counts):
+        '''
+        Adds counts to keys, each key given once, and returns their new
+        estimates.
+
+        Additions are conservative updates: a counter is only raised as far
+        as the key's new estimate, as a counter above it already counts
+        other keys. This takes the word counts of bench.py sketch from 65%
+        to 0.1% over at the default width. Removals come off every row,
+        which can leave the keys sharing a counter with the removed one
+        under their true count by up to the amount removed.
+        '''
+        columns = self._columns(hash64(keys))
+        rows = self._rows.astype(np.intp)
+        counts = np.asarray(counts, np.int32)
+        added = counts > 0
+        if added.any():
+            cols = columns[:, added]
+            raised = self.table[rows, cols].min(axis=0) + counts[added]
+            np.maximum.at(self.table, (rows, cols), np.broadcast_to(raised, cols.shape))
+        if not added.all():
+            np.add.at(self.table, (rows, columns[:, ~added]), counts[~added])
+        self.total += int(counts.sum())
+        return self.table[rows, columns].min(axis=0)
+
+    def estimate(self, keys):
+        columns = self._columns(hash64(keys))
+        return self.table[self._rows.astype(np.intp), columns].min(axis=0)
+
+    def error(self):
+        '''
+        Most an estimate is over its true count with probability 1 - exp(-depth)
+        '''
+        return math.e / self.width * self.total
+
+    def nbytes(self):
+        return self.table.nbytes
+
+
+class TopK(object):
+    '''
+    Candidates for the k keys with the highest Count-Min estimates. Every
+    updated key is offered with its estimate, which covers all of its
+    history, so a key that was dropped comes back as soon as it beats the
+    floor. Up to 2k are kept between trims back to the top k.
+    '''
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        self.floor = 0
+
+    def offer(self, keys, estimates):
+        counts = self.counts
+        for key, estimate in zip(keys, estimates):
+            if estimate <= 0:
+                counts.pop(key, None)
+            elif estimate > self.floor or key in counts:
+                counts[key] = estimate
+        if len(counts) >= 2 * self.k:
+            kept = heapq.nlargest(self.k, counts.items(), key=itemgetter(1))
+            self.counts = dict(kept)
+            self.floor = kept[-1][1]
+
+    def top(self, count, sketch, prefix=''):
+        '''
+        The count candidates with the highest current estimates in sketch,
+        where they are keyed with prefix. The kept estimates are from each
+        key's last update and miss collisions since.
+        '''
+        keys = list(self.counts)
+        if not keys:
+            return []
+        estimates = sketch.estimate([prefix + key for key in keys]).tolist()
+        self.counts = dict(zip(keys, estimates))
+        ranked = sorted(zip(keys, estimates), key=lambda item: (-item[1], item[0]))
+        return [item for item in ranked[:count] if item[1] > 0]
+
+
+class HyperLogLogs(object):
+    '''
+    A HyperLogLog of react names for each message, as the rows of one uint8
+    register matrix that grows by doubling up to capacity messages. Names
+    can't be removed. At capacity, the half of the messages with the lowest
+    estimates are dropped.
+    '''
+    def __init__(self, precision=SKETCH_HLL_PRECISION, capacity=SKETCH_MESSAGES):
+        self.precision = precision
+        self.m = 1 << precision
+        self.capacity = capacity
+        self.registers = np.zeros((16, self.m), np.uint8)
+        self.estimates = np.zeros(16, np.float32)
+        self.rows = {}
+        self.ids = []
+        self.free = []
+        if self.m <= 16:
+            self.alpha = 0.673
+        elif self.m <= 32:
+            self.alpha = 0.697
+        elif self.m <= 64:
+            self.alpha = 0.709
+        else:
+            self.alpha = 0.7213 / (1 + 1.079 / self.m)
+
+    def add(self, msg_ids, names):
+        new = len(set(msg_ids) - self.rows.keys())
+        available = len(self.free) + self.capacity - len(self.ids)
+        if new > available:
+            self._evict(new - available)
+        rows = np.fromiter((self._row(msg_id) for msg_id in msg_ids), np.intp, len(msg_ids))
+        bits = 64 - self.precision
+        index, ranks = [], []
+        for h in hash64(names).tolist():
+            index.append(h >> bits)
+            ranks.append(bits - (h & ((1 << bits) - 1)).bit_length() + 1)
+        np.maximum.at(self.registers, (rows, np.array(index, np.intp)), np.array(ranks, np.uint8))
+        touched = np.unique(rows)
+        self.estimates[touched] = self._estimate(self.registers[touched])
+
+    def _estimate(self, registers):
+        m = self.m
+        raw = self.alpha * m * m / np.sum(np.ldexp(1.0, -registers.astype(np.int32)), axis=1)
+        zeros = np.count_nonzero(registers == 0, axis=1)
+        small = (raw <= 2.5 * m) & (zeros > 0)
+        raw[small] = m * np.log(m / zeros[small])
+        return raw
+
+    def _row(self, msg_id):
+        row = self.rows.get(msg_id)
+        if row is not None:
+            return row
+        if self.free:
+            row = self.free.pop()
+            self.ids[row] = msg_id
+        else:
+            row = len(self.ids)
+            self.ids.append(msg_id)
+            if row >= len(self.registers):
+                self._grow(row + 1)
+        self.rows[msg_id] = row
+        return row
+
+    def _grow(self, size):
+        capacity = max(size, min(self.capacity, len(self.registers) * 2))
+        registers = np.zeros((capacity, self.m), np.uint8)
+        registers[:len(self.registers)] = self.registers
+        estimates = np.zeros(capacity, np.float32)
+        estimates[:len(self.estimates)] = self.estimates
+        self.registers, self.estimates = registers, estimates
+
+    def _evict(self, needed):
+        live = np.fromiter(self.rows.values(), np.intp, len(self.rows))
+        drop = max(len(live) // 2, needed)
+        self._free(live[np.argsort(self.estimates[live], kind='stable')[:drop]].tolist())
+
+    def remove(self, msg_ids):
+        self._free([row for row in (self.rows.get(msg_id) for msg_id in msg_ids) if row is not None])
+
+    def _free(self, rows):
+        for row in rows:
+            del self.rows[self.ids[row]]
+            self.ids[row] = None
+        self.registers[rows] = 0
+        self.estimates[rows] = 0
+        self.free.extend(rows)
+
+    def estimate(self, msg_id):
+        row = self.rows.get(msg_id)
+        return 0.0 if row is None else float(self.estimates[row])
+
+    def ranked(self):
+        '''
+        Message IDs by estimated distinct react names, most first
+        '''
+        live = np.fromiter(self.rows.values(), np.intp, len(self.rows))
+        order = live[np.argsort(-self.estimates[live], kind='stable')]
+        return [self.ids[row] for row in order.tolist()]
+
+    def nbytes(self):
+        return self.registers.nbytes + self.estimates.nbytes
+
+
+class TeamSketches(object):
+    '''
+    One team's sketches. params is checked on load, a sketch saved with other
+    settings is rebuilt.
+    '''
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, top_k=SKETCH_TOP_K,
+                 react_top_k=SKETCH_REACT_TOP_K, precision=SKETCH_HLL_PRECISION, capacity=SKETCH_MESSAGES):
+        self.params = dict(width=width, depth=depth, top_k=top_k, react_top_k=react_top_k,
+                           precision=precision, capacity=capacity)
+        self.phrases = CountMinSketch(width, depth)
+        self.top_phrases = TopK(top_k)
+        self.words = CountMinSketch(width, depth)
+        self.top_words = {}
+        self.react_top_k = react_top_k
+        self.reacts = HyperLogLogs(precision, capacity)
+
+    def add_phrases(self, counts):
+        '''
+        Adds {phrase: count}, negative to subtract
+        '''
+        counts = {phrase: count for phrase, count in counts.items() if count}
+        if counts:
+            keys = list(counts)
+            self.top_phrases.offer(keys, self.phrases.add(keys, list(counts.values())).tolist())
+
+    def add_react_words(self, counts):
+        '''
+        Adds {(react name, word): count}, negative to subtract
+        '''
+        counts = {key: count for key, count in counts.items() if count}
+        if not counts:
+            return
+        estimates = self.words.add([name + '\0' + word for name, word in counts],
+                                   list(counts.values())).tolist()
+        by_react = {}
+        for (name, word), estimate in zip(counts, estimates):
+            keys, values = by_react.setdefault(name, ([], []))
+            keys.append(word)
+            values.append(estimate)
+        for name, (keys, values) in by_react.items():
+            top = self.top_words.get(name)
+            if top is None:
+                top = self.top_words[name] = TopK(self.react_top_k)
+            top.offer(keys, values)
+
+    def nbytes(self):
+        return self.phrases.nbytes() + self.words.nbytes() + self.reacts.nbytes()
+
+    def dumps(self):
+        '''
+        The sketches as bytes: SKETCH_HEADER, then JSON of the settings,
+        totals, top-K candidates and message IDs, then the two Count-Min
+        tables as little endian int32, and the registers and float32
+        estimates of the messages' HyperLogLogs
+        '''
+        reacts = self.reacts
+        used = len(reacts.ids)
+        meta = json.dumps({
+            'params': self.params,
+            'totals': [self.phrases.total, self.words.total],
+            'top_phrases': [self.top_phrases.floor, self.top_phrases.counts],
+            'top_words': {name: [top.floor, top.counts] for name, top in self.top_words.items()},
+            'ids': reacts.ids,
+            'free': reacts.free}).encode('utf-8')
+        return b''.join([SKETCH_HEADER.pack(SKETCH_MAGIC, SKETCH_FORMAT, len(meta)), meta,
+                         self.phrases.table.astype('<i4').tobytes(),
+                         self.words.table.astype('<i4').tobytes(),
+                         reacts.registers[:used].tobytes(),
+                         reacts.estimates[:used].astype('<f4').tobytes()])
+
+    @classmethod
+    def loads(cls, data):
+        '''
+        The TeamSketches dumps saved as data, or None if it was saved in
+        another format
+        '''
+        meta = _meta(data)
+        if meta is None:
+            return None
+        team = cls(**meta['params'])
+        team.phrases.total, team.words.total = meta['totals']
+        team.top_phrases.floor, team.top_phrases.counts = meta['top_phrases']
+        for name, (floor, counts) in meta['top_words'].items():
+            top = team.top_words[name] = TopK(team.react_top_k)
+            top.floor, top.counts = floor, counts
+        reacts = team.reacts
+        reacts.ids, reacts.free = meta['ids'], meta['free']
+        reacts.rows = {msg_id: row for row, msg_id in enumerate(reacts.ids) if msg_id is not None}
+        used = len(reacts.ids)
+        arrays = [(team.phrases.table.shape, '<i4'), (team.words.table.shape, '<i4'),
+                  ((used, reacts.m), 'u1'), ((used,), '<f4')]
+        offset = SKETCH_HEADER.size + meta['length']
+        values = []
+        for shape, dtype in arrays:
+            count = int(np.prod(shape))
+            values.append(np.frombuffer(data, dtype, count, offset).reshape(shape))
+            offset += count * np.dtype(dtype).itemsize
+        team.phrases.table[:] = values[0]
+        team.words.table[:] = values[1]
+        if used > len(reacts.registers):
+            reacts._grow(used)
+        reacts.registers[:used] = values[2]
+        reacts.estimates[:used] = values[3]
+        return team
+
+
+def _meta(data):
+    '''
+    The JSON part of a saved TeamSketches, with its length, or None if data
+    isn't in SKETCH_FORMAT
+    '''
+    if len(data) < SKETCH_HEADER.size:
+        return None
+    magic, version, length = SKETCH_HEADER.unpack_from(data)
+    if magic != SKETCH_MAGIC or version != SKETCH_FORMAT:
+        return None
+    meta = json.loads(bytes(data[SKETCH_HEADER.size:SKETCH_HEADER.size + length]).decode('utf-8'))
+    meta['length'] = length
+    return meta
+
+
+class Sketches(object):
+    '''
+    Every team's sketches, loaded in a background thread and saved every
+    save_interval seconds. Takes the changes db records for each write, and
+    answers the approximate commands for analytics.
+
+    teams holds the sketches in memory, least recently used first. Past
+    max_bytes the first are saved if they changed and dropped, and read
+    back from the Sketches table when next used.
+    '''
+    def __init__(self, save_interval=SKETCH_SAVE_INTERVAL, max_bytes=SKETCH_MAX_BYTES, **params):
+        if np is None:
+            raise RuntimeError('numpy is needed for the analytics sketches')
+        self.save_interval = save_interval
+        self.max_bytes = max_bytes
+        self.params = dict(width=SKETCH_WIDTH, depth=SKETCH_DEPTH, top_k=SKETCH_TOP_K,
+                           react_top_k=SKETCH_REACT_TOP_K, precision=SKETCH_HLL_PRECISION,
+                           capacity=SKETCH_MESSAGES)
+        self.params.update(params)
+        self.teams = None
+        self._lock = threading.Lock()
+        # Changes applied while loading, replayed onto the loaded sketches
+        self._replay = None
+        self._dirty = set()
+        # Teams with a row in the Sketches table at the current settings
+        self._stored = set()
+        self._thread = None
+        self._stats = {'loads': 0, 'load_seconds': 0.0, 'built': False, 'changes': 0,
+                       'saves': 0, 'errors': 0, 'team_loads': 0, 'evictions': 0}
+
+    @property
+    def ready(self):
+        return self.teams is not None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='analytics-sketches')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self.ready:
+            try:
+                self.load()
+            except Exception as e:
+                self._stats['errors'] += 1
+                log.log_error('Loading sketches failed: ' + str(e))
+                time.sleep(self.save_interval)
+        while True:
+            time.sleep(self.save_interval)
+            self.save()
+
+    def _team(self, teams, team_id):
+        '''
+        The team's sketches, read back from the Sketches table if they were
+        dropped, or new ones
+        '''
+        team = teams.get(team_id)
+        if team is not None:
+            teams.move_to_end(team_id)
+            return team
+        if team_id in self._stored:
+            rows = db.execute(LOAD_TEAM_SKETCH, (team_id,))
+            team = TeamSketches.loads(bytes(rows[0][0])) if rows else None
+            self._stats['team_loads'] += 1
+        if team is None:
+            team = TeamSketches(**self.params)
+        teams[team_id] = team
+        return team
+
+    def _shrink(self, teams, keep):
+        '''
+        Drops the least recently used teams other than keep until teams fit
+        in max_bytes, saving those that changed
+        '''
+        size = sum(team.nbytes() for team in teams.values())
+        for team_id in list(teams):
+            if size <= self.max_bytes:
+                break
+            if team_id in keep:
+                continue
+            team = teams.pop(team_id)
+            if team_id in self._dirty or team_id not in self._stored:
+                try:
+                    db.execute(SAVE_SKETCH, (team_id, team.dumps(), datetime.now(timezone.utc)))
+                except Exception as e:
+                    self._stats['errors'] += 1
+                    log.log_error('Saving sketches failed: ' + str(e))
+                    teams[team_id] = team
+                    teams.move_to_end(team_id, last=False)
+                    break
+                self._stored.add(team_id)
+                self._dirty.discard(team_id)
+            size -= team.nbytes()
+            self._stats['evictions'] += 1
+
+    def _resident(self, team_id):
+        '''
+        The team's sketches for a command, or None if it has none
+        '''
+        if team_id not in self.teams and team_id not in self._stored:
+            return None
+        team = self._team(self.teams, team_id)
+        self._shrink(self.teams, {team_id})
+        return team
+
+    def load(self):
+        '''
+        Reads the saved sketches, the most recently saved until max_bytes,
+        or builds them if there are none or any were saved with other
+        settings or in another format
+        '''
+        start = time.time()
+        with self._lock:
+            self._replay = []
+        try:
+            teams, stored, size = OrderedDict(), set(), 0
+            built = False
+            for team_id, data in db.stream(LOAD_SKETCHES):
+                data = bytes(data)
+                meta = _meta(data)
+                if meta is None or meta['params'] != self.params:
+                    built = True
+                    break
+                stored.add(team_id)
+                if size < self.max_bytes:
+                    teams[team_id] = team = TeamSketches.loads(data)
+                    teams.move_to_end(team_id, last=False)
+                    size += team.nbytes()
+            built = built or not stored
+            self._stored = stored
+            if built:
+                # Writes that commit as the scans start can be counted twice
+                teams = self.build()
+        finally:
+            with self._lock:
+                replay, self._replay = self._replay, None
+        with self._lock:
+            for changes in replay:
+                self._apply(teams, changes)
+                self._dirty.update(_teams(changes))
+            self.teams = teams
+            if built:
+                self._dirty.update(teams)
+        if built:
+            self.save()
+        self._stats['loads'] += 1
+        self._stats['load_seconds'] = time.time() - start
+        self._stats['built'] = built
+
+    def build(self):
+        '''
+        Builds every team's sketches from Messages, Reacts and MessageWords.
+        Teams past max_bytes are saved as they are dropped, and the rest are
+        returned.
+        '''
+        teams = OrderedDict()
+        self._stored = set()
+        for rows in _batches(db.stream(MESSAGE_TEXTS)):
+            self._apply(teams, [('messages', 1, rows)])
+        for rows in _batches(db.stream(REACT_NAMES)):
+            by_team = {}
+            for msg_id, team_id, name in rows:
+                ids, names = by_team.setdefault(team_id, ([], []))
+                ids.append(msg_id)
+                names.append(name)
+            for team_id, (ids, names) in by_team.items():
+                self._team(teams, team_id).reacts.add(ids, names)
+            self._shrink(teams, by_team)
+        for rows in _batches(db.stream(REACT_WORDS)):
+            by_team = {}
+            for team_id, name, word in rows:
+                by_team.setdefault(team_id, Counter())[(name, word)] += 1
+            for team_id, counts in by_team.items():
+                self._team(teams, team_id).add_react_words(counts)
+            self._shrink(teams, by_team)
+        self._shrink(teams, ())
+        return teams
+
+    def apply(self, changes):
+        '''
+        Applies the changes db recorded for a committed write:
+            ('messages', sign, [(MessageID, TeamID, Text)])
+            ('reacts', sign, [(MessageID, TeamID, ReactName)], {MessageID: [words]})
+        '''
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append(changes)
+            if self.teams is not None:
+                self._apply(self.teams, changes)
+                self._dirty.update(_teams(changes))
+            self._stats['changes'] += len(changes)
+
+    def _apply(self, teams, changes):
+        touched = _teams(changes)
+        for change in changes:
+            kind, sign, rows = change[:3]
+            by_team = {}
+            for row in rows:
+                by_team.setdefault(row[1], []).append(row)
+            for team_id, team_rows in by_team.items():
+                team = self._team(teams, team_id)
+                if kind == 'messages':
+                    phrases = Counter(p for _, _, text in team_rows for p in nlp.phrases(text))
+                    team.add_phrases({p: sign * n for p, n in phrases.items()})
+                    if sign < 0:
+                        team.reacts.remove([msg_id for msg_id, _, _ in team_rows])
+                    continue
+                words = change[3]
+                counts = Counter((name, word) for msg_id, _, name in team_rows for word in words.get(msg_id, ()))
+                team.add_react_words({key: sign * n for key, n in counts.items()})
+                if sign > 0:
+                    team.reacts.add([msg_id for msg_id, _, _ in team_rows], [name for _, _, name in team_rows])
+        self._shrink(teams, touched)
+
+    def save(self):
+        '''
+        Writes the sketches of the teams changed since the last save
+        '''
+        with self._lock:
+            if self.teams is None:
+                return
+            dirty, self._dirty = self._dirty, set()
+            # Teams dropped since they changed were saved then
+            blobs = [(team_id, self.teams[team_id].dumps()) for team_id in dirty if team_id in self.teams]
+        try:
+            now = datetime.now(timezone.utc)
+            for team_id, blob in blobs:
+                db.execute(SAVE_SKETCH, (team_id, blob, now))
+            self._stats['saves'] += 1
+            with self._lock:
+                self._stored.update(team_id for team_id, _ in blobs)
+        except Exception as e:
+            self._stats['errors'] += 1
+            log.log_error('Saving sketches failed: ' + str(e))
+            with self._lock:
+                self._dirty |= dirty
+
+    def common_phrases(self, team_id, count):
+        '''
+        [(phrase, estimated count)] of the team's most common phrases
+        '''
+        with self._lock:
+            team = self._resident(team_id)
+            return team.top_phrases.top(count, team.phrases) if team else []
+
+    def react_words(self, team_id, react_name, count):
+        '''
+        [(word, estimated count)] of the words most used on messages with
+        react_name, counted once per react as REACT_WORDS does
+        '''
+        with self._lock:
+            team = self._resident(team_id)
+            top = team and team.top_words.get(react_name)
+            return top.top(count, team.words, react_name + '\0') if top else []
+
+    def most_unique_messages(self, team_id):
+        '''
+        IDs of the team's messages by estimated distinct react names, most first
+        '''
+        with self._lock:
+            team = self._resident(team_id)
+            return team.reacts.ranked() if team else []
+
+    def stats(self):
+        stats = dict(self._stats)
+        teams = self.teams
+        if teams is not None:
+            with self._lock:
+                stats['teams'] = len(teams.keys() | self._stored)
+                stats['resident_teams'] = len(teams)
+                stats['array_bytes'] = sum(team.nbytes() for team in teams.values())
+                stats['messages'] = sum(len(team.reacts.rows) for team in teams.values())
+                stats['phrase_error'] = max([team.phrases.error() for team in teams.values()] or [0.0])
+                stats['word_error'] = max([team.words.error() for team in teams.values()] or [0.0])
+                stats['dirty_teams'] = len(self._dirty)
+        return stats
+
+
+def _teams(changes):
+    return {row[1] for change in changes for row in change[2]}
+
+
+def _batches(rows, size=BUILD_BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rebuild', action='store_true',
+                        help='build the sketches from the database and save them, with the bot stopped')
+    parser.add_argument('--database', help='database URL to use instead of DATABASE_URL')
+    args = parser.parse_args()
+    if args.database:
+        db.use(args.database)
+    if not args.rebuild:
+        parser.print_help()
+        raise SystemExit(1)
+    sketches = Sketches()
+    start = time.time()
+    teams = sketches.build()
+    with sketches._lock:
+        sketches.teams = teams
+        sketches._dirty.update(teams)
+    sketches.save()
+    print('built %d teams in %.1fs' % (len(teams), time.time() - start))
+    print(sketches.stats())
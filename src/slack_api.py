@@ -0,0 +1,243 @@
+import os
+import atexit
+import threading
+import time
+import log
+import metrics
+import requests
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+# Point at a fake Slack server in tests, e.g. http://localhost:8000/api/
+SLACK_API_URL = os.environ.get('SLACK_API_URL', 'https://slack.com/api/')
+SLACK_TIMEOUT = float(os.environ.get('SLACK_TIMEOUT', 10))
+# Times a call is retried after a 429 before giving up
+SLACK_MAX_RETRIES = int(os.environ.get('SLACK_MAX_RETRIES', 3))
+# Seconds an auth.test result is trusted for
+AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', 300))
+# Outbound messages to one channel queued within this many milliseconds are
+# posted as a single chat.postMessage
+OUTBOUND_COALESCE_MS = int(os.environ.get('OUTBOUND_COALESCE_MS', 250))
+# Slack truncates longer messages
+MAX_MESSAGE_CHARS = 40000
+
+# Requests per minute allowed by each of Slack's rate limit tiers, see
+# https://api.slack.com/docs/rate-limits. 'post' is chat.postMessage's own
+# limit of about one message per second.
+TIER_RATES = {1: 1, 2: 20, 3: 50, 4: 100, 'post': 60}
+# Scales every tier's rate, e.g. up for a fake Slack server in tests
+SLACK_RATE_MULTIPLIER = float(os.environ.get('SLACK_RATE_MULTIPLIER', 1))
+METHOD_TIERS = {'auth.test': 4,
+                'chat.postMessage': 'post',
+                'conversations.history': 3,
+                'conversations.info': 3,
+                'conversations.list': 2,
+                'conversations.open': 3,
+                'conversations.replies': 3,
+                'oauth.access': 4,
+                'users.info': 4,
+                'users.list': 2}
+DEFAULT_TIER = 3
+
+CALL_SECONDS = metrics.histogram('slack_api_seconds', 'Latency of Slack Web API calls, rate limit waits excluded',
+                                 ('method',))
+
+
+class TokenBucket(object):
+    '''
+    Allows rate_per_min calls a minute with bursts of up to burst calls.
+    pause() holds every caller back until a Retry-After has passed.
+    '''
+    def __init__(self, rate_per_min, burst=None):
+        self.rate = rate_per_min / 60.0
+        self.capacity = burst or max(1, rate_per_min // 10)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Blocks until a call is allowed. Returns the seconds spent waiting.
+        '''
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.time()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            # One call is let through when the pause ends
+            self.tokens = 1
+            self.updated = self.paused_until
+
+
+class SlackAPI(object):
+    '''
+    Slack Web API client with the same api_call interface as SlackClient.
+
+    Calls share one pooled requests.Session and pass through a token bucket
+    per rate limit tier. A 429 pauses the tier for its Retry-After and the
+    call is retried. DM channel IDs and auth.test results are cached, and
+    messages queued with queue_message are coalesced per channel.
+    '''
+    def __init__(self, token, api_url=SLACK_API_URL):
+        self.token = token
+        self.api_url = api_url
+        self.session = requests.Session()
+        self._buckets = {tier: TokenBucket(rate * SLACK_RATE_MULTIPLIER)
+                         for tier, rate in TIER_RATES.items()}
+        self._dm_channels = {}
+        self._auth = {}
+        self._outbound = OrderedDict()
+        self._outbound_cond = threading.Condition()
+        self._sender = None
+        self._stats = {'calls': 0, 'errors': 0, 'rate_limited': 0, 'wait_seconds': 0.0,
+                       'dm_cache_hits': 0, 'auth_cache_hits': 0,
+                       'messages_queued': 0, 'messages_posted': 0}
+
+    def api_call(self, method, **kwargs):
+        '''
+        Calls method and returns the decoded response. Network errors and
+        exhausted retries are returned as {'ok': False, 'error': ...} rather
+        than raised.
+        '''
+        kwargs.setdefault('token', self.token)
+        bucket = self._buckets[METHOD_TIERS.get(method, DEFAULT_TIER)]
+        for attempt in range(SLACK_MAX_RETRIES + 1):
+            self._stats['wait_seconds'] += bucket.acquire()
+            self._stats['calls'] += 1
+            try:
+                with CALL_SECONDS.time(method):
+                    response = self.session.post(self.api_url + method, data=kwargs, timeout=SLACK_TIMEOUT)
+            except requests.RequestException as e:
+                self._stats['errors'] += 1
+                log.log_error('%s failed: %s' % (method, e))
+                return {'ok': False, 'error': str(e)}
+
+            if response.status_code == 429:
+                self._stats['rate_limited'] += 1
+                bucket.pause(float(response.headers.get('Retry-After', 1)))
+                continue
+            try:
+                return response.json()
+            except ValueError:
+                self._stats['errors'] += 1
+                return {'ok': False, 'error': 'http_%d' % response.status_code}
+        return {'ok': False, 'error': 'ratelimited'}
+
+    def auth_test(self, token):
+        '''
+        Returns whether token is valid, calling auth.test at most once per
+        AUTH_CACHE_TTL seconds for each token
+        '''
+        now = time.time()
+        cached = self._auth.get(token)
+        if cached and cached[0] > now:
+            self._stats['auth_cache_hits'] += 1
+            return cached[1]
+        response = self.api_call('auth.test', token=token)
+        ok = response.get('ok', False)
+        # Failed calls aren't cached so a network blip doesn't lock users out
+        if ok or response.get('error') in ('invalid_auth', 'not_authed', 'account_inactive'):
+            self._auth[token] = (now + AUTH_CACHE_TTL, ok)
+        return ok
+
+    def open_dm(self, user_id):
+        '''
+        Returns the ID of the DM channel with user_id, or None if it can't be
+        opened. DM channel IDs don't change, so each is only opened once.
+        '''
+        channel = self._dm_channels.get(user_id)
+        if channel:
+            self._stats['dm_cache_hits'] += 1
+            return channel
+        response = self.api_call('conversations.open', users=user_id)
+        if not response.get('ok'):
+            return None
+        channel = response['channel']['id']
+        self._dm_channels[user_id] = channel
+        return channel
+
+    def queue_message(self, channel, text, **kwargs):
+        '''
+        Queues text for channel. A background thread posts what was queued for
+        each channel in the last OUTBOUND_COALESCE_MS as one message.
+
+        Returns:
+            Future: resolved to whether the post text went out in succeeded
+        '''
+        future = Future()
+        with self._outbound_cond:
+            if self._sender is None:
+                self._sender = threading.Thread(target=self._send_loop, name='slack-outbound')
+                self._sender.daemon = True
+                self._sender.start()
+                atexit.register(self.flush_messages)
+            key = (channel, tuple(sorted(kwargs.items())))
+            self._outbound.setdefault(key, []).append((text, future))
+            self._stats['messages_queued'] += 1
+            self._outbound_cond.notify()
+        return future
+
+    def _send_loop(self):
+        while True:
+            with self._outbound_cond:
+                while not self._outbound:
+                    self._outbound_cond.wait()
+            time.sleep(OUTBOUND_COALESCE_MS / 1000.0)
+            self.flush_messages()
+
+    def flush_messages(self):
+        '''
+        Posts everything queued, joining the texts for each channel
+        '''
+        with self._outbound_cond:
+            outbound, self._outbound = self._outbound, OrderedDict()
+        for (channel, options), queued in outbound.items():
+            for chunk in self._join(queued):
+                ok = False
+                try:
+                    text = '\n\n'.join(text for text, _ in chunk)
+                    response = self.api_call('chat.postMessage', channel=channel, text=text, **dict(options))
+                    ok = response.get('ok', False)
+                    if not ok:
+                        log.log_error('chat.postMessage to %s failed: %s' % (channel, response.get('error')))
+                    self._stats['messages_posted'] += 1
+                finally:
+                    for _, future in chunk:
+                        future.set_result(ok)
+
+    def _join(self, queued):
+        '''
+        Splits the queued (text, future) pairs into runs that fit in a message
+        '''
+        chunk = []
+        size = 0
+        for entry in queued:
+            if chunk and size + len(entry[0]) + 2 > MAX_MESSAGE_CHARS:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(entry)
+            size += len(entry[0]) + 2
+        if chunk:
+            yield chunk
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['dm_channels'] = len(self._dm_channels)
+        stats['queued'] = sum(len(queued) for queued in self._outbound.values())
+        return stats
@@ -1,13 +1,39 @@
+import marshal
+from sys import intern
+from datetime import datetime, timezone
+import metrics
+
+# Ops an API event turns into, named after the db and EventBatcher methods
+ADD_REACT = 'add_react'
+REMOVE_REACT = 'remove_react'
+ADD_MESSAGE = 'add_message'
+REMOVE_MESSAGE = 'remove_message'
+REACT_OPS = {'reaction_added': ADD_REACT, 'reaction_removed': REMOVE_REACT}
+# Slash command fields Bot.handle_slash_command and Bot.respond read
+SLASH_COMMAND_FIELDS = ('token', 'text', 'team_id', 'channel_id', 'user_id', 'response_url')
+
+FUNCTION_SECONDS = metrics.histogram('function_seconds', 'Latency of functions decorated with time_it',
+                                     ('function',))
+
+
 def msg_id_string(channel_id, time_stamp):
     return channel_id + time_stamp
 
+def ts_to_datetime(time_stamp):
+    '''
+    Converts a Slack ts ('1500000000.000100') to an aware UTC datetime
+    '''
+    return datetime.fromtimestamp(float(time_stamp), timezone.utc)
+
 def create_react(slack_event):
     event = slack_event['event']
     react_name = event['reaction']
     user_id = event['user']
     channel_id = event['item']['channel']
     time_stamp = event['item']['ts']
-    return React('', channel_id, time_stamp, user_id, react_name)
+    # event_ts is when the react was left, ts is the message's
+    created_at = ts_to_datetime(event['event_ts']) if 'event_ts' in event else None
+    return React(slack_event.get('team_id', ''), channel_id, time_stamp, user_id, react_name, created_at)
 
 def create_message(slack_event):
     event = slack_event['event']
@@ -18,31 +44,87 @@ def create_message(slack_event):
         return
     time_stamp = event['ts']
     text = event['text']
-    return Message('', channel_id, time_stamp, user_id, text)
+    return Message(slack_event.get('team_id', ''), channel_id, time_stamp, user_id, text)
+
+def compact_api_event(slack_event):
+    '''
+    Pulls the fields the event handler needs out of a Slack API event, so
+    the rest of the payload isn't pickled through the event queue.
+
+    Returns:
+        tuple or None: (op, team_id, channel_id, ts, user_id, react name or
+        text, event_ts or ''), None for events that aren't handled
+    '''
+    event = slack_event['event']
+    event_type = event['type']
+    team_id = slack_event.get('team_id', '')
+    if event_type in REACT_OPS:
+        return (REACT_OPS[event_type], team_id, event['item']['channel'], event['item']['ts'],
+                event['user'], event['reaction'], event.get('event_ts', ''))
+    if event_type != 'message':
+        return None
+    if event.get('subtype') == 'message_deleted':
+        # The deleted message is in deleted_ts and previous_message, ts is
+        # the deletion's own
+        previous = event.get('previous_message', {})
+        return (REMOVE_MESSAGE, team_id, event['channel'], event['deleted_ts'], previous.get('user', ''), '', '')
+    if 'user' not in event:
+        return None
+    return (ADD_MESSAGE, team_id, event['channel'], event['ts'], event['user'], event['text'], '')
 
-class React:
-    def __init__(self, team_id, channel_id, time_stamp, user_id, name):
-        self.team_id = team_id
+def encode_api_event(fields):
+    '''
+    marshal is a few times smaller and faster than pickle for a tuple of
+    strings, and both ends of the queue run the same interpreter
+    '''
+    return marshal.dumps(fields)
+
+def decode_api_event(data):
+    return marshal.loads(data)
+
+def create_record(fields):
+    '''
+    Builds the React or Message for compact_api_event's fields
+
+    Returns:
+        tuple: (op, React or Message)
+    '''
+    op, team_id, channel_id, time_stamp, user_id, value, event_ts = fields
+    if op == ADD_REACT or op == REMOVE_REACT:
+        created_at = ts_to_datetime(event_ts) if event_ts else None
+        return op, React(team_id, channel_id, time_stamp, user_id, value, created_at)
+    return op, Message(team_id, channel_id, time_stamp, user_id, value)
+
+def compact_slash_command(slash_command):
+    return {key: slash_command[key] for key in SLASH_COMMAND_FIELDS if key in slash_command}
+
+class React(object):
+    # No per instance __dict__, and the IDs and react names are interned so
+    # the handful of distinct values are shared by every record
+    __slots__ = ('team_id', 'channel_id', 'msg_id', 'user_id', 'name', 'created_at')
+
+    def __init__(self, team_id, channel_id, time_stamp, user_id, name, created_at=None):
+        self.team_id = intern(team_id)
+        self.channel_id = intern(channel_id)
         self.msg_id = msg_id_string(channel_id,time_stamp)
-        self.user_id = user_id
-        self.name = name
+        self.user_id = intern(user_id)
+        self.name = intern(name)
+        self.created_at = created_at or ts_to_datetime(time_stamp)
+
+class Message(object):
+    __slots__ = ('team_id', 'channel_id', 'msg_id', 'user_id', 'text', 'created_at')
 
-class Message:
     def __init__(self, team_id, channel_id, time_stamp, user_id, text):
-        self.team_id = team_id
+        self.team_id = intern(team_id)
+        self.channel_id = intern(channel_id)
         self.msg_id = msg_id_string(channel_id, time_stamp)
-        self.user_id = user_id
+        self.user_id = intern(user_id)
         self.text = text
+        self.created_at = ts_to_datetime(time_stamp)
 
 def time_it(func):
-    from functools import wraps
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        import time
-        start = time.time()
-        ret_val = func(*args, **kwargs)
-        end = time.time()
-        duration = end - start
-        print('Time elapsed for ' + str(func.__name__) + ' : ' + str(duration) + ' seconds')
-        return ret_val
-    return wrapper
\ No newline at end of file
+    '''
+    Records how long each call of func takes in the function_seconds
+    histogram on /metrics
+    '''
+    return FUNCTION_SECONDS.timed()(func)
@@ -0,0 +1,97 @@
+'''
+Synthetic Slack workspaces for benchmarks. Users, channels, words, react
+names, message lengths and reacts per message are all Zipf distributed, so a
+few users post most messages and a few reacts are most of the reacts, as in
+a real workspace. The same seed always gives the same workspace.
+'''
+import random
+import time
+import nlp
+from util import Message, React, ts_to_datetime
+
+
+class Workspace(object):
+    '''
+    Args:
+        team_id   (str)   : TeamID written on every row
+        users     (int)   : number of users
+        channels  (int)   : number of channels
+        messages  (int)   : number of messages
+        vocab     (int)   : number of distinct non stop words
+        reacts    (int)   : number of distinct react names
+        days      (int)   : messages are spread over this many days before now
+        skew      (float) : Zipf exponent, higher is more skewed
+        seed      (int)   : random seed
+    '''
+    def __init__(self, team_id='TBENCH', users=200, channels=20, messages=20000, vocab=20000,
+                 reacts=300, days=90, skew=1.1, seed=0):
+        self.team_id = team_id
+        self.users = ['U%06d' % i for i in range(users)]
+        self.channels = ['C%06d' % i for i in range(channels)]
+        self.message_count = messages
+        self.react_names = ['react_%d' % i for i in range(reacts)]
+        # Stop words are the most common words, as they are in real text
+        self.words = sorted(nlp.stop_words) + ['word%d' % i for i in range(vocab)]
+        self.days = days
+        self.skew = skew
+        self.seed = seed
+        self.end = time.time()
+
+    def _zipf(self, n):
+        # Cumulative weights so random.choices doesn't re-sum them on every call
+        total = 0.0
+        cum = []
+        for rank in range(n):
+            total += 1.0 / (rank + 1) ** self.skew
+            cum.append(total)
+        return cum
+
+    def generate(self):
+        '''
+        Yields (message, [reacts on it]) in ts order
+        '''
+        rng = random.Random(self.seed)
+        user_w = self._zipf(len(self.users))
+        channel_w = self._zipf(len(self.channels))
+        word_w = self._zipf(len(self.words))
+        react_w = self._zipf(len(self.react_names))
+        lengths = list(range(1, 81))
+        length_w = self._zipf(len(lengths))
+        react_counts = list(range(0, 40))
+        react_count_w = self._zipf(len(react_counts))
+
+        start = self.end - self.days * 86400
+        stamps = sorted(rng.uniform(start, self.end) for _ in range(self.message_count))
+        for i, stamp in enumerate(stamps):
+            # ts has to be unique within a channel, the index keeps it so
+            ts = '%d.%06d' % (int(stamp), i % 1000000)
+            channel = rng.choices(self.channels, cum_weights=channel_w)[0]
+            user = rng.choices(self.users, cum_weights=user_w)[0]
+            words = rng.choices(self.words, cum_weights=word_w,
+                                k=rng.choices(lengths, cum_weights=length_w)[0])
+            if rng.random() < 0.1:
+                words.insert(rng.randrange(len(words) + 1),
+                             '<@%s>' % rng.choices(self.users, cum_weights=user_w)[0])
+            msg = Message(self.team_id, channel, ts, user, ' '.join(words))
+
+            reacts = {}
+            for _ in range(rng.choices(react_counts, cum_weights=react_count_w)[0]):
+                reactor = rng.choices(self.users, cum_weights=user_w)[0]
+                name = rng.choices(self.react_names, cum_weights=react_w)[0]
+                # Most reacts come within minutes of the message
+                left = min(self.end, stamp + rng.expovariate(1 / 600.0))
+                reacts[(reactor, name)] = React(self.team_id, channel, ts, reactor, name,
+                                                ts_to_datetime(left))
+            yield msg, list(reacts.values())
+
+    def texts(self):
+        return [msg.text for msg, _ in self.generate()]
+
+    def directory(self):
+        '''
+        Returns (users, channels) shaped like Bot.users and Bot.channels
+        '''
+        users = {user: {'user_name': user.lower(), 'display_name': 'name_' + user.lower()}
+                 for user in self.users}
+        channels = {channel: 'channel_' + channel.lower() for channel in self.channels}
+        return users, channels
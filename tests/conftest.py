@@ -0,0 +1,85 @@
+'''
+The modules in src/ import each other by name, as they do when run from
+there. Tests that need a database get a fresh embedded SQLite one, and the
+Postgres ones a new database on TEST_DATABASE_URL.
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import pytest
+
+
+@pytest.fixture
+def sqlite_url(tmp_path):
+    return 'sqlite:///' + str(tmp_path / 'react_analytics.db')
+
+
+@pytest.fixture
+def database(sqlite_url):
+    import db
+    previous = db.DATABASE_URL
+    db.use(sqlite_url)
+    yield db
+    db.use(previous)
+
+
+@pytest.fixture
+def postgres_url(monkeypatch):
+    '''
+    A new, empty database on the TEST_DATABASE_URL server, dropped afterwards
+    '''
+    url = os.environ.get('TEST_DATABASE_URL')
+    if not url:
+        pytest.skip('TEST_DATABASE_URL is not set')
+    psycopg2 = pytest.importorskip('psycopg2')
+    from psycopg2.extensions import make_dsn
+    import db
+    name = 'react_analytics_test_%d' % os.getpid()
+    sslmode = os.environ.get('TEST_DATABASE_SSLMODE', 'prefer')
+    admin = psycopg2.connect(url, sslmode=sslmode)
+    admin.autocommit = True
+    with admin.cursor() as cursor:
+        cursor.execute('DROP DATABASE IF EXISTS ' + name)
+        cursor.execute('CREATE DATABASE ' + name)
+    monkeypatch.setattr(db, 'DATABASE_SSLMODE', sslmode)
+    previous = db.DATABASE_URL
+    dsn = make_dsn(url, dbname=name)
+    db.use(dsn)
+    yield dsn
+    db.backend.pool.closeall()
+    db.use(previous)
+    with admin.cursor() as cursor:
+        cursor.execute('DROP DATABASE ' + name)
+    admin.close()
+
+
+@pytest.fixture(scope='session')
+def redis_server(tmp_path_factory):
+    '''
+    TEST_REDIS_URL, or a throwaway redislite server
+    '''
+    url = os.environ.get('TEST_REDIS_URL')
+    if url:
+        yield url
+        return
+    redislite = pytest.importorskip('redislite')
+    server = redislite.Redis(str(tmp_path_factory.mktemp('redis') / 'redis.db'))
+    yield 'unix://' + server.socket_file
+    server.shutdown()
+
+
+@pytest.fixture
+def redis_url(redis_server):
+    import redis
+    redis.Redis.from_url(redis_server).flushdb()
+    return redis_server
+
+
+@pytest.fixture
+def fake_slack():
+    from fake_slack import FakeSlack
+    server = FakeSlack().start()
+    yield server
+    server.stop()
@@ -0,0 +1,126 @@
+'''
+A Slack Web API server for tests, serving the methods slack_api.SlackAPI
+and backfill call from channels held in memory
+'''
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class FakeSlack(object):
+    '''
+    channels maps a channel ID to its messages, oldest first. A message's
+    'replies' are served by conversations.replies and left out of history.
+
+    users maps a user ID to its users.list member and channel_names a
+    channel ID to its name. With no users, users.info answers any ID.
+
+    rate_limits maps a method to the Retry-After values of the 429s its
+    next calls get, and fail_at a call number to an error response.
+    '''
+    def __init__(self, team_id='T1'):
+        self.team_id = team_id
+        self.channels = {}
+        self.users = {}
+        self.channel_names = {}
+        self.calls = []
+        self.rate_limits = {}
+        self.fail_at = set()
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/api/' % self.server.server_port
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def methods(self):
+        return [method for method, _ in self.calls]
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+                args = {key: values[0] for key, values in parse_qs(body).items()}
+                with fake._lock:
+                    fake.calls.append((method, args))
+                    number = len(fake.calls)
+                    limits = fake.rate_limits.get(method)
+                    retry_after = limits.pop(0) if limits else None
+                if retry_after is not None:
+                    self.send_response(429)
+                    self.send_header('Retry-After', str(retry_after))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if number in fake.fail_at:
+                    return self.reply({'ok': False, 'error': 'internal_error'})
+                self.reply(fake.respond(method, args))
+
+            def reply(self, response):
+                data = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def respond(self, method, args):
+        if method == 'auth.test':
+            if args.get('token') == 'bad':
+                return {'ok': False, 'error': 'invalid_auth'}
+            return {'ok': True, 'team_id': self.team_id}
+        if method == 'conversations.list':
+            return {'ok': True, 'channels': [{'id': channel, 'name': self.channel_names.get(channel, channel)}
+                                             for channel in self.channels]}
+        if method == 'conversations.info':
+            if args['channel'] not in self.channels:
+                return {'ok': False, 'error': 'channel_not_found'}
+            channel = args['channel']
+            return {'ok': True, 'channel': {'id': channel, 'name': self.channel_names.get(channel, channel)}}
+        if method == 'users.list':
+            return {'ok': True, 'members': list(self.users.values())}
+        if method == 'users.info' and self.users:
+            if args['user'] not in self.users:
+                return {'ok': False, 'error': 'user_not_found'}
+            return {'ok': True, 'user': self.users[args['user']]}
+        if method == 'conversations.open':
+            return {'ok': True, 'channel': {'id': 'D' + args['users']}}
+        if method in ('users.info', 'chat.postMessage'):
+            return {'ok': True}
+        if method == 'conversations.history':
+            messages = sorted(self.channels[args['channel']], key=lambda m: float(m['ts']), reverse=True)
+            if 'latest' in args:
+                messages = [m for m in messages if float(m['ts']) < float(args['latest'])]
+            if 'oldest' in args:
+                messages = [m for m in messages if float(m['ts']) > float(args['oldest'])]
+            return self.page(messages, args)
+        if method == 'conversations.replies':
+            parent = [m for m in self.channels[args['channel']] if m['ts'] == args['ts']][0]
+            return self.page([parent] + parent.get('replies', []), args)
+        return {'ok': False, 'error': 'unknown_method'}
+
+    def page(self, messages, args):
+        start = int(args.get('cursor') or 0)
+        limit = int(args.get('limit') or 100)
+        next_cursor = str(start + limit) if start + limit < len(messages) else ''
+        return {'ok': True, 'has_more': bool(next_cursor),
+                'messages': [{k: v for k, v in m.items() if k != 'replies'} for m in messages[start:start + limit]],
+                'response_metadata': {'next_cursor': next_cursor}}
@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import analytics
+from bot import parse_window
+
+
+def test_parse_window():
+    assert parse_window('most_used <@U123|alice> 7d') == timedelta(days=7)
+    assert parse_window('24h') == timedelta(hours=24)
+    assert parse_window('2w :eyes:') == timedelta(weeks=2)
+    assert parse_window('most_used') is None
+    # Not a window: part of a mention, a word or a number with no unit
+    assert parse_window('<@U7d> day7d 7') is None
+
+
+def test_windows_longer_than_history_are_all_of_it():
+    assert parse_window('most_used 1000000d') is None
+    assert parse_window('most_used 99999999999999w') is None
+    assert analytics.window_start(timedelta(days=999999999)) is None
+    start = analytics.window_start(timedelta(days=1))
+    assert abs(datetime.now(timezone.utc) - timedelta(days=1) - start) < timedelta(minutes=1)
+
+
+def test_windowed_queries_filter_on_created_at(database):
+    since = datetime(2017, 7, 14, tzinfo=timezone.utc)
+    sql, args = analytics.compile_query(analytics.REACTS_BY_USER, 5, team='T1', user=None, since=since)
+    assert 'Reacts.CreatedAt >= %s' in sql and 'Reacts.UserID =' not in sql
+    assert args == ('T1', since, 5)
+    sql, args = analytics.compile_query(analytics.MOST_REACTED_TO, None, team='T1', since=since)
+    assert 'Messages.CreatedAt >= %s' in sql
+    assert args == ('T1', since, database.backend.no_limit)
+
+
+def test_windowed_commands_count_recent_rows(database):
+    from util import Message, React
+    database.add_message(Message('T1', 'C1', '1500000000.000100', 'U1', 'old'))
+    database.add_react(React('T1', 'C1', '1500000000.000100', 'U2', 'eyes'))
+    database.add_message(Message('T1', 'C1', '%d.000100' % (datetime.now().timestamp() - 60), 'U1', 'new'))
+    database.add_react(React('T1', 'C1', '%d.000100' % (datetime.now().timestamp() - 60), 'U3', 'tada'))
+    assert analytics.most_used_reacts('T1') == {'eyes': 1, 'tada': 1}
+    assert analytics.most_used_reacts('T1', window=timedelta(days=1)) == {'tada': 1}
+    assert analytics.most_used_reacts('T1', window=parse_window('1000000d')) == {'eyes': 1, 'tada': 1}
+    assert analytics.most_reacted_to_posts('T1', window=timedelta(hours=1)) == [('new', 1)]
+
+
+def buzzword_data(db):
+    from util import Message, React
+    texts = ['quick brown fox', 'quick brown dog', 'lazy dog ping <@U123>', 'alice says hi', '']
+    for n, text in enumerate(texts):
+        ts = '150000000%d.000100' % n
+        db.add_message(Message('T1', 'C1', ts, 'U1', text))
+        for user, name in (('U2', 'eyes'), ('U3', 'fire'), ('U4', 'tada'))[:n % 3 + 1]:
+            db.add_react(React('T1', 'C1', ts, user, name))
+    # Only on the message with no words
+    db.add_react(React('T1', 'C1', '1500000004.000100', 'U2', 'shrug'))
+
+
+def assert_buzzwords_match(count):
+    users = {'U123': {'display_name': 'alice'}}
+    names = ('eyes', 'fire', 'tada', 'shrug', 'unused')
+    together = analytics.react_buzzwords.uncached('T1', names, users, {}, count=count)
+    assert list(together) == list(names)
+    for name in names:
+        alone = analytics.react_buzzword.uncached('T1', name, users, {}, count=count)
+        if count is None:
+            assert together[name] == alone, name
+        else:
+            # Which of the words tied at the cut are kept is up to the database
+            assert sorted(together[name].values()) == sorted(alone.values()), name
+    assert together['shrug'] == together['unused'] == {}
+    return together
+
+
+@pytest.mark.parametrize('hash_aggregate', [True, False])
+def test_buzzwords_match_one_react_at_a_time(database, monkeypatch, hash_aggregate):
+    # True takes the ROW_NUMBER statement, False the UNION ALL of REACT_WORDS
+    monkeypatch.setattr(database.backend, 'hash_aggregate', hash_aggregate)
+    buzzword_data(database)
+    everything = assert_buzzwords_match(None)
+    # 'alice' and the mention resolving to her are one word
+    assert everything['eyes']['alice'] == 2
+    assert everything['eyes']['quick'] == 2
+    for count in (1, 2, 3):
+        assert_buzzwords_match(count)
+
+
+def test_buzzwords_match_one_react_at_a_time_on_postgres(postgres_url):
+    import db
+    buzzword_data(db)
+    assert_buzzwords_match(None)
+    assert_buzzwords_match(2)
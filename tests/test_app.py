@@ -0,0 +1,144 @@
+import queue
+import threading
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('celery')
+
+import bot
+import dedupe
+
+TOKEN = 'verification'
+
+
+def message_event(event_id, ts='1500000000.000100', token=TOKEN):
+    return {'token': token, 'team_id': 'T1', 'event_id': event_id,
+            'event': {'type': 'message', 'channel': 'C1', 'user': 'U1', 'ts': ts, 'text': 'hello'}}
+
+
+@pytest.fixture
+def app(database, monkeypatch):
+    # The module's Bot would start an event handler process
+    monkeypatch.setattr(bot.Bot, 'start', lambda self: None)
+    import app
+    monkeypatch.setattr(app.pyBot, 'verification', TOKEN)
+    monkeypatch.setattr(app.pyBot, 'batcher', None)
+    # Stands in for the multiprocessing queue, whose empty() lags behind put()
+    monkeypatch.setattr(app.pyBot, 'event_queue', queue.Queue())
+    monkeypatch.setattr(app, 'ASYNC_ACK', True)
+    monkeypatch.setattr(dedupe, 'events', dedupe.EventDeduplicator(redis_url=None))
+    return app
+
+
+@pytest.fixture
+def worker(app, monkeypatch):
+    '''
+    Runs queued tasks on a thread, each once release is set
+    '''
+    class Worker(object):
+        def __init__(self):
+            self.release = threading.Event()
+            self.threads = []
+
+        def delay(self, *args):
+            def run():
+                self.release.wait(5)
+                app.queue_bot_event(*args)
+            thread = threading.Thread(target=run)
+            thread.start()
+            self.threads.append(thread)
+
+        def finish(self):
+            self.release.set()
+            for thread in self.threads:
+                thread.join()
+            # What the event handler process does with the queue
+            while not app.pyBot.event_queue.empty():
+                app.pyBot.handle_event(app.pyBot.event_queue.get())
+
+    worker = Worker()
+    monkeypatch.setattr(app.queue_bot_event, 'delay', worker.delay)
+    yield worker
+    worker.release.set()
+
+
+def stored_messages(database):
+    return database.execute('SELECT MessageID, Text FROM Messages')
+
+
+def test_events_are_acked_before_they_are_handled(app, worker, database):
+    client = app.app.test_client()
+    response = client.post('/listening', json=message_event('Ev1'))
+    assert response.status_code == 200
+    # Acked while the worker is still held back
+    assert worker.threads[0].is_alive()
+    assert app.pyBot.event_queue.empty()
+    assert stored_messages(database) == []
+
+    worker.finish()
+    assert stored_messages(database) == [('C11500000000.000100', 'hello')]
+
+
+def test_invalid_tokens_are_not_queued(app, worker):
+    client = app.app.test_client()
+    response = client.post('/listening', json=message_event('Ev1', token='wrong'))
+    assert response.status_code == 403
+    response = client.post('/react_analytics', data={'token': 'wrong', 'text': 'most_active'})
+    assert response.get_data(as_text=True) == 'Invalid token'
+    assert worker.threads == []
+
+
+def test_redelivered_events_are_handled_once(app, worker, database):
+    client = app.app.test_client()
+    for _ in range(2):
+        assert client.post('/listening', json=message_event('Ev1')).status_code == 200
+    client.post('/listening', json=message_event('Ev2', ts='1500000001.000100'))
+    worker.finish()
+    assert len(stored_messages(database)) == 2
+
+
+def test_slash_commands_are_queued(app, worker, monkeypatch):
+    handled = []
+    monkeypatch.setattr(app.pyBot, 'handle_slash_command', lambda event: handled.append(event.event_info))
+    client = app.app.test_client()
+    response = client.post('/react_analytics', data={'token': TOKEN, 'text': 'most_active 7d', 'user_id': 'U1',
+                                                      'team_id': 'T1', 'response_url': 'https://example.com/r'})
+    assert response.status_code == 200 and response.get_data(as_text=True) == ''
+    assert handled == []
+    worker.finish()
+    assert [(event['text'], event['response_url']) for event in handled] == [('most_active 7d', 'https://example.com/r')]
+
+
+def test_synchronous_acks_handle_the_event_first(app, database, monkeypatch):
+    monkeypatch.setattr(app, 'ASYNC_ACK', False)
+    # Eager tasks still look up the result backend, keep it off REDIS_URL
+    monkeypatch.setitem(app.celery.conf, 'result_backend', 'cache+memory://')
+    client = app.app.test_client()
+    assert client.post('/listening', json=message_event('Ev1')).status_code == 200
+    # on_event ran in the request, the event is on the queue
+    assert app.pyBot.event_queue.get(timeout=1).type == bot.EVENT_TYPE_API_EVENT
+
+
+def test_acks_are_measured(app, worker, monkeypatch):
+    monkeypatch.setattr(app, 'ack_latencies', app.deque(maxlen=10))
+    client = app.app.test_client()
+    client.post('/listening', json={'challenge': 'abc'})
+    client.post('/listening', json=message_event('Ev1'))
+    stats = app.ack_stats()
+    assert stats['count'] == 2
+    assert 0 < stats['p50_ms'] <= stats['max_ms'] < 1000
+    assert 'ack_seconds_count{endpoint="hears"}' in app.metrics.render()
+
+
+def test_dms_report_delivery(app, fake_slack, monkeypatch):
+    from slack_api import SlackAPI
+    monkeypatch.setattr(app.pyBot, 'bot_client', SlackAPI('xoxb', api_url=fake_slack.url))
+    sent = app.pyBot.send_dm('U1', 'hello')
+    assert sent.result(timeout=5)
+    assert [args['channel'] for method, args in fake_slack.calls if method == 'chat.postMessage'] == ['DU1']
+    # Commands without a response_url are answered by DM, and wait for it
+    fake_slack.fail_at.add(len(fake_slack.calls) + 1)
+    assert not app.pyBot.respond({'user_id': 'U1'}, 'result')
+    monkeypatch.setattr(app.pyBot.bot_client, 'open_dm', lambda user_id: None)
+    assert not app.pyBot.send_dm('U1', 'hello').result()
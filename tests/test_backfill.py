@@ -0,0 +1,102 @@
+import random
+import pytest
+import backfill
+import slack_api
+from backfill import Backfill
+from slack_api import SlackAPI
+from test_ingest import snapshot
+
+
+@pytest.fixture
+def history(fake_slack, database, monkeypatch):
+    # Fast buckets and small pages, so a crawl takes many calls
+    monkeypatch.setattr(slack_api, 'SLACK_RATE_MULTIPLIER', 10000)
+    monkeypatch.setattr(backfill, 'BACKFILL_PAGE_SIZE', 40)
+    rng = random.Random(0)
+    for c in range(3):
+        messages = []
+        for i in range(150):
+            ts = '%d.%06d' % (1600000000 + i * 60, c)
+            message = {'type': 'message', 'user': 'U%d' % rng.randrange(5), 'text': 'message %d' % i, 'ts': ts}
+            if rng.random() < 0.3:
+                message['reactions'] = [{'name': name, 'users': ['U%d' % u for u in rng.sample(range(5), 2)]}
+                                        for name in ('eyes', 'tada')]
+            if rng.random() < 0.1:
+                message['reply_count'] = 2
+                message['replies'] = [{'type': 'message', 'user': 'U1', 'text': 'reply %d' % j,
+                                       'ts': '%d.%06d' % (1600000000 + i * 60 + j + 1, c), 'thread_ts': ts}
+                                      for j in range(2)]
+            if rng.random() < 0.05:
+                message = {'type': 'message', 'subtype': 'bot_message', 'text': 'bot', 'ts': ts}
+            messages.append(message)
+        fake_slack.channels['C%d' % c] = messages
+    return fake_slack
+
+
+def expected(fake):
+    messages = reacts = 0
+    for channel in fake.channels.values():
+        for message in channel:
+            if 'user' not in message:
+                continue
+            messages += 1 + len(message.get('replies', []))
+            reacts += sum(len(reaction['users']) for reaction in message.get('reactions', []))
+    return messages, reacts
+
+
+def loaded(db):
+    return (db.execute("SELECT COUNT(*) FROM Messages WHERE TeamID = 'T1'")[0][0],
+            db.execute("SELECT COUNT(*) FROM Reacts WHERE TeamID = 'T1'")[0][0])
+
+
+def run(fake, concurrency=2):
+    return Backfill(SlackAPI('xoxp', api_url=fake.url), 'T1', concurrency=concurrency, batch_size=50).run()
+
+
+def test_crawl(history, database):
+    stats = run(history)
+    assert (stats['channels_done'], stats['channels_failed']) == (3, 0)
+    assert loaded(database) == expected(history)
+    assert (stats['messages'], stats['reacts']) == expected(history)
+    checkpoints = Backfill(None, 'T1').checkpoints()
+    assert sorted(checkpoints) == ['C0', 'C1', 'C2']
+    assert all(done for _, _, done in checkpoints.values())
+    maintained = snapshot()
+    database.rebuild_rollups()
+    assert snapshot() == maintained
+
+
+def test_interrupted_crawl_resumes(history, database):
+    # One channel at a time, and a call after C0's first batch was written fails
+    history.fail_at = {18}
+    stats = run(history, concurrency=1)
+    assert (stats['channels_done'], stats['channels_failed']) == (2, 1)
+    assert loaded(database) < expected(history)
+    checkpoints = Backfill(None, 'T1').checkpoints()
+    oldest, newest, done = checkpoints['C0']
+    assert not done and oldest is not None
+
+    history.fail_at = set()
+    history.calls = []
+    stats = run(history, concurrency=1)
+    assert (stats['channels_done'], stats['channels_failed']) == (3, 0)
+    assert loaded(database) == expected(history)
+    # C0 carries on below what was written, the others only look for newer
+    # messages
+    first_pages = {args['channel']: args for method, args in history.calls
+                   if method == 'conversations.history' and 'cursor' not in args}
+    assert first_pages['C0'].get('latest') == oldest
+    for channel in ('C1', 'C2'):
+        assert first_pages[channel].get('oldest') == checkpoints[channel][1]
+    maintained = snapshot()
+    database.rebuild_rollups()
+    assert snapshot() == maintained
+
+
+def test_rerun_only_loads_new_messages(history, database):
+    run(history)
+    history.channels['C0'].append({'type': 'message', 'user': 'U9', 'text': 'new', 'ts': '1700000000.000000'})
+    history.calls = []
+    stats = run(history)
+    assert (stats['messages'], stats['reacts']) == (1, 0)
+    assert loaded(database) == expected(history)
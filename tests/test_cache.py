@@ -0,0 +1,51 @@
+import metrics
+from cache import ResultCache
+
+HISTOGRAM = metrics.histogram('test_cache_seconds', 'Test timings', ('function',))
+
+
+def test_uncached_reaches_past_outer_decorators():
+    cache = ResultCache(redis_url=None)
+    calls = []
+
+    @HISTOGRAM.timed()
+    @cache.cached('count')
+    def count(team_id, n):
+        calls.append(n)
+        return n
+
+    assert count('T1', 1) == count('T1', 1) == 1
+    assert calls == [1]
+    assert count.uncached('T1', 1) == 1
+    assert calls == [1, 1]
+
+
+def test_results_depend_on_the_directory(database):
+    import analytics
+    from util import Message, React
+    database.add_message(Message('T1', 'C1', '1500000000.000100', 'U1', 'ping <@U123> in <#C456>'))
+    database.add_react(React('T1', 'C1', '1500000000.000100', 'U2', 'eyes'))
+    users = {'U123': {'display_name': 'alice'}}
+    assert 'alice' in analytics.react_buzzword('T1', 'eyes', users, {})
+    assert 'bob' in analytics.react_buzzword('T1', 'eyes', {'U123': {'display_name': 'bob'}}, {})
+    assert 'general' in analytics.react_buzzword('T1', 'eyes', users, {'C456': 'general'})
+    assert 'general' in analytics.react_buzzwords('T1', ('eyes',), users, {'C456': 'general'})['eyes']
+    assert 'random' in analytics.react_buzzwords('T1', ('eyes',), users, {'C456': 'random'})['eyes']
+    # The same directory hits the cache, one with a user added doesn't
+    hits = analytics.results.stats()['hits']
+    analytics.react_buzzword('T1', 'eyes', users, {})
+    assert analytics.results.stats()['hits'] == hits + 1
+    users['U999'] = {'display_name': 'carol'}
+    analytics.react_buzzword('T1', 'eyes', users, {})
+    assert analytics.results.stats()['hits'] == hits + 1
+
+
+def test_redis_consumer_needs_a_shared_cache(monkeypatch):
+    import pytest
+    import cache
+    import consumer
+    monkeypatch.setattr(cache.results, 'redis_url', None)
+    with pytest.raises(RuntimeError):
+        consumer.check_shared_cache()
+    monkeypatch.setattr(cache.results, 'redis_url', 'redis://localhost:6379')
+    consumer.check_shared_cache()
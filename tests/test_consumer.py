@@ -0,0 +1,110 @@
+import pytest
+import consumer
+from bot import EVENT_TYPE_API_EVENT, EVENT_TYPE_SLASH_COMMAND
+from consumer import EventLog, EventConsumer, DEAD_LETTER_STREAM, GROUP
+
+
+class FakeBatcher(object):
+    def __init__(self):
+        self.fail = False
+        self.flushes = 0
+
+    def flush(self, retry=True):
+        self.flushes += 1
+        if self.fail:
+            raise RuntimeError('database is down')
+        return 0
+
+
+class FakeBot(object):
+    '''
+    Records the events it is handed and raises for the types in fail
+    '''
+    def __init__(self):
+        self.batcher = FakeBatcher()
+        self.handled = []
+        self.fail = set()
+
+    def handle_event(self, event):
+        self.handled.append((event.type, event.event_info))
+        if event.type in self.fail:
+            raise RuntimeError('handler failed')
+
+
+@pytest.fixture
+def log(redis_url, monkeypatch):
+    # Every poll claims whatever is pending, without waiting
+    monkeypatch.setattr(consumer, 'CONSUMER_RETRY_IDLE_MS', 0)
+    monkeypatch.setattr(consumer, 'CONSUMER_BLOCK_MS', 10)
+    monkeypatch.setattr(consumer, 'CONSUMER_MAX_DELIVERIES', 3)
+    event_log = EventLog(redis_url, partitions=1)
+    event_log.ensure_groups()
+    return event_log
+
+
+def api_event(n):
+    return {'event_id': 'Ev%d' % n, 'team_id': 'T1',
+            'event': {'type': 'reaction_added', 'user': 'U1', 'reaction': 'eyes', 'event_ts': '1500000001.000000',
+                      'item': {'type': 'message', 'channel': 'C1', 'ts': '1500000000.000100'}}}
+
+
+def slash_command(text):
+    return {'token': 'x', 'team_id': 'T1', 'user_id': 'U1', 'channel_id': 'C1', 'text': text,
+            'response_url': 'https://hooks.slack.invalid/1'}
+
+
+def pending(event_log):
+    return event_log.redis.xpending(event_log.stream(0), GROUP)['pending']
+
+
+def test_events_are_acked_after_the_batch_is_written(log):
+    bot = FakeBot()
+    worker = EventConsumer(bot, log, 0)
+    for n in range(3):
+        log.append(EVENT_TYPE_API_EVENT, api_event(n))
+    assert worker.poll() == 3
+    assert len(bot.handled) == 3
+    assert bot.batcher.flushes == 1
+    assert pending(log) == 0
+
+
+def test_failed_writes_are_retried(log):
+    bot = FakeBot()
+    worker = EventConsumer(bot, log, 0)
+    log.append(EVENT_TYPE_API_EVENT, api_event(1))
+    bot.batcher.fail = True
+    worker.poll()
+    assert pending(log) == 1
+    bot.batcher.fail = False
+    assert worker.poll() == 1
+    assert len(bot.handled) == 2
+    assert pending(log) == 0
+
+
+def test_failing_events_are_dead_lettered(log):
+    bot = FakeBot()
+    bot.fail.add(EVENT_TYPE_API_EVENT)
+    worker = EventConsumer(bot, log, 0)
+    log.append(EVENT_TYPE_API_EVENT, api_event(1))
+    for _ in range(5):
+        worker.poll()
+    assert len(bot.handled) == consumer.CONSUMER_MAX_DELIVERIES
+    assert log.redis.xlen(DEAD_LETTER_STREAM) == 1
+    assert pending(log) == 0
+
+
+def test_slash_commands_run_once(log):
+    bot = FakeBot()
+    bot.fail.add(EVENT_TYPE_SLASH_COMMAND)
+    worker = EventConsumer(bot, log, 0)
+    log.append(EVENT_TYPE_SLASH_COMMAND, slash_command('most_used'))
+    log.append(EVENT_TYPE_API_EVENT, api_event(1))
+    worker.poll()
+    # The batch write fails too, only the API event is retried
+    bot.batcher.fail = True
+    log.append(EVENT_TYPE_SLASH_COMMAND, slash_command('most_active'))
+    for _ in range(5):
+        worker.poll()
+    commands = [info['text'] for event_type, info in bot.handled if event_type == EVENT_TYPE_SLASH_COMMAND]
+    assert commands == ['most_used', 'most_active']
+    assert log.redis.xlen(DEAD_LETTER_STREAM) == 0
@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+import dedupe
+from dedupe import EventDeduplicator
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1500000000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(dedupe.time, 'time', clock)
+    return clock
+
+
+def test_duplicates_are_suppressed_in_memory(clock):
+    events = EventDeduplicator(window=60, redis_url=None)
+    assert not events.seen('Ev1')
+    assert events.seen('Ev1')
+    assert not events.seen('Ev2')
+    assert events.stats()['duplicates'] == events.stats()['local_duplicates'] == 1
+    events.forget('Ev1')
+    assert not events.seen('Ev1')
+
+
+def test_ids_expire_after_the_window(clock):
+    events = EventDeduplicator(window=60, redis_url=None)
+    assert not events.seen('Ev1')
+    clock.now += 59
+    assert events.seen('Ev1')
+    # Seeing it again doesn't extend the window
+    clock.now += 2
+    assert not events.seen('Ev1')
+
+
+def test_least_recently_seen_ids_are_evicted(clock):
+    events = EventDeduplicator(window=60, max_size=2, redis_url=None)
+    for event_id in ('Ev1', 'Ev2', 'Ev3'):
+        assert not events.seen(event_id)
+    assert events.stats()['size'] == 2
+    assert events.seen('Ev3')
+    assert not events.seen('Ev1')
+
+
+def test_duplicates_are_caught_across_processes(redis_url):
+    first, second = EventDeduplicator(window=1, redis_url=redis_url), EventDeduplicator(window=1, redis_url=redis_url)
+    assert not first.seen('Ev1')
+    assert second.seen('Ev1')
+    assert second.stats()['duplicates'] == 1 and second.stats()['local_duplicates'] == 0
+    # A forgotten event is accepted by whichever process gets the retry
+    assert not first.seen('Ev2')
+    first.forget('Ev2')
+    assert not second.seen('Ev2')
+    # Redis drops the ID after the window too
+    time.sleep(1.1)
+    assert not EventDeduplicator(window=1, redis_url=redis_url).seen('Ev1')
+
+
+def test_unreachable_redis_falls_back_to_memory(tmp_path):
+    pytest.importorskip('redis')
+    events = EventDeduplicator(window=60, redis_url='unix://' + str(tmp_path / 'missing.sock'))
+    assert not events.seen('Ev1')
+    assert events.seen('Ev1')
+    assert events.stats()['redis_errors'] == 1
@@ -0,0 +1,128 @@
+import pytest
+from directory import Directory
+from slack_api import SlackAPI
+
+
+def member(user_id, name, display_name=None):
+    return {'id': user_id, 'name': name, 'profile': {'display_name': display_name or name}}
+
+
+@pytest.fixture
+def slack(fake_slack):
+    fake_slack.users = {'U1': member('U1', 'ada'), 'U2': member('U2', 'grace', 'Grace H')}
+    fake_slack.channels = {'C1': [], 'C2': []}
+    fake_slack.channel_names = {'C1': 'general', 'C2': 'random'}
+    return fake_slack
+
+
+def directory(slack, redis_url=None):
+    result = Directory(SlackAPI('xoxp', api_url=slack.url), redis_url=redis_url)
+    # No refresh thread, the tests crawl and load themselves
+    result.start = lambda: None
+    return result
+
+
+def test_lookups_are_cached(slack):
+    users = directory(slack)
+    assert users.user('U2') == {'user_name': 'grace', 'display_name': 'Grace H'}
+    assert users.user('U2') == {'user_name': 'grace', 'display_name': 'Grace H'}
+    assert users.channel('C1') == 'general'
+    assert users.channel('C1') == 'general'
+    # IDs Slack doesn't know are only asked about once
+    assert users.user('U9') is None
+    assert users.user('U9') is None
+    assert slack.methods() == ['users.info', 'conversations.info', 'users.info']
+    stats = users.stats()
+    assert (stats['lookups'], stats['api_lookups'], stats['negative_hits']) == (6, 3, 1)
+
+
+def test_other_processes_load_the_crawl(slack, redis_url):
+    crawler, other = directory(slack, redis_url), directory(slack, redis_url)
+    assert crawler.refresh()
+    assert other.load() is not None
+    assert other.users == crawler.users == {'U1': {'user_name': 'ada', 'display_name': 'ada'},
+                                            'U2': {'user_name': 'grace', 'display_name': 'Grace H'}}
+    assert other.channels == {'C1': 'general', 'C2': 'random'}
+    del slack.calls[:]
+    assert other.user('U1')['user_name'] == 'ada'
+    assert other.channel('C2') == 'random'
+    assert slack.calls == []
+
+
+def test_change_events_update_every_process(slack, redis_url):
+    changed, other = directory(slack, redis_url), directory(slack, redis_url)
+    changed.refresh()
+    other.load()
+    assert changed.user('U7') is None
+    del slack.channels['C2']
+    users, channels = changed.users, changed.channels
+    del slack.calls[:]
+
+    assert changed.apply_event({'type': 'user_change', 'user': member('U1', 'ada', 'Countess')})
+    assert changed.apply_event({'type': 'team_join', 'user': member('U7', 'alan')})
+    assert changed.apply_event({'type': 'channel_rename', 'channel': {'id': 'C1', 'name': 'announcements'}})
+    assert changed.apply_event({'type': 'channel_created', 'channel': {'id': 'C3', 'name': 'new'}})
+    assert changed.apply_event({'type': 'channel_deleted', 'channel': 'C2'})
+    assert not changed.apply_event({'type': 'reaction_added'})
+
+    expected_users = {'U1': {'user_name': 'ada', 'display_name': 'Countess'},
+                      'U2': {'user_name': 'grace', 'display_name': 'Grace H'},
+                      'U7': {'user_name': 'alan', 'display_name': 'alan'}}
+    expected_channels = {'C1': 'announcements', 'C3': 'new'}
+    assert changed.users == expected_users and changed.channels == expected_channels
+    # Replaced, so results cached on the old dicts aren't served
+    assert changed.users is not users and changed.channels is not channels
+    # The negative cache doesn't hide a user who just joined
+    assert changed.user('U7') == {'user_name': 'alan', 'display_name': 'alan'}
+    # and a deleted channel is looked up, Slack no longer has it either
+    assert changed.channel('C2') is None
+    assert slack.methods() == ['conversations.info']
+    # Other processes pick the changes up on their next check
+    assert other.users['U1']['display_name'] == 'ada'
+    other.load()
+    assert other.users == expected_users and other.channels == expected_channels
+    assert changed.stats()['loads'] == 0
+
+
+def test_failed_calls_fall_back(slack, redis_url):
+    users = directory(slack, redis_url)
+    users.refresh()
+    # An error response isn't remembered as the user not existing...
+    slack.fail_at.add(len(slack.calls) + 1)
+    slack.users['U5'] = member('U5', 'linus')
+    assert users.user('U5') is None
+    assert users.user('U5')['user_name'] == 'linus'
+    assert users.stats()['errors'] == 1
+    # ...and a failed crawl keeps what was loaded
+    slack.fail_at.add(len(slack.calls) + 1)
+    assert not users.refresh()
+    assert set(users.users) == {'U1', 'U2', 'U5'}
+
+
+def test_unreachable_slack_returns_none():
+    class Down(object):
+        def api_call(self, method, **kwargs):
+            raise IOError('connection refused')
+
+    users = Directory(Down(), redis_url=None)
+    users.start = lambda: None
+    assert users.user('U1') is None
+    assert users.channel('C1') is None
+    assert users._try(users.refresh) is None
+    assert users.stats()['errors'] == 3
+    assert users._missing == {}
+    assert users.users == {} and users.channels == {}
+
+
+def test_change_events_reach_the_directory(slack):
+    from bot import Bot, Event, EVENT_TYPE_API_EVENT
+    from consumer import partition_key
+    bot = Bot(start_loop=False)
+    bot.directory = directory(slack)
+    slack_event = {'team_id': 'T1', 'event_id': 'Ev1',
+                   'event': {'type': 'channel_rename', 'channel': {'id': 'C1', 'name': 'announcements'}}}
+    assert partition_key(EVENT_TYPE_API_EVENT, slack_event) == 'C1'
+    event = Event.compact(EVENT_TYPE_API_EVENT, slack_event)
+    assert event.event_info == {'event': slack_event['event']}
+    bot.handle_event(event)
+    assert bot.directory.channels == {'C1': 'announcements'}
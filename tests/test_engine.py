@@ -0,0 +1,119 @@
+import time
+from datetime import timedelta
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import analytics
+import engine
+from ingest import coalesce
+from util import Message, React, ADD_REACT, REMOVE_MESSAGE, REMOVE_REACT
+
+TEAM = 'T1'
+DAY = timedelta(days=1)
+CASES = [('most_used_reacts', {}), ('most_used_reacts', {'user': 'U2'}), ('most_used_reacts', {'channel': 'C1'}),
+         ('most_used_reacts', {'channel': 'C1', 'user': 'U3'}), ('most_used_reacts', {'window': DAY}),
+         ('users_with_most_reacts', {}), ('users_with_most_reacts', {'window': DAY}),
+         ('most_active', {}), ('most_active', {'window': DAY}),
+         ('most_reacted_to_posts', {}), ('most_reacted_to_posts', {'user': 'U1'}),
+         ('most_reacted_to_posts', {'channel': 'C2'}), ('most_reacted_to_posts', {'window': DAY}),
+         ('most_unique_reacts_on_a_post', {}), ('most_unique_reacts_on_a_post', {'channel': 'C1'}),
+         ('most_unique_reacts_on_a_post', {'window': DAY})]
+
+
+def message(ts, channel='C1', user='U1', text='the quick brown fox', team=TEAM):
+    return Message(team, channel, ts, user, text)
+
+
+def react(ts, user, name, channel='C1', team=TEAM):
+    return React(team, channel, ts, user, name)
+
+
+def test_messages_deleted_elsewhere_are_skipped(database):
+    db = database
+    eng = engine.Engine()
+    for n, ts in enumerate(('1500000000.000100', '1500000001.000100')):
+        db.add_message(message(ts, text='message %d' % n))
+        db.add_react(react(ts, 'U2', 'eyes'))
+        db.add_react(react(ts, 'U3', 'tada'))
+    eng.reload()
+    # Deleted by another process, the engine still has the message
+    db.execute('DELETE FROM Reacts WHERE MessageID = %s', ('C11500000000.000100',))
+    db.execute('DELETE FROM Messages WHERE MessageID = %s', ('C11500000000.000100',))
+    assert eng.most_reacted_to_posts(TEAM) == [('message 1', 2)]
+    assert eng.most_unique_reacts_on_a_post(TEAM) == [('message 1', {'eyes', 'tada'})]
+
+
+def normalized(result):
+    # Ties come back in any order
+    if isinstance(result, dict):
+        return result
+    return sorted((row[0], sorted(row[1]) if isinstance(row[1], set) else row[1]) for row in result)
+
+
+def assert_matches_sql(eng):
+    for team_id in ('T1', 'T2'):
+        for name, filters in CASES:
+            sql = getattr(analytics, name).uncached.__wrapped__
+            expected = normalized(sql(team_id, count=None, **filters))
+            assert normalized(getattr(eng, name)(team_id, count=None, **filters)) == expected, (team_id, name, filters)
+
+
+def test_answers_match_the_sql(database, monkeypatch):
+    db = database
+    eng = engine.Engine()
+    monkeypatch.setattr(db, 'engine', eng)
+    now = int(time.time())
+    old, recent = '1500000000.%06d', str(now - 3600) + '.%06d'
+    for n in range(4):
+        db.add_message(message(old % n, channel='C%d' % (n % 2 + 1), user='U%d' % (n % 3 + 1), text='old %d' % n))
+        for user, name in (('U2', 'eyes'), ('U3', 'tada'), ('U%d' % (n + 1), 'fire'))[:n + 1]:
+            db.add_react(react(old % n, user, name, channel='C%d' % (n % 2 + 1)))
+    db.add_message(message(old % 9, team='T2', channel='C9', user='U4', text='theirs'))
+    db.add_react(react(old % 9, 'U4', 'eyes', channel='C9', team='T2'))
+    eng.reload()
+    assert_matches_sql(eng)
+
+    # Written after the load, applied as each write commits
+    db.add_message(message(recent % 1, channel='C1', user='U2', text='recent'))
+    db.add_message(message(recent % 2, channel='C1', user='U3', text=''))
+    for user, name in (('U1', 'eyes'), ('U3', 'eyes'), ('U4', 'rocket')):
+        db.add_react(react(recent % 1, user, name))
+    db.add_react(react(recent % 2, 'U1', 'eyes'))
+    # Reacts from the other workspace in a shared channel
+    db.add_react(react(recent % 1, 'U4', 'tada', team='T2'))
+    db.add_react(react(old % 3, 'U5', 'eyes', channel='C2', team='T2'))
+    db.add_react(react(old % 3, 'U5', 'rocket', channel='C2', team='T2'))
+    db.remove_react(react(old % 3, 'U5', 'rocket', channel='C2', team='T2'))
+    db.remove_react(react(old % 2, 'U2', 'eyes'))
+    db.remove_message(message(old % 1, channel='C2'))
+    db.write_batch(*coalesce([(REMOVE_MESSAGE, message(old % 0)), (REMOVE_REACT, react(recent % 1, 'U3', 'eyes')),
+                              (ADD_REACT, react(recent % 1, 'U5', 'fire'))]))
+    assert eng.stats()['loads'] == 1
+    assert_matches_sql(eng)
+    # and a fresh load of the same rows
+    eng.reload()
+    assert_matches_sql(eng)
+
+
+def test_writes_from_other_processes_fall_back_to_sql(database, redis_url, monkeypatch):
+    import cache
+    db = database
+    monkeypatch.setattr(cache, 'results', cache.ResultCache(redis_url=redis_url))
+    eng = engine.Engine()
+    monkeypatch.setattr(db, 'engine', eng)
+    db.add_message(message('1500000000.000100'))
+    eng.reload()
+    # This process's own writes reach the engine
+    db.add_react(react('1500000000.000100', 'U2', 'eyes'))
+    assert eng.serves(TEAM)
+    # One by another process only bumps the shared generation
+    monkeypatch.setattr(db, 'engine', None)
+    db.add_react(react('1500000000.000100', 'U3', 'eyes'))
+    cache.results._generations[TEAM] -= 1
+    assert not eng.serves(TEAM)
+    assert eng.serves('T2')
+    eng.reload()
+    assert eng.serves(TEAM)
+    assert eng.most_used_reacts(TEAM) == {'eyes': 2}
@@ -0,0 +1,138 @@
+import random
+import pytest
+import db
+from ingest import coalesce
+from util import Message, React, ADD_MESSAGE, REMOVE_MESSAGE, ADD_REACT, REMOVE_REACT
+
+TEAM = 'T1'
+CHANNEL = 'C1'
+
+
+def message(ts, user='U1', text='the quick brown fox'):
+    return Message(TEAM, CHANNEL, ts, user, text)
+
+
+def react(ts, user='U1', name='thumbsup'):
+    return React(TEAM, CHANNEL, ts, user, name)
+
+
+def snapshot():
+    '''
+    Every row that an event can change, rollups included
+    '''
+    tables = {
+        'Messages': 'SELECT MessageID, UserID, Text FROM Messages',
+        'Reacts': 'SELECT MessageID, UserID, ReactName FROM Reacts',
+        'ReactCounts': 'SELECT TeamID, ReactName, Count FROM ReactCounts WHERE Count != 0',
+        'UserReactCounts': 'SELECT TeamID, UserID, Count FROM UserReactCounts WHERE Count != 0',
+        'UserActivity': 'SELECT TeamID, UserID, Count FROM UserActivity WHERE Count != 0',
+        'MessageReactCounts': '''SELECT MessageID, TeamID, Total, DistinctReacts FROM MessageReactCounts
+                                 WHERE Total != 0''',
+        'PhraseCounts': 'SELECT TeamID, Phrase, Count FROM PhraseCounts WHERE Count != 0',
+        'MessageWords': 'SELECT MessageID, Word FROM MessageWords',
+    }
+    return {table: sorted(db.execute(query)) for table, query in tables.items()}
+
+
+def one_at_a_time(setup, ops):
+    for op, obj in setup + ops:
+        getattr(db, op)(obj)
+    return snapshot()
+
+
+def batched(setup, ops):
+    for op, obj in setup:
+        getattr(db, op)(obj)
+    db.write_batch(*coalesce(ops))
+    return snapshot()
+
+
+def compare(sqlite_url, tmp_path, setup, ops):
+    db.use(sqlite_url)
+    expected = one_at_a_time(setup, ops)
+    db.use('sqlite:///' + str(tmp_path / 'batched.db'))
+    assert batched(setup, ops) == expected
+    return expected
+
+
+def test_react_inside_a_remove_add_window_is_dropped(database, sqlite_url, tmp_path):
+    setup = [(ADD_MESSAGE, message('1500000000.000100'))]
+    ops = [(REMOVE_MESSAGE, message('1500000000.000100')),
+           (ADD_REACT, react('1500000000.000100')),
+           (ADD_MESSAGE, message('1500000000.000100'))]
+    result = compare(sqlite_url, tmp_path, setup, ops)
+    assert result['Reacts'] == []
+
+
+def test_react_before_its_message_sees_the_database(database, sqlite_url, tmp_path):
+    ops = [(ADD_REACT, react('1500000000.000100')),
+           (ADD_MESSAGE, message('1500000000.000100')),
+           (ADD_REACT, react('1500000000.000100', user='U2'))]
+    result = compare(sqlite_url, tmp_path, [], ops)
+    assert result['Reacts'] == [('C11500000000.000100', 'U2', 'thumbsup')]
+
+
+def test_react_after_a_message_is_readded_is_kept(database, sqlite_url, tmp_path):
+    setup = [(ADD_MESSAGE, message('1500000000.000100')), (ADD_REACT, react('1500000000.000100'))]
+    ops = [(REMOVE_MESSAGE, message('1500000000.000100')),
+           (ADD_MESSAGE, message('1500000000.000100', text='an edited fox')),
+           (ADD_REACT, react('1500000000.000100', name='tada')),
+           (REMOVE_REACT, react('1500000000.000100', name='tada')),
+           (ADD_REACT, react('1500000000.000100', name='tada'))]
+    result = compare(sqlite_url, tmp_path, setup, ops)
+    assert result['Reacts'] == [('C11500000000.000100', 'U1', 'tada')]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_batches_match_one_at_a_time(database, sqlite_url, tmp_path, seed):
+    rng = random.Random(seed)
+    stamps = ['1500000000.00010%d' % i for i in range(3)]
+    texts = ['the quick brown fox', 'jumps over the lazy dog', 'the quick brown dog']
+
+    def op():
+        ts = rng.choice(stamps)
+        kind = rng.choice([ADD_MESSAGE, REMOVE_MESSAGE, ADD_REACT, ADD_REACT, REMOVE_REACT])
+        if kind in (ADD_MESSAGE, REMOVE_MESSAGE):
+            return kind, message(ts, rng.choice(['U1', 'U2']), rng.choice(texts))
+        return kind, react(ts, rng.choice(['U1', 'U2']), rng.choice(['thumbsup', 'tada']))
+
+    setup = [op() for _ in range(10)]
+    ops = [op() for _ in range(30)]
+    compare(sqlite_url, tmp_path, setup, ops)
+
+
+def test_rollups_match_a_rebuild(database):
+    rng = random.Random(0)
+    stamps = ['1500000000.00010%d' % i for i in range(5)]
+    for ts in stamps:
+        db.add_message(message(ts, rng.choice(['U1', 'U2', 'U3'])))
+    ops = []
+    for _ in range(200):
+        ts = rng.choice(stamps)
+        kind = rng.choice([ADD_MESSAGE, REMOVE_MESSAGE, ADD_REACT, ADD_REACT, ADD_REACT, REMOVE_REACT])
+        if kind in (ADD_MESSAGE, REMOVE_MESSAGE):
+            ops.append((kind, message(ts, rng.choice(['U1', 'U2', 'U3']))))
+        else:
+            ops.append((kind, react(ts, rng.choice(['U1', 'U2', 'U3']), rng.choice(['thumbsup', 'tada', 'eyes']))))
+    for start in range(0, len(ops), 25):
+        db.write_batch(*coalesce(ops[start:start + 25]))
+    maintained = snapshot()
+    db.rebuild_rollups()
+    assert snapshot() == maintained
+
+
+def test_reacts_from_two_teams_on_one_message(database):
+    # A channel shared between workspaces delivers its reacts with each
+    # workspace's TeamID. They count towards the message's team.
+    database.add_message(Message('T2', CHANNEL, '1500000000.000100', 'U1', 'the quick brown fox'))
+    database.write_batch([], [], [], [React('T1', CHANNEL, '1500000000.000100', 'U1', 'eyes'),
+                                      React('T2', CHANNEL, '1500000000.000100', 'U2', 'eyes'),
+                                      React('T1', CHANNEL, '1500000000.000100', 'U2', 'tada')])
+    assert database.execute('SELECT MessageID, TeamID, Total, DistinctReacts FROM MessageReactCounts') == [
+        ('C11500000000.000100', 'T2', 3, 2)]
+    database.remove_react(React('T1', CHANNEL, '1500000000.000100', 'U2', 'tada'))
+    assert database.execute('SELECT MessageID, TeamID, Total, DistinctReacts FROM MessageReactCounts') == [
+        ('C11500000000.000100', 'T2', 2, 1)]
+    maintained = snapshot()
+    database.rebuild_rollups()
+    assert snapshot() == maintained
@@ -0,0 +1,71 @@
+import json
+import os
+import subprocess
+import sys
+import time
+import pytest
+import metrics
+
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    return tmp_path
+
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write_export(metrics_dir, pid, total, age=0):
+    snap = {'pid': pid, 'time': time.time(), 'metrics': {
+        'react_analytics_test_events_total': {'kind': 'counter', 'help': 'Test events', 'labels': ['op'],
+                                              'samples': [[['add'], total]]},
+        'react_analytics_test_depth': {'kind': 'gauge', 'help': 'Test depth', 'labels': [],
+                                       'samples': [[[], 7]]}}}
+    path = metrics_dir / ('%d.json' % pid)
+    path.write_text(json.dumps(snap))
+    stale = time.time() - age
+    os.utime(path, (stale, stale))
+    return path
+
+
+def total(text):
+    lines = [line for line in text.splitlines() if line.startswith('react_analytics_test_events_total{')]
+    return sum(float(line.split()[-1]) for line in lines)
+
+
+def test_counters_of_exited_processes_are_kept(metrics_dir):
+    stale = metrics.METRICS_STALE_INTERVALS * metrics.METRICS_EXPORT_INTERVAL + 1
+    first = write_export(metrics_dir, exited_pid(), 5, age=stale)
+    assert total(metrics.render()) == 5
+    assert not first.exists()
+    assert 'react_analytics_test_depth' not in metrics.render()
+    second = write_export(metrics_dir, exited_pid(), 3)
+    assert total(metrics.render()) == 8
+    os.utime(second, (0, 0))
+    assert total(metrics.render()) == 8
+    assert total(metrics.render()) == 8
+    assert not second.exists()
+
+
+def test_live_processes_are_not_folded(metrics_dir):
+    # A stalled process's export is still read, its totals are current
+    stale = metrics.METRICS_STALE_INTERVALS * metrics.METRICS_EXPORT_INTERVAL + 1
+    path = write_export(metrics_dir, os.getppid(), 4, age=stale)
+    assert total(metrics.render()) == 4
+    assert path.exists()
+
+
+def test_statement_labels_are_bounded(monkeypatch):
+    import db
+    import analytics
+    names = set()
+    for react_count in (1, 2, 20):
+        reacts = tuple('react%d' % i for i in range(react_count))
+        for hash_aggregate in (True, False):
+            monkeypatch.setattr(db.backend, 'hash_aggregate', hash_aggregate)
+            names.add(db.statement_name(analytics.react_words_query('T1', reacts, 5, None)[0]))
+    assert names == {'SELECT Reacts MessageWords'}
@@ -0,0 +1,127 @@
+import sqlite3
+
+import db
+
+MIGRATIONS = list(db.MIGRATIONS)
+
+
+def schema_versions():
+    return [row[0] for row in db.execute('SELECT Version FROM SchemaVersion ORDER BY Version')]
+
+
+def columns(table):
+    return {row[0] for row in db.execute('''SELECT column_name FROM information_schema.columns
+                                            WHERE table_name = %s''', (table.lower(),))}
+
+
+def test_fresh_database_runs_every_migration(postgres_url):
+    db.init_db()
+    assert schema_versions() == [migration.version for migration in db.MIGRATIONS]
+    for table in ('ReactCounts', 'UserReactCounts', 'UserActivity', 'MessageReactCounts', 'PhraseCounts'):
+        assert 'teamid' in columns(table)
+
+
+def rollups():
+    return {table: sorted(db.execute('SELECT * FROM ' + table))
+            for table in ('ReactCounts', 'UserReactCounts', 'UserActivity', 'MessageReactCounts', 'PhraseCounts')}
+
+
+def upgrade(postgres_url, monkeypatch, version):
+    '''
+    Migrates up to version, as a deploy of that release would
+    '''
+    monkeypatch.setattr(db, 'MIGRATIONS', [m for m in MIGRATIONS if m.version <= version])
+    db.backend.pool.closeall()
+    db.use(postgres_url)
+    db.init_db()
+
+
+def test_unscoped_rollups_are_kept_as_team_blank(postgres_url, monkeypatch):
+    from util import Message, React
+    upgrade(postgres_url, monkeypatch, 5)
+    for n, (user, text) in enumerate((('U1', 'quick brown fox'), ('U2', 'quick brown fox jumps'))):
+        msg_id = 'C1150000000%d.000100' % n
+        db.execute('INSERT INTO Messages (MessageID, UserID, Text) VALUES (%s, %s, %s)', (msg_id, user, text))
+        for reactor, name in (('U2', 'eyes'), ('U3', 'eyes'), ('U3', 'fire')):
+            db.execute('INSERT INTO Reacts (MessageID, UserID, ReactName) VALUES (%s, %s, %s)',
+                       (msg_id, reactor, name))
+    # Migrations 6 and 8 count the rows above, 10 keeps those counts
+    upgrade(postgres_url, monkeypatch, 9)
+    upgrade(postgres_url, monkeypatch, MIGRATIONS[-1].version)
+    assert schema_versions() == [migration.version for migration in MIGRATIONS]
+    migrated = rollups()
+    assert sorted(db.execute('SELECT TeamID, ReactName, Count FROM ReactCounts')) == [('', 'eyes', 4), ('', 'fire', 2)]
+    db.rebuild_rollups()
+    assert rollups() == migrated
+    for name in ('react_counts_count_idx', 'user_react_counts_count_idx', 'user_activity_count_idx',
+                 'message_react_counts_total_idx', 'message_react_counts_distinct_idx', 'phrase_counts_count_idx'):
+        assert 'teamid' in db.execute('SELECT indexdef FROM pg_indexes WHERE indexname = %s', (name,))[0][0].lower()
+    # New writes count by team
+    db.add_message(Message('T1', 'C2', '1500000000.000100', 'U1', 'quick brown fox'))
+    db.add_react(React('T1', 'C2', '1500000000.000100', 'U2', 'eyes'))
+    assert sorted(db.execute('SELECT TeamID, ReactName, Count FROM ReactCounts')) == \
+        [('', 'eyes', 4), ('', 'fire', 2), ('T1', 'eyes', 1)]
+    assert db.execute("SELECT Count FROM PhraseCounts WHERE TeamID = 'T1'") == [(1,)]
+
+
+def test_message_words_are_reindexed_in_batches(postgres_url, monkeypatch):
+    import nlp
+    from util import Message
+    upgrade(postgres_url, monkeypatch, 14)
+    texts = ['ask <@U123> about it', 'quick brown fox', 'thanks <@U456>']
+    for n, text in enumerate(texts):
+        db.add_message(Message('T1', 'C1', '150000000%d.000100' % n, 'U1', text))
+    # As the old tokenizer indexed them
+    db.execute('DELETE FROM MessageWords')
+    for msg_id, word in (('C11500000000.000100', 'u123'), ('C11500000002.000100', 'u456')):
+        db.execute('INSERT INTO MessageWords (MessageID, Word) VALUES (%s, %s)', (msg_id, word))
+    monkeypatch.setattr(db, 'MIGRATION_BATCH_SIZE', 2)
+    upgrade(postgres_url, monkeypatch, 15)
+    expected = {('C1150000000%d.000100' % n, token) for n, text in enumerate(texts) for token in nlp.indexed_tokens(text)}
+    assert set(db.execute('SELECT MessageID, Word FROM MessageWords')) == expected
+
+
+def set_user_version(sqlite_url, version):
+    conn = sqlite3.connect(sqlite_url[len('sqlite:///'):])
+    conn.execute('PRAGMA user_version = %d' % version)
+    conn.close()
+
+
+def test_sqlite_files_run_pending_migrations(database, sqlite_url):
+    import nlp
+    from util import Message
+    text = 'ask <@U123> about it'
+    database.add_message(Message('T1', 'C1', '1500000000.000100', 'U1', text))
+    database.execute('DELETE FROM MessageWords')
+    database.execute('INSERT INTO MessageWords (MessageID, Word) VALUES (%s, %s)', ('C11500000000.000100', 'u123'))
+    set_user_version(sqlite_url, 14)
+    db.use(sqlite_url)
+    db.init_db()
+    assert set(db.execute('SELECT Word FROM MessageWords')) == {(token,) for token in nlp.indexed_tokens(text)}
+    assert db.execute('PRAGMA user_version') == [(MIGRATIONS[-1].version,)]
+
+
+def test_new_sqlite_files_skip_migrations(sqlite_url, monkeypatch):
+    called = []
+    monkeypatch.setattr(db, 'MIGRATIONS', MIGRATIONS + [db.Migration(99, 'Test', [], False, [called.append])])
+    previous = db.DATABASE_URL
+    db.use(sqlite_url)
+    try:
+        db.init_db()
+        assert called == []
+        assert db.execute('PRAGMA user_version') == [(99,)]
+    finally:
+        db.use(previous)
+
+
+def test_message_react_counts_move_to_the_message_team(database, sqlite_url):
+    from util import Message, React
+    database.add_message(Message('T2', 'C1', '1500000000.000100', 'U1', 'quick brown fox'))
+    database.add_react(React('T1', 'C1', '1500000000.000100', 'U2', 'eyes'))
+    # As migration 10 to 15 left it
+    database.execute("UPDATE MessageReactCounts SET TeamID = 'T1'")
+    set_user_version(sqlite_url, 15)
+    db.use(sqlite_url)
+    db.init_db()
+    assert database.execute('SELECT MessageID, TeamID, Total FROM MessageReactCounts') == [
+        ('C11500000000.000100', 'T2', 1)]
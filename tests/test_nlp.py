@@ -0,0 +1,61 @@
+import threading
+import nlp
+from util import Message, React
+
+USERS = {'U123': 'alice'}
+CHANNELS = {'C456': 'general'}
+
+
+def test_mentions_are_resolved():
+    counts = nlp.Tokenizer().count(['ask <@U123>, in <#C456|general>', 'thanks <@U123>!', 'cc <@U999>'],
+                                   USERS, CHANNELS)
+    assert counts['alice'] == 2
+    assert counts['general'] == 1
+    assert counts['<@U999>'] == 1
+    assert 'u123' not in counts
+
+
+def test_stop_words_and_punctuation():
+    assert nlp.Tokenizer().tokens('The fox, the DOG!') == {'fox', 'dog'}
+
+
+def test_shared_tokenizer_with_a_small_cache():
+    tokenizer = nlp.Tokenizer(cache_size=50)
+    texts = [' '.join('word%d' % ((i * 7 + j) % 400) for j in range(20)) for i in range(200)]
+    expected = [nlp.Tokenizer().tokens(text) for text in texts]
+    errors = []
+
+    def run():
+        try:
+            for _ in range(20):
+                assert [tokenizer.tokens(text) for text in texts] == expected
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_buzzwords_resolve_indexed_mentions(database):
+    import analytics
+    database.add_message(Message('T1', 'C1', '1500000000.000100', 'U1', 'ping <@U123> about it'))
+    database.add_react(React('T1', 'C1', '1500000000.000100', 'U2', 'eyes'))
+    users = {'U123': {'display_name': 'alice'}}
+    assert 'alice' in analytics.react_buzzword('T1', 'eyes', users, {})
+
+
+def test_mentions_are_what_changed_from_the_reference():
+    from bench import reference_unique_words, synthetic_messages
+    users = {'U%d' % i: {'display_name': 'user%d' % i} for i in range(50)}
+    channels = {'C%d' % i: 'channel%d' % i for i in range(10)}
+    plain = [msg for msg in synthetic_messages(2000) if '<' not in msg]
+    assert nlp.Tokenizer().count(plain, {u: users[u]['display_name'] for u in users}, channels) == \
+        reference_unique_words(plain, users, channels)
+    # The reference lowercased and stripped mentions before looking them up
+    msgs = ['ask <@U7> in <#C3>']
+    assert reference_unique_words(msgs, users, channels) == {'ask': 1, 'u7': 1, 'c3': 1}
+    assert nlp.Tokenizer().count(msgs, {'U7': 'user7'}, channels) == {'ask': 1, 'user7': 1, 'channel3': 1}
@@ -0,0 +1,110 @@
+import pickle
+from collections import OrderedDict
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import sketch
+
+SMALL = dict(width=64, depth=2, top_k=4, react_top_k=3, precision=4, capacity=32)
+
+
+def messages(team_id, count):
+    return [('%s.%d' % (team_id, n), team_id, 'the quick brown fox %d jumps' % (n % 3)) for n in range(count)]
+
+
+def changes(team_id, count=6):
+    rows = messages(team_id, count)
+    reacts = [(msg_id, team_id, name) for msg_id, _, _ in rows for name in ('eyes', 'fire')]
+    words = {msg_id: text.split(' ') for msg_id, _, text in rows}
+    return [('messages', 1, rows), ('reacts', 1, reacts, words)]
+
+
+def answers(sketches, team_id):
+    return (sketches.common_phrases(team_id, 4), sketches.react_words(team_id, 'eyes', 3),
+            sketches.most_unique_messages(team_id))
+
+
+def test_dumps_round_trip():
+    team = sketch.TeamSketches(**SMALL)
+    sketches = sketch.Sketches(**SMALL)
+    sketches._apply(OrderedDict(T1=team), changes('T1', 40))
+    copy = sketch.TeamSketches.loads(team.dumps())
+    assert copy.params == team.params
+    assert (copy.phrases.table == team.phrases.table).all()
+    assert (copy.words.table == team.words.table).all()
+    assert copy.phrases.total == team.phrases.total and copy.words.total == team.words.total
+    assert copy.top_phrases.top(4, copy.phrases) == team.top_phrases.top(4, team.phrases)
+    assert copy.top_words['eyes'].top(3, copy.words, 'eyes\0') == team.top_words['eyes'].top(3, team.words, 'eyes\0')
+    assert copy.reacts.ranked() == team.reacts.ranked()
+    assert copy.reacts.estimate('T1.0') == team.reacts.estimate('T1.0')
+    # The loaded sketches keep counting
+    copy.reacts.add(['T1.99'], ['eyes'])
+    assert copy.reacts.estimate('T1.99') > 0
+
+
+def test_other_formats_are_not_read():
+    team = sketch.TeamSketches(**SMALL)
+    assert sketch.TeamSketches.loads(pickle.dumps(team)) is None
+    data = bytearray(team.dumps())
+    data[4] += 1
+    assert sketch.TeamSketches.loads(bytes(data)) is None
+
+
+def test_pickled_rows_are_rebuilt(database):
+    from util import Message
+    database.add_message(Message('T1', 'C1', '1500000000.000100', 'U1', 'quick brown fox'))
+    database.execute(sketch.SAVE_SKETCH, ('T1', pickle.dumps(sketch.TeamSketches(**SMALL)), None))
+    sketches = sketch.Sketches(**SMALL)
+    sketches.load()
+    assert sketches.stats()['built']
+    assert sketches.common_phrases('T1', 4) == [('quick brown fox', 1)]
+    data = bytes(database.execute(sketch.LOAD_TEAM_SKETCH, ('T1',))[0][0])
+    assert data.startswith(sketch.SKETCH_MAGIC)
+
+
+def test_least_recently_used_teams_are_dropped(database):
+    team_bytes = sketch.TeamSketches(**SMALL).nbytes()
+    sketches = sketch.Sketches(max_bytes=2 * team_bytes, **SMALL)
+    sketches.load()
+    expected = {}
+    for team_id in ('T1', 'T2', 'T3', 'T4'):
+        sketches.apply(changes(team_id))
+        expected[team_id] = answers(sketches, team_id)
+        assert len(sketches.teams) <= 2
+    assert list(sketches.teams) == ['T3', 'T4']
+    assert sketches.stats()['teams'] == 4
+    # Dropped teams were saved, and come back as they were
+    assert {team_id for team_id, _ in database.execute(sketch.LOAD_SKETCHES)} == {'T1', 'T2'}
+    assert answers(sketches, 'T1') == expected['T1']
+    assert list(sketches.teams) == ['T4', 'T1']
+    sketches.apply(changes('T2'))
+    assert list(sketches.teams) == ['T1', 'T2']
+    assert sketches.common_phrases('T2', 1)[0][1] == 2 * expected['T2'][0][0][1]
+    assert sketches.common_phrases('T9', 4) == []
+    # A restart loads the most recently saved teams up to the limit
+    sketches.save()
+    restarted = sketch.Sketches(max_bytes=2 * team_bytes, **SMALL)
+    restarted.load()
+    assert not restarted.stats()['built']
+    assert len(restarted.teams) <= 2
+    for team_id in ('T1', 'T3', 'T4'):
+        assert answers(restarted, team_id) == expected[team_id]
+
+
+def test_build_drops_teams_past_the_limit(database):
+    from util import Message, React
+    for team_id in ('T1', 'T2', 'T3'):
+        for n in range(3):
+            ts = '150000000%d.000100' % n
+            database.add_message(Message(team_id, 'C' + team_id, ts, 'U1', 'quick brown fox'))
+            database.add_react(React(team_id, 'C' + team_id, ts, 'U2', 'eyes'))
+    team_bytes = sketch.TeamSketches(**SMALL).nbytes()
+    sketches = sketch.Sketches(max_bytes=team_bytes, **SMALL)
+    sketches.load()
+    assert sketches.stats()['built']
+    assert len(sketches.teams) == 1
+    for team_id in ('T1', 'T2', 'T3'):
+        assert sketches.common_phrases(team_id, 4) == [('quick brown fox', 3)]
+        assert [word for word, _ in sketches.react_words(team_id, 'eyes', 3)] == ['brown', 'fox', 'quick']
@@ -0,0 +1,92 @@
+import threading
+import time
+import slack_api
+from slack_api import SlackAPI, TokenBucket
+
+
+def test_bucket_allows_a_burst_then_the_rate():
+    bucket = TokenBucket(600, burst=2)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    start = time.time()
+    bucket.acquire()
+    # 10 calls a second
+    assert 0.05 < time.time() - start < 0.5
+
+
+def test_pause_holds_back_every_caller():
+    bucket = TokenBucket(6000, burst=10)
+    bucket.pause(0.3)
+    waits = []
+    threads = [threading.Thread(target=lambda: waits.append(bucket.acquire())) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert min(waits) >= 0.25
+
+
+def test_rate_limited_calls_wait_and_retry(fake_slack):
+    fake_slack.rate_limits['users.info'] = [0.3]
+    api = SlackAPI('xoxb', api_url=fake_slack.url)
+    start = time.time()
+    assert api.api_call('users.info', user='U1') == {'ok': True}
+    assert time.time() - start >= 0.3
+    assert fake_slack.methods() == ['users.info', 'users.info']
+    assert api.stats()['rate_limited'] == 1
+
+
+def test_a_429_pauses_the_whole_tier(fake_slack):
+    fake_slack.rate_limits['users.info'] = [0.3]
+    api = SlackAPI('xoxb', api_url=fake_slack.url)
+    api.api_call('users.info', user='U1')
+    # users.list is another tier and isn't held back
+    start = time.time()
+    api.api_call('users.list')
+    assert time.time() - start < 0.2
+    fake_slack.rate_limits['users.info'] = [0.3]
+    thread = threading.Thread(target=api.api_call, args=('users.info',), kwargs={'user': 'U2'})
+    thread.start()
+    time.sleep(0.1)
+    start = time.time()
+    # auth.test shares users.info's tier
+    api.api_call('auth.test')
+    assert time.time() - start >= 0.1
+    thread.join()
+
+
+def test_retries_give_up(fake_slack, monkeypatch):
+    monkeypatch.setattr(slack_api, 'SLACK_MAX_RETRIES', 2)
+    fake_slack.rate_limits['users.info'] = [0, 0, 0, 0]
+    api = SlackAPI('xoxb', api_url=fake_slack.url)
+    assert api.api_call('users.info', user='U1') == {'ok': False, 'error': 'ratelimited'}
+    assert fake_slack.methods() == ['users.info'] * 3
+
+
+def test_auth_and_dm_channels_are_cached(fake_slack):
+    api = SlackAPI('xoxb', api_url=fake_slack.url)
+    assert [api.auth_test('good') for _ in range(3)] == [True] * 3
+    assert [api.auth_test('bad') for _ in range(3)] == [False] * 3
+    assert [api.open_dm('U1') for _ in range(3)] == ['DU1'] * 3
+    assert fake_slack.methods() == ['auth.test', 'auth.test', 'conversations.open']
+
+
+def test_queued_messages_are_coalesced_per_channel(fake_slack):
+    api = SlackAPI('xoxb', api_url=fake_slack.url)
+    for i in range(3):
+        api.queue_message('D1', 'message %d' % i)
+    api.queue_message('D2', 'other')
+    api.flush_messages()
+    posts = [(args['channel'], args['text']) for method, args in fake_slack.calls if method == 'chat.postMessage']
+    assert posts == [('D1', 'message 0\n\nmessage 1\n\nmessage 2'), ('D2', 'other')]
+
+
+def test_queued_messages_report_whether_they_were_posted(fake_slack):
+    api = SlackAPI('xoxb', api_url=fake_slack.url)
+    first, second = api.queue_message('D1', 'one'), api.queue_message('D1', 'two')
+    other = api.queue_message('D2', 'other')
+    # The second post fails
+    fake_slack.fail_at.add(2)
+    assert not first.done()
+    api.flush_messages()
+    assert (first.result(), second.result(), other.result()) == (True, True, False)
@@ -0,0 +1,42 @@
+from util import compact_api_event, create_record, encode_api_event, decode_api_event
+from util import ADD_MESSAGE, REMOVE_MESSAGE, ADD_REACT
+
+# As Slack sends them, see https://api.slack.com/events/message/message_deleted
+MESSAGE_DELETED = {
+    'token': 'x', 'team_id': 'T1', 'api_app_id': 'A1', 'type': 'event_callback', 'event_id': 'Ev1',
+    'event': {'type': 'message', 'subtype': 'message_deleted', 'hidden': True, 'channel': 'C1',
+              'ts': '1500000100.000200', 'deleted_ts': '1500000000.000100', 'event_ts': '1500000100.000200',
+              'channel_type': 'channel',
+              'previous_message': {'type': 'message', 'user': 'U1', 'text': 'hello', 'ts': '1500000000.000100'}}}
+
+MESSAGE = {'team_id': 'T1', 'event_id': 'Ev2',
+           'event': {'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': 'hello', 'ts': '1500000000.000100',
+                     'event_ts': '1500000000.000100', 'channel_type': 'channel'}}
+
+REACTION_ADDED = {'team_id': 'T1', 'event_id': 'Ev3',
+                  'event': {'type': 'reaction_added', 'user': 'U2', 'reaction': 'eyes',
+                            'item': {'type': 'message', 'channel': 'C1', 'ts': '1500000000.000100'},
+                            'item_user': 'U1', 'event_ts': '1500000050.000300'}}
+
+
+def test_message_deleted_removes_the_deleted_message():
+    op, msg = create_record(decode_api_event(encode_api_event(compact_api_event(MESSAGE_DELETED))))
+    op_added, added = create_record(compact_api_event(MESSAGE))
+    assert (op, op_added) == (REMOVE_MESSAGE, ADD_MESSAGE)
+    assert msg.msg_id == added.msg_id
+    assert (msg.team_id, msg.user_id) == ('T1', 'U1')
+
+
+def test_reaction_added():
+    op, react = create_record(compact_api_event(REACTION_ADDED))
+    assert op == ADD_REACT
+    assert (react.msg_id, react.user_id, react.name) == ('C11500000000.000100', 'U2', 'eyes')
+
+
+def test_unhandled_messages():
+    edited = {'team_id': 'T1', 'event': {'type': 'message', 'subtype': 'message_changed', 'channel': 'C1',
+                                         'ts': '1500000100.000200', 'message': {'user': 'U1', 'text': 'hi'}}}
+    bot_message = {'team_id': 'T1', 'event': {'type': 'message', 'subtype': 'bot_message', 'channel': 'C1',
+                                              'ts': '1500000100.000200', 'text': 'hi', 'bot_id': 'B1'}}
+    assert compact_api_event(edited) is None
+    assert compact_api_event(bot_message) is None